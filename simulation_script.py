@@ -4,7 +4,7 @@ import numpy as np
 
 from trafficgraphnn.sumo_network import SumoNetwork
 from trafficgraphnn.genconfig import ConfigGenerator
-from trafficgraphnn.preprocessing.preprocess import run_preprocessing
+from trafficgraphnn.simulation_farm import SimulationFarm
 
 def main(
     net_name,
@@ -16,6 +16,7 @@ def main(
     grid_number=3,
     grid_length=750,
     num_lanes=3,
+    num_concurrent=1,
 ):
     np.random.seed(seed)
     net_dir = os.path.join('data/networks', net_name)
@@ -38,17 +39,14 @@ def main(
         config.define_tls_output_file()
         sn = SumoNetwork.from_gen_config(config)
 
-    if sim_end_time is not None:
-        run_arg = ['--end', str(sim_end_time)]
-    else:
-        run_arg = None
-
-    for _ in range(num_simulations):
-            sn.config_gen.gen_rand_trips(
-                period=period, binomial=None, end_time=trip_end_time)
-            sn.routefile = os.path.join(net_dir, f'{net_name}_rand.trips.xml')
-            sn.run(extra_args=run_arg)
-            run_preprocessing(sn)
+    # simulations run while earlier ones are preprocessed
+    farm = SimulationFarm(
+        sn, num_concurrent=num_concurrent, period=period,
+        trip_end_time=trip_end_time, sim_end_time=sim_end_time,
+        seed=seed)
+    farm.run(num_simulations)
+    for line in farm.scheduler.format_stats():
+        print(line)
 
 
 if __name__ == '__main__':
@@ -72,6 +70,9 @@ if __name__ == '__main__':
                         help='Number of lanes per road.')
     parser.add_argument('--seed', '-s', type=int, default=1234,
                         help="Random seed.")
+    parser.add_argument('--num_concurrent', '-j', type=int, default=1,
+                        help='Number of simulations to run at once. Each '
+                        'concurrent run writes to its own output directory.')
 
     args = parser.parse_args()
     main(args.net_name, args.num_simulations,
@@ -82,4 +83,5 @@ if __name__ == '__main__':
          grid_length=args.grid_length,
          num_lanes=args.num_lanes,
          seed=args.seed,
+         num_concurrent=args.num_concurrent,
     )
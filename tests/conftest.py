@@ -0,0 +1,53 @@
+import os
+import tempfile
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def run_network():
+    """Small grid network simulated with its outputs in a run directory, the
+    way SimulationFarm runs simulations"""
+    from trafficgraphnn.genconfig import ConfigGenerator
+    from trafficgraphnn.simulation_farm import write_run_additional_files
+    from trafficgraphnn.sumo_network import SumoNetwork
+
+    with tempfile.TemporaryDirectory() as path:
+        config = ConfigGenerator('test', os.path.join(path, 'data/networks'))
+        config.gen_grid_network(grid_number=3, grid_length=200, num_lanes=1)
+        config.gen_rand_trips(period=2, end_time=900, seed=1)
+        config.gen_e1_detectors(distance_to_tls=[5, 125], frequency=1)
+        config.gen_e2_detectors(distance_to_tls=0, frequency=1)
+        config.define_tls_output_file()
+        sn = SumoNetwork.from_gen_config(config)
+
+        run_dir = os.path.join(path, 'run0')
+        output_dir = os.path.join(run_dir, 'output')
+        os.makedirs(output_dir)
+        run_sn = SumoNetwork(
+            sn.netfile, routefile=sn.routefile,
+            addlfiles=write_run_additional_files(
+                sn.additional_files, run_dir, output_dir),
+            output_dir=output_dir)
+        run_sn.run(seed=1)
+        yield run_sn
+
+
+@pytest.fixture(scope='session')
+def raw_xml_file(run_network):
+    """Raw hdf file of the `run_network` simulation's outputs"""
+    from trafficgraphnn.preprocessing.io import write_hdf_for_sumo_network
+    return write_hdf_for_sumo_network(run_network)
+
+
+@pytest.fixture(scope='session')
+def preprocessed_file(run_network, raw_xml_file):
+    """Preprocessed file of the `run_network` simulation, with averaged
+    levels for intervals 5 and 10 and cycle tables"""
+    from trafficgraphnn.preprocessing.preprocess import write_per_lane_tables
+
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, '0001.h5')
+        write_per_lane_tables(filename, run_network, raw_xml_file,
+                              pyramid_intervals=[5, 10], cycle_tables=True)
+        yield filename
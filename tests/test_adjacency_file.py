@@ -0,0 +1,62 @@
+import os
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+from trafficgraphnn.preprocessing import io
+
+
+def test_adjacency_file_roundtrip():
+    lanes = ['a_0', 'a_1', 'b_0']
+    A_matrices = {
+        'A_downstream': sparse.csr_matrix(
+            np.array([[0, 0, 1], [0, 0, 1], [0, 0, 0]], dtype=bool)),
+        'A_neighbors': sparse.csr_matrix(
+            np.array([[0, 1, 0], [1, 0, 0], [0, 0, 0]], dtype=bool)),
+    }
+    with tempfile.TemporaryDirectory() as path:
+        filename, A_hash = io.write_adjacency_file(path, lanes, A_matrices)
+        # identical adjacency is deduplicated into the same file
+        assert io.write_adjacency_file(path, lanes, A_matrices) == (
+            filename, A_hash)
+        assert len(os.listdir(path)) == 1
+
+        read_lanes, A_dict = io.read_adjacency_file(filename, A_hash)
+        assert list(read_lanes) == lanes
+        for name, A in A_matrices.items():
+            np.testing.assert_array_equal(A_dict[name], A.toarray())
+
+        # second read comes from the cache
+        assert io.read_adjacency_file(filename, A_hash)[1] is A_dict
+
+
+def test_copy_preprocessed_file(preprocessed_file):
+    import shutil
+
+    import pandas as pd
+    import pytest
+
+    from trafficgraphnn.load_data import read_from_file
+
+    expected = read_from_file(preprocessed_file)
+    with tempfile.TemporaryDirectory() as path:
+        copy = io.copy_preprocessed_file(preprocessed_file, path)
+        for array, expected_array in zip(read_from_file(copy), expected):
+            np.testing.assert_array_equal(array, expected_array)
+
+        # a file copied on its own names the missing adjacency file
+        alone_dir = os.path.join(path, 'alone')
+        os.makedirs(alone_dir)
+        alone = os.path.join(alone_dir, os.path.basename(preprocessed_file))
+        shutil.copy(preprocessed_file, alone)
+        with pytest.raises(FileNotFoundError, match=io.ADJACENCY_DIRNAME):
+            read_from_file(alone)
+
+        # an adjacency file with the same hash next to the file is found
+        with pd.HDFStore(copy, 'r') as store:
+            A_filename, A_hash = io.adjacency_ref(store, copy)
+        shutil.copy(A_filename, alone_dir)
+        with pd.HDFStore(alone, 'r') as store:
+            assert io.adjacency_ref(store, alone) == (
+                os.path.join(alone_dir, os.path.basename(A_filename)), A_hash)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from trafficgraphnn.bucketing import (bucketed_file_order, effective_shape,
+                                      padding_efficiency)
+
+
+def test_effective_shape():
+    entry = {'lanes': 12, 'timesteps': 3600, 't0': 0., 'freq': 1.}
+    assert effective_shape(entry) == (12, 3600)
+    assert effective_shape(entry, max_time=999) == (12, 1000)
+    assert effective_shape(entry, max_time=999, average_interval=60) \
+        == (12, 17)
+
+
+def test_bucketing_reduces_padding():
+    shapes = {}
+    for i in range(16):
+        shapes['short_{}'.format(i)] = (10, 100)
+        shapes['long_{}'.format(i)] = (40, 1000)
+    mixed = sorted(shapes)
+    np.random.RandomState(0).shuffle(mixed)
+
+    order = bucketed_file_order(shapes, 4,
+                                random_state=np.random.RandomState(0))
+    assert sorted(order) == sorted(shapes)
+    for i in range(0, len(order), 4):
+        assert len(set(shapes[f] for f in order[i:i + 4])) == 1
+
+    assert padding_efficiency(order, shapes, 4)['efficiency'] == 1.
+    assert padding_efficiency(mixed, shapes, 4)['efficiency'] < .9
+
+    # bucket edges merge nearby lengths
+    shapes = {'a': (10, 90), 'b': (10, 110), 'c': (10, 900), 'd': (10, 95)}
+    order = bucketed_file_order(shapes, 2, time_boundaries=[200],
+                                shuffle=False)
+    assert set(order[:2]) == {'a', 'b'}
+    assert order[-1] == 'c'
+
+
+def test_cycle_level_rejects_bucket_by_shape():
+    from trafficgraphnn.load_data_tf import TFBatcher
+
+    with pytest.raises(ValueError):
+        TFBatcher([], 1, None, bucket_by_shape=True, cycle_level=True)
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from trafficgraphnn.preprocessing.codec import decode_table, encode_table
+
+
+def test_encode_decode_is_exact():
+    df = pd.DataFrame({
+        'e1_0/occupancy': np.float32([0., 33.33, 100., 12.5]),
+        'e1_0/speed': np.float32([-1., 13.89, 0.01, 27.78]),
+        'e2_0/nVehSeen': np.float32([0., 3., 12., 7.]),
+        'green': np.float32([0., 1., 1., 0.]),
+        'liu_estimated_veh': np.float32([-1., 2.3456789, 0., 1.]),
+        'e2_0/maxJamLengthInVehicles': np.float32([-1., np.nan, 2., 0.]),
+    })
+    encoded, codecs = encode_table(df)
+
+    assert encoded['e1_0/occupancy'].dtype == np.uint16
+    assert encoded['e1_0/speed'].dtype == np.int16
+    assert encoded['e2_0/nVehSeen'].dtype == np.int16
+    assert encoded['green'].dtype == np.uint8
+    # no codec for this feature
+    assert encoded['liu_estimated_veh'].dtype == np.float32
+    # blanks can't be encoded
+    assert codecs['e2_0/maxJamLengthInVehicles'] == ('float32', 1)
+
+    columns = list(df.columns)
+    decoded = decode_table(encoded, columns, codecs)
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, df.values)
+
+    # values off the codec's precision fall back to float32
+    encoded, codecs = encode_table(
+        pd.DataFrame({'occupancy': np.float32([1.005, 2.])}))
+    assert codecs['occupancy'] == ('float32', 1)
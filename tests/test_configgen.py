@@ -30,3 +30,135 @@ def test_netgenerate_bin(default_config_gen):
     expected_binfile = os.path.join(get_sumo_dir(), 'bin', 'netgenerate')
 
     assert genconfig.netgenerate_bin == expected_binfile
+
+
+def test_sample_trip_files(default_config_gen):
+    from lxml import etree
+    from trafficgraphnn.gendata import _fringe_edges, sample_trip_files
+
+    genconfig = default_config_gen
+    genconfig.gen_grid_network(grid_number=3, grid_length=100, num_lanes=1)
+    netfile = genconfig.net_output_file
+    tripfiles = [os.path.join(genconfig.net_config_dir, f'{i}.trips.xml')
+                 for i in range(3)]
+    sample_trip_files(netfile, tripfiles, [1, 1, 2], period=10, end_time=600)
+
+    fringe = _fringe_edges(netfile)
+    sources = {fringe.edge_ids[i] for i in fringe.reachable_pairs[:, 0]}
+    sinks = {fringe.edge_ids[i] for i in fringe.reachable_pairs[:, 1]}
+
+    trips = [etree.parse(f).getroot().findall('trip') for f in tripfiles]
+    # one departure every 10 s, minus trips with unreachable sinks
+    assert 0 < len(trips[0]) <= 60
+    assert all(trip.get('from') in sources and trip.get('to') in sinks
+               for trip in trips[0])
+    # same seed gives the same trips
+    assert ([etree.tostring(t) for t in trips[0]]
+            == [etree.tostring(t) for t in trips[1]])
+    assert ([etree.tostring(t) for t in trips[0]]
+            != [etree.tostring(t) for t in trips[2]])
+
+
+def _trips(tripfile):
+    from lxml import etree
+    return [(trip.get('from'), trip.get('to'), float(trip.get('depart')))
+            for trip in etree.parse(tripfile).getroot().findall('trip')]
+
+
+def _frequencies(values):
+    from collections import Counter
+    counts = Counter(values)
+    return {k: v / len(values) for k, v in counts.items()}
+
+
+def test_sample_trip_files_matches_random_trips(default_config_gen):
+    from trafficgraphnn.gendata import (_fringe_edges, fringe_weight_files,
+                                        run_random_trips, sample_trip_files)
+
+    genconfig = default_config_gen
+    genconfig.gen_grid_network(grid_number=3, grid_length=100, num_lanes=1)
+    netfile = genconfig.net_output_file
+    sampled_file = os.path.join(genconfig.net_config_dir,
+                                'sampled.trips.xml')
+    random_trips_file = os.path.join(genconfig.net_config_dir,
+                                     'randomtrips.trips.xml')
+
+    sample_trip_files(netfile, [sampled_file], [1], period=.5, binomial=4,
+                      end_time=3000)
+    run_random_trips(['--net-file', netfile,
+                      '--output-trip-file', random_trips_file,
+                      '--period', '.5', '--binomial', '4',
+                      '--begin', '0', '--end', '3000',
+                      '--vehicle-class', 'passenger',
+                      '--weights-prefix', fringe_weight_files(netfile),
+                      '--seed', '1'])
+
+    fringe = _fringe_edges(netfile)
+    reachable = {(fringe.edge_ids[i], fringe.edge_ids[j])
+                 for i, j in fringe.reachable_pairs}
+    sampled = _trips(sampled_file)
+    # the sampler drops the unroutable trips that routing would drop
+    random_trips = [trip for trip in _trips(random_trips_file)
+                    if trip[:2] in reachable]
+    assert all(trip[:2] in reachable for trip in sampled)
+
+    # about 6000 trips each, so counts agree to a few standard deviations
+    assert abs(len(sampled) - len(random_trips)) < .05 * len(random_trips)
+    for position in [0, 1]: # sources, then sinks
+        sampled_freqs = _frequencies([trip[position] for trip in sampled])
+        random_trips_freqs = _frequencies(
+            [trip[position] for trip in random_trips])
+        assert set(sampled_freqs) == set(random_trips_freqs)
+        assert all(abs(sampled_freqs[edge] - random_trips_freqs[edge]) < .025
+                   for edge in sampled_freqs)
+    # departures per 500 s
+    sampled_freqs = _frequencies([int(trip[2] // 500) for trip in sampled])
+    random_trips_freqs = _frequencies(
+        [int(trip[2] // 500) for trip in random_trips])
+    assert all(abs(sampled_freqs.get(k, 0) - random_trips_freqs[k]) < .025
+               for k in random_trips_freqs)
+
+
+def test_net_cache(default_config_gen):
+    from trafficgraphnn import net_cache
+
+    genconfig = default_config_gen
+    genconfig.gen_grid_network(grid_number=3, grid_length=100, num_lanes=1)
+    netfile = genconfig.net_output_file
+
+    net_cache.clear_cache(netfile, remove_disk_cache=True)
+    parsed = net_cache.get_parsed_net(netfile)
+    assert net_cache.read_net(netfile) is parsed.net
+    assert os.path.exists(net_cache.disk_cache_filename(netfile))
+
+    # a new process would load the pickle instead of parsing
+    net_cache.clear_cache(netfile)
+    loaded = net_cache.get_parsed_net(netfile)
+    assert loaded is not parsed
+    # only the derived data is cached, the net is parsed on first use
+    assert loaded._net is None
+    assert loaded.sha1 == parsed.sha1
+    assert set(loaded.lane_graph.edges) == set(parsed.lane_graph.edges)
+    assert ([e.getID() for e in loaded.net.getEdges()]
+            == [e.getID() for e in parsed.net.getEdges()])
+
+
+def test_net_cache_write_failure(default_config_gen, monkeypatch):
+    from trafficgraphnn import net_cache
+
+    genconfig = default_config_gen
+    genconfig.gen_grid_network(grid_number=3, grid_length=100, num_lanes=1)
+    netfile = genconfig.net_output_file
+    net_cache.clear_cache(netfile, remove_disk_cache=True)
+
+    def fail(self):
+        raise AttributeError("Can't pickle local object")
+    monkeypatch.setattr(net_cache.ParsedNet, '__getstate__', fail)
+
+    # an unpicklable net is just not cached
+    parsed = net_cache.get_parsed_net(netfile)
+    assert net_cache.read_net(netfile) is parsed.net
+    directory = os.path.dirname(os.path.abspath(netfile))
+    assert not any(name.endswith('.tmp') for name in os.listdir(directory))
+    assert not os.path.exists(net_cache.disk_cache_filename(netfile))
+    net_cache.clear_cache(netfile)
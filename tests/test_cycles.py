@@ -0,0 +1,33 @@
+import numpy as np
+
+from trafficgraphnn.preprocessing.cycles import (aggregate_cycles,
+                                                 cycle_feature_names)
+
+
+def test_aggregate_cycles():
+    x_features = ['e1_0/occupancy', 'green']
+    y_features = ['e2_0/maxJamLengthInVehicles', 'e2_0/nVehSeen']
+    green = np.array([[0, 1, 1, 0, 0, 1, 0],
+                      [1, 1, 1, 1, 1, 1, 1]], dtype=np.float32)
+    X = np.stack([np.tile(np.arange(1, 8, dtype=np.float32), (2, 1)), green],
+                 -1)
+    Y = np.stack([np.tile(np.array([0, 5, 1, 2, 9, 0, 3], np.float32), (2, 1)),
+                  np.tile(np.array([1, 1, 1, 1, 2, 2, 2], np.float32), (2, 1))],
+                 -1)
+
+    X_cycle, Y_cycle, bounds = aggregate_cycles(
+        X, Y, green, x_features, y_features,
+        per_cycle_features=['e2_0/maxJamLengthInVehicles'])
+
+    assert cycle_feature_names(x_features) == [
+        'e1_0/occupancy/mean', 'e1_0/occupancy/max', 'green/mean',
+        'cycle_length']
+    # red starts at 0, 3 and 6 bound two cycles
+    np.testing.assert_array_equal(bounds[0], [[0, 3], [3, 6]])
+    np.testing.assert_allclose(X_cycle[0], [[2, 3, 2 / 3, 3],
+                                            [5, 6, 1 / 3, 3]])
+    # per-cycle targets include the closing red start
+    np.testing.assert_allclose(Y_cycle[0], [[5, 1], [9, 5 / 3]])
+    # a lane that never turns red has no cycles
+    np.testing.assert_array_equal(bounds[1], -1)
+    np.testing.assert_array_equal(Y_cycle[1, :, 0], [-1, -1])
@@ -0,0 +1,22 @@
+import numpy as np
+
+from trafficgraphnn.load_data import disjoint_union_batch
+
+
+def test_disjoint_union_batch_offsets_edges_and_pads_time():
+    pad_scalars = (False, [0., -1.], [-1.])
+    A_0 = np.array([[[0, 1], [0, 0]]])
+    A_1 = np.array([[[0, 0, 0], [1, 0, 0], [0, 1, 0]]])
+    sample_0 = (A_0, np.ones((3, 2, 2)), np.ones((3, 2, 1)))
+    sample_1 = (A_1[np.newaxis], np.zeros((2, 3, 2)), np.zeros((2, 3, 1)))
+
+    X, Y, edges, lane_to_sample = disjoint_union_batch(
+        [sample_0, None, sample_1], pad_scalars)
+
+    assert X.shape == (1, 3, 5, 2)
+    assert Y.shape == (1, 3, 5, 1)
+    np.testing.assert_array_equal(edges, [[0, 0, 1], [0, 3, 2], [0, 4, 3]])
+    np.testing.assert_array_equal(lane_to_sample, [0, 0, 2, 2, 2])
+    # the shorter sample is padded in time with each feature's pad value
+    np.testing.assert_array_equal(X[0, 2, 2:], [[0., -1.]] * 3)
+    np.testing.assert_array_equal(Y[0, 2, 2:, 0], [-1.] * 3)
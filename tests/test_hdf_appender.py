@@ -0,0 +1,29 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from trafficgraphnn.utils import AsyncHDFAppender
+
+
+def _frame(begin, num_rows):
+    index = np.arange(begin, begin + num_rows)
+    return pd.DataFrame({'value': index * .5}, index=index)
+
+
+def test_rows_are_flushed_when_the_body_raises():
+    frames = [_frame(0, 3), _frame(3, 4), _frame(7, 2)]
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'results.h5')
+        with pytest.raises(ValueError, match='in the body'):
+            # nothing reaches max_rows or max_wait before the error
+            with AsyncHDFAppender(filename, 'df', max_rows=1000,
+                                  max_wait=60.) as appender:
+                for df in frames:
+                    appender.append(df)
+                raise ValueError('in the body')
+
+        pd.testing.assert_frame_equal(pd.read_hdf(filename, 'df'),
+                                      pd.concat(frames))
@@ -0,0 +1,41 @@
+import json
+import os
+import subprocess
+import sys
+
+# Seconds allowed for a fresh interpreter to import the preprocessing
+# package. Override with TRAFFICGRAPHNN_IMPORT_BUDGET on slow machines.
+IMPORT_TIME_BUDGET = float(
+    os.environ.get('TRAFFICGRAPHNN_IMPORT_BUDGET', 3.))
+
+HEAVY_MODULES = ['tensorflow', 'keras', 'traci', 'matplotlib']
+
+_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import trafficgraphnn.preprocessing.preprocess
+import trafficgraphnn.preprocessing.io
+import trafficgraphnn.load_data
+elapsed = time.perf_counter() - t0
+loaded = sorted({name.split('.')[0] for name in sys.modules})
+print(json.dumps({'elapsed': elapsed, 'loaded': loaded}))
+"""
+
+
+def _import_in_fresh_interpreter():
+    out = subprocess.check_output([sys.executable, '-c', _SCRIPT],
+                                  universal_newlines=True)
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def test_preprocessing_does_not_import_heavy_modules():
+    result = _import_in_fresh_interpreter()
+    heavy = [name for name in HEAVY_MODULES if name in result['loaded']]
+    assert heavy == [], 'preprocessing imported {}'.format(heavy)
+
+
+def test_preprocessing_import_time_budget():
+    result = _import_in_fresh_interpreter()
+    assert result['elapsed'] < IMPORT_TIME_BUDGET, (
+        'Importing preprocessing took {:.2f} s, budget is {:.2f} s'.format(
+            result['elapsed'], IMPORT_TIME_BUDGET))
@@ -0,0 +1,30 @@
+import numpy as np
+
+from trafficgraphnn.preprocessing import preprocess
+from trafficgraphnn.preprocessing.time_grid import TimeGrid
+
+
+def test_assemble_lane_arrays_fill_and_clip():
+    nan = np.nan
+    lane_arrays = [
+        (TimeGrid(0., 1., 3), ['green', 'occupancy'],
+         np.array([[1, 5], [nan, 6], [0, 7]], dtype=np.float32)),
+        (TimeGrid(1., 1., 3), ['occupancy', 'green'],
+         np.array([[2, 1], [nan, nan], [nan, nan]], dtype=np.float32)),
+    ]
+    grid = TimeGrid.union([lane_grid for lane_grid, _, _ in lane_arrays])
+    assert grid == TimeGrid(0., 1., 4)
+    columns, data = preprocess._assemble_lane_arrays(lane_arrays, grid)
+    assert columns == ['green', 'occupancy']
+    assert data.shape == (2, 4, 2)
+    np.testing.assert_array_equal(data[1, :, 1], [nan, 2, nan, nan])
+
+    green = data[:, :, 0]
+    preprocess._ffill_time_axis(green)
+    np.testing.assert_array_equal(green, [[1, 1, 0, 0], [nan, 1, 1, 1]])
+
+    preprocess._fill_pad_values(data, columns)
+    pad = preprocess.pad_value_for_feature['occupancy']
+    np.testing.assert_array_equal(data[0, :, 1], [5, 6, 7, pad])
+    # last timestep is padding in every lane
+    assert preprocess._last_nonpad_timestep_index(data, columns) == 2
@@ -0,0 +1,125 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+from trafficgraphnn.lane_index import LaneIndex
+
+
+class _Lane(object):
+    def __init__(self, lane_id, index):
+        self.lane_id = lane_id
+        self.index = index
+
+    def getID(self):
+        return self.lane_id
+
+    def getIndex(self):
+        return self.index
+
+
+class _Edge(object):
+    def __init__(self, edge_id, num_lanes):
+        self.edge_id = edge_id
+        # out of index order on purpose
+        self.lanes = [_Lane('{}_{}'.format(edge_id, i), i)
+                      for i in reversed(range(num_lanes))]
+
+    def getID(self):
+        return self.edge_id
+
+    def getLanes(self):
+        return self.lanes
+
+
+class _Net(object):
+    def __init__(self, edges):
+        self.edges = edges
+
+    def getEdges(self):
+        return self.edges
+
+
+@pytest.fixture()
+def index():
+    net = _Net([_Edge('a', 2), _Edge('b', 2), _Edge('c', 1)])
+    graph = nx.DiGraph()
+    graph.add_edge('a_0', 'c_0', direction='r', tls='t')
+    graph.add_edge('a_1', 'b_1', direction='s', tls='t')
+    graph.add_edge('a_1', 'b_0', direction='s', tls='t')
+    graph.add_edge('b_0', 'c_0', direction='l', tls='')
+    graph.add_node('a_0', detectors={'e1_a_0': {'type': 'e1Detector',
+                                                'pos': '-5'}})
+    graph.add_node('c_0', detectors={'e2_c_0': {'type': 'e2Detector',
+                                                'pos': '0'}})
+    graph.add_node('b_1', detectors={})
+    return LaneIndex.from_net_and_graph(net, graph)
+
+
+def test_lane_order(index):
+    assert index.lane_ids.tolist() == ['a_0', 'a_1', 'b_0', 'b_1', 'c_0']
+    assert index.lanes_of_edge('b') == ['b_0', 'b_1']
+    assert index.neighboring_lanes('a_0') == ['a_1']
+    assert index.neighboring_lanes('c_0', include_input_lane=True) == ['c_0']
+    # a lane with an empty detectors dict counts, as with the graph
+    assert index.lanes_with_detectors() == ['a_0', 'b_1', 'c_0']
+    assert index.detector_to_lane() == {'e1_a_0': 'a_0', 'e2_c_0': 'c_0'}
+
+
+def test_adjacency(index):
+    lanes = ['c_0', 'a_0', 'a_1', 'b_0']
+    A = index.adjacency(lanes).toarray()
+    expected = np.zeros((4, 4), dtype=bool)
+    expected[1, 0] = True # a_0 -> c_0
+    expected[2, 3] = True # a_1 -> b_0
+    expected[3, 0] = True # b_0 -> c_0
+    np.testing.assert_array_equal(A, expected)
+    np.testing.assert_array_equal(
+        index.adjacency(lanes, reverse=True).toarray(), expected.T)
+
+    turns = index.adjacency(lanes, directions=['l', 'r']).toarray()
+    np.testing.assert_array_equal(turns, expected & [[0, 0, 0, 0],
+                                                     [1, 0, 0, 0],
+                                                     [0, 0, 0, 0],
+                                                     [1, 0, 0, 0]])
+    assert index.tls_ids == ['t']
+    assert sorted(index.conn_tls.tolist()) == [-1, 0, 0, 0]
+
+
+def test_neighbor_adjacency(index):
+    A = index.neighbor_adjacency(include_self_adjacency=False).toarray()
+    expected = np.zeros((5, 5), dtype=bool)
+    expected[0, 1] = expected[1, 0] = True
+    expected[2, 3] = expected[3, 2] = True
+    np.testing.assert_array_equal(A, expected)
+
+    A_self = index.neighbor_adjacency().toarray()
+    np.testing.assert_array_equal(A_self, expected | np.eye(5, dtype=bool))
+
+
+class _Network(object):
+    def __init__(self, index, undirected_graph):
+        self.lane_index = index
+        self.undirected_graph = undirected_graph
+
+    def lanes_with_detectors(self):
+        return self.lane_index.lanes_with_detectors()
+
+
+@pytest.mark.parametrize('undirected_graph', [False, True])
+def test_A_matrices_follow_graph_directedness(index, undirected_graph):
+    from trafficgraphnn.preprocessing.preprocess import \
+        build_A_matrices_for_lanes
+
+    lanes = ['c_0', 'a_0', 'a_1', 'b_0']
+    A_matrices = build_A_matrices_for_lanes(
+        _Network(index, undirected_graph), lanes)
+    directed = index.adjacency(lanes).toarray()
+    expected = directed | directed.T if undirected_graph else directed
+
+    np.testing.assert_array_equal(
+        A_matrices['A_downstream'].toarray(), expected)
+    np.testing.assert_array_equal(
+        A_matrices['A_upstream'].toarray(), expected.T)
+    for name in ['A_turn_movements', 'A_through_movements']:
+        A = A_matrices[name].toarray()
+        assert (A == A.T).all() or not undirected_graph
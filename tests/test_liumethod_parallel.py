@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from trafficgraphnn.liumethod import LiuEtAlRunner, _sumo_network_init_kwargs
+from trafficgraphnn.sumo_network import SumoNetwork
+
+
+def _read_results(runner):
+    return pd.read_hdf(runner._results_filename(), 'df_estimation_results')
+
+
+def test_network_kwargs_keep_output_dir(run_network):
+    kwargs = _sumo_network_init_kwargs(run_network)
+    assert SumoNetwork(**kwargs).output_dir == run_network.output_dir
+
+
+def test_parallel_matches_serial(run_network):
+    serial = LiuEtAlRunner(run_network, sim_num=0)
+    max_num_phase = serial.get_max_num_phase()
+    assert max_num_phase > 1
+    serial.run_up_to_phase(max_num_phase)
+
+    parallel = LiuEtAlRunner(run_network, sim_num=1, num_workers=2,
+                             write_buffer_rows=1)
+    assert parallel.parallel
+    parallel.run_up_to_phase(max_num_phase)
+
+    pd.testing.assert_frame_equal(_read_results(serial),
+                                  _read_results(parallel))
+    for lane_id, lane in serial.liu_lanes.items():
+        serial_state = lane.get_results_state()
+        parallel_state = parallel.liu_lanes[lane_id].get_results_state()
+        assert serial_state.keys() == parallel_state.keys()
+        for key in serial_state:
+            # some entries are scalars
+            np.testing.assert_equal(serial_state[key], parallel_state[key])
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from trafficgraphnn.preprocessing.liumethod_new import (
+    _estimate_method_columns, lane_inputs_from_periods, liu_estimates_for_lane,
+    liu_method_for_net, liu_sweep_estimates_for_lane, liu_sweep_for_net,
+    queue_estimate)
+
+INTER_DETECTOR_DISTANCE = 120.
+JAM_DENSITIES = [.02, .05, .13333, .2]
+
+
+@pytest.fixture()
+def lane_periods():
+    """Three queueing periods of synthetic detector data, estimated with the
+    input-output, saturated and liu methods"""
+    random_state = np.random.RandomState(0)
+    index = np.arange(90)
+    stopbar = pd.DataFrame(
+        {'nVehContrib': random_state.randint(2, size=90).astype(float)},
+        index=index)
+    advance = pd.DataFrame(
+        {'nVehContrib': random_state.randint(2, size=90).astype(float)},
+        index=index)
+    intervals = [(0, 29), (30, 59), (60, 89)]
+    stopbar_periods = [stopbar.loc[b:e] for b, e in intervals]
+    advance_periods = [advance.loc[b:e] for b, e in intervals]
+    green_times = [20, 50, 80]
+    breakpoints_A = [None, 42, 72]
+    breakpoints_B = [None, 54, 84]
+    breakpoints_C = [None, None, 87]
+    return (stopbar_periods, advance_periods, green_times, breakpoints_A,
+            breakpoints_B, breakpoints_C)
+
+
+def test_queue_estimate(lane_periods):
+    stopbar, advance = lane_periods[:2]
+    lane_inputs = lane_inputs_from_periods(*lane_periods)
+    jam_density = .13333
+
+    # the first period has no breakpoint A
+    (t, estimate, method), = queue_estimate(lane_inputs, 0, 2.,
+                                            INTER_DETECTOR_DISTANCE,
+                                            jam_density)
+    assert (t, method) == (29, 'input-output')
+    assert estimate == (2. + advance[0]['nVehContrib'].sum()
+                        - stopbar[0]['nVehContrib'].sum())
+
+    # the second has no breakpoint C
+    (t, estimate, method), = queue_estimate(lane_inputs, 1, 0.,
+                                            INTER_DETECTOR_DISTANCE,
+                                            jam_density)
+    assert (t, method) == (59, 'saturated')
+    assert estimate == pytest.approx(INTER_DETECTOR_DISTANCE * jam_density)
+
+    # the third has breakpoints B at 84 and C at 87, with green at 80
+    (t_max, max_queue, method), (t_end, end_queue, _) = queue_estimate(
+        lane_inputs, 2, 0., INTER_DETECTOR_DISTANCE, jam_density)
+    assert method == 'liu'
+    assert max_queue == pytest.approx(
+        advance[2].loc[:87, 'nVehContrib'].sum()
+        + INTER_DETECTOR_DISTANCE * jam_density)
+    v2 = INTER_DETECTOR_DISTANCE / (84 - 80)
+    assert t_max == np.round(80 + max_queue / jam_density / v2)
+    assert t_end == 89
+    if t_end > t_max:
+        assert end_queue == pytest.approx(
+            max_queue - stopbar[2].loc[int(t_max):, 'nVehContrib'].sum()
+            + advance[2].loc[87:, 'nVehContrib'].sum())
+    else:
+        assert np.isnan(end_queue)
+
+
+def test_sweep_matches_single_jam_densities(lane_periods):
+    lane_inputs = lane_inputs_from_periods(*lane_periods)
+    results = liu_sweep_estimates_for_lane(
+        lane_inputs, 'lane', INTER_DETECTOR_DISTANCE, JAM_DENSITIES)
+
+    assert len(results) == len(JAM_DENSITIES)
+    methods = set()
+    for jam_density, result in zip(JAM_DENSITIES, results):
+        expected = liu_estimates_for_lane(
+            lane_inputs, 'lane', INTER_DETECTOR_DISTANCE, jam_density)
+        pd.testing.assert_frame_equal(result, expected)
+        methods.update(result['lane_method'])
+    assert len(methods) == 3
+    # whether the max queue is before the end of the phase depends on the
+    # jam density
+    assert len(set(len(result) for result in results)) > 1
+
+
+def test_sweep_cube_matches_separate_runs(run_network, raw_xml_file):
+    jam_densities = [.1, .13333]
+    cube = liu_sweep_for_net(run_network, raw_xml_file,
+                             jam_densities=jam_densities,
+                             lane_change_heuristic_settings=(True, False))
+
+    for jam_density in jam_densities:
+        for use_heuristic in [True, False]:
+            results = liu_method_for_net(
+                run_network, raw_xml_file, jam_density=jam_density,
+                use_lane_change_accounting_heuristic=use_heuristic)
+            expected = pd.concat([_estimate_method_columns(lane_id, df)
+                                  for lane_id, df in results.items()],
+                                 axis=1)
+            pd.testing.assert_frame_equal(cube[(jam_density, use_heuristic)],
+                                          expected, check_names=False)
@@ -0,0 +1,111 @@
+import os
+import tempfile
+
+import pytest
+
+from trafficgraphnn.preprocessing.manifest import DatasetManifest, make_entry
+from trafficgraphnn.preprocessing.time_grid import TimeGrid
+
+
+def _add_file(manifest, number):
+    filename = os.path.join(manifest.directory, '{:04}.h5'.format(number))
+    with open(filename, 'wb') as f:
+        f.write(b'0' * number)
+    manifest.add(filename, make_entry(filename, 10, TimeGrid(0., 1., 100),
+                                      ['occupancy'], ['nVehSeen'], 'abc'))
+
+
+def test_numbering_and_persistence():
+    with tempfile.TemporaryDirectory() as path:
+        with DatasetManifest.locked(path) as manifest:
+            assert manifest.reserve_file_numbers(2) == [1, 2]
+        with DatasetManifest.locked(path) as manifest:
+            assert manifest.reserved == {1, 2}
+            _add_file(manifest, 1)
+            assert manifest.next_file_number() == 3
+
+        manifest = DatasetManifest.load(path)
+        assert manifest.reserved == {2}
+        entry = manifest.entry(os.path.join(path, '0001.h5'))
+        assert entry['lanes'] == 10 and entry['timesteps'] == 100
+        assert entry['bytes'] == 1
+        # unchanged files are not reopened
+        assert not manifest.sync()
+
+
+def test_assigned_splits_are_stable():
+    with tempfile.TemporaryDirectory() as path:
+        manifest = DatasetManifest(path)
+        for number in range(1, 11):
+            _add_file(manifest, number)
+        manifest.assign_splits(.2, .1)
+        assert [os.path.basename(f) for f in manifest.filenames('test')] \
+            == ['0010.h5']
+        assert len(manifest.filenames('val')) == 2
+        first_splits = {name: entry['split']
+                        for name, entry in manifest.entries.items()}
+
+        for number in range(11, 21):
+            _add_file(manifest, number)
+        manifest.assign_splits(.2, .1)
+        assert all(manifest.entries[name]['split'] == split
+                   for name, split in first_splits.items())
+        assert len(manifest.filenames('val')) == 4
+        assert len(manifest.filenames('test')) == 2
+
+
+def test_release_file_numbers():
+    with tempfile.TemporaryDirectory() as path:
+        with DatasetManifest.locked(path) as manifest:
+            assert manifest.reserve_file_numbers(3) == [1, 2, 3]
+        with DatasetManifest.locked(path) as manifest:
+            manifest.release_file_numbers([2, 3])
+        manifest = DatasetManifest.load(path)
+        assert manifest.reserved == {1}
+        assert manifest.next_file_number() == 2
+
+
+def _saved_manifest(path, numbers):
+    with DatasetManifest.locked(path) as manifest:
+        for number in numbers:
+            _add_file(manifest, number)
+        manifest.assign_splits(.1, .1)
+    return manifest
+
+
+def test_listed_files_split_over_listed_set():
+    from trafficgraphnn.load_data_tf import files_from_manifests
+
+    with tempfile.TemporaryDirectory() as path:
+        _saved_manifest(path, range(1, 21))
+        listed = [os.path.join(path, '{:04}.h5'.format(number))
+                  for number in range(1, 11)]
+
+        file_info = files_from_manifests(listed, val_proportion=.2,
+                                         test_proportion=.1)
+        assert sorted(file_info) == sorted(listed)
+        splits = [file_info[f]['split'] for f in sorted(listed)]
+        assert splits == ['train'] * 7 + ['val'] * 2 + ['test']
+
+        # the directory's own splits are over all of its files
+        file_info = files_from_manifests(path)
+        assert len(file_info) == 20
+        assert sum(entry['split'] == 'test'
+                   for entry in file_info.values()) == 2
+
+
+def test_manifest_of_read_only_directory():
+    from trafficgraphnn.load_data_tf import files_from_manifests
+
+    with tempfile.TemporaryDirectory() as path:
+        _saved_manifest(path, range(1, 11))
+        mtime = os.path.getmtime(os.path.join(path, 'manifest.json'))
+        os.chmod(path, 0o555)
+        try:
+            if os.access(path, os.W_OK):
+                pytest.skip('permissions are not enforced for this user')
+            file_info = files_from_manifests(path)
+        finally:
+            os.chmod(path, 0o755)
+        assert len(file_info) == 10
+        assert os.path.getmtime(os.path.join(path, 'manifest.json')) == mtime
@@ -0,0 +1,40 @@
+import networkx as nx
+
+from trafficgraphnn.preprocessing.pool import (NetworkState,
+                                               PreprocessingPool,
+                                               worker_network_state)
+
+
+class _Network(object):
+    def __init__(self, output_file):
+        self.netfile = 'test.net.xml'
+        self.graph = nx.DiGraph()
+        self.graph.add_node('a_0', detectors={
+            'e1_a_0_0': {'id': 'e1_a_0_0', 'type': 'e1Detector', 'pos': '-5',
+                         'file': output_file}})
+        self.graph.add_node('b_0')
+
+    def lanes_with_detectors(self):
+        return ['a_0']
+
+
+def _detector_ids(lane):
+    return sorted(worker_network_state().lane_detectors[lane])
+
+
+def test_network_state_ignores_output_files():
+    state = NetworkState.from_sumo_network(_Network('run1/e1.xml'))
+    assert state.key == NetworkState.from_sumo_network(
+        _Network('run2/e1.xml')).key
+    assert 'file' not in state.lane_detectors['a_0']['e1_a_0_0']
+
+
+def test_workers_get_network_state():
+    with PreprocessingPool(2) as pool:
+        pool.set_network(_Network('run1/e1.xml'))
+        first_pool = pool.pool
+        assert pool.map(_detector_ids, ['a_0', 'a_0']) == [['e1_a_0_0']] * 2
+
+        # another run of the same network reuses the workers
+        pool.set_network(_Network('run2/e1.xml'))
+        assert pool.pool is first_pool
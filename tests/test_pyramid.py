@@ -0,0 +1,120 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+from trafficgraphnn.load_data import (_pyramid_level_length, read_from_file,
+                                      x_feature_subset_default,
+                                      y_feature_subset_default)
+from trafficgraphnn.preprocessing.features import per_cycle_features_default
+from trafficgraphnn.preprocessing.io import copy_preprocessed_file
+from trafficgraphnn.preprocessing.pyramid import (downsample_time_axis,
+                                                  level_grid, level_info,
+                                                  level_matches)
+from trafficgraphnn.preprocessing.time_grid import TimeGrid, get_storer_grid
+
+
+def test_downsample_time_axis_pads_last_block():
+    data = np.arange(10, dtype=np.float32).reshape(1, 5, 2)
+    features = ['e1_0/occupancy', 'e2_0/maxJamLengthInVehicles']
+    out = downsample_time_axis(data, 2, features,
+                               ['e2_0/maxJamLengthInVehicles'])
+    assert out.shape == (1, 3, 2)
+    # mean of the last block includes the occupancy pad value 0
+    np.testing.assert_allclose(out[0, :, 0], [1, 5, 4])
+    np.testing.assert_allclose(out[0, :, 1], [3, 7, 9])
+    assert level_grid(TimeGrid(0., 1., 5), 2) == TimeGrid(0., 2., 3)
+
+
+def test_level_matches_per_cycle_settings():
+    per_cycle = ['e2_0/maxJamLengthInVehicles']
+    info = level_info(10, per_cycle, 'end', masked=True)
+    x = ['e1_0/occupancy', 'green']
+    assert level_matches(info, x, per_cycle, per_cycle, 'end')
+    assert not level_matches(info, x, per_cycle, per_cycle, 'begin')
+    # without green the loader would not mask
+    assert not level_matches(info, ['e1_0/occupancy'], per_cycle, per_cycle,
+                             'end')
+    # the feature would be averaged instead of maxed
+    assert not level_matches(info, x, per_cycle, [], 'end')
+
+
+def _copy_without_levels(filename, path):
+    """Copy of a preprocessed file with its averaged levels removed"""
+    import pandas as pd
+
+    copy = copy_preprocessed_file(filename, path)
+    with pd.HDFStore(copy) as store:
+        for key in store.keys():
+            if '_avg' in key:
+                store.remove(key)
+    return copy
+
+
+def _level_length(filename, interval, max_time, when_per_cycle):
+    import pandas as pd
+
+    with pd.HDFStore(filename, 'r') as store:
+        return _pyramid_level_length(
+            store, interval, max_time, x_feature_subset_default,
+            y_feature_subset_default, per_cycle_features_default,
+            when_per_cycle)
+
+
+def _assert_level_matches_averaging(filename, interval, max_time,
+                                    when_per_cycle, uses_level):
+    assert (_level_length(filename, interval, max_time, when_per_cycle)
+            is not None) == uses_level
+    with tempfile.TemporaryDirectory() as path:
+        full = _copy_without_levels(filename, path)
+        assert _level_length(full, interval, max_time, when_per_cycle) is None
+        for stored, averaged in zip(
+                read_from_file(filename, max_time=max_time,
+                               when_per_cycle=when_per_cycle,
+                               average_interval=interval,
+                               return_t_and_lanenames=True),
+                read_from_file(full, max_time=max_time,
+                               when_per_cycle=when_per_cycle,
+                               average_interval=interval,
+                               return_t_and_lanenames=True)):
+            np.testing.assert_array_equal(stored, averaged)
+
+
+def _time_of_step(filename, num_timesteps):
+    """max_time that keeps the first `num_timesteps` rows of the file"""
+    import pandas as pd
+
+    with pd.HDFStore(filename, 'r') as store:
+        grid = get_storer_grid(store, 'X')
+    return grid.t0 + (num_timesteps - 1) * grid.freq
+
+
+@pytest.mark.parametrize('interval,num_timesteps,uses_level', [
+    (5, None, True),
+    (10, None, True),
+    # max_time on a block boundary reads the first rows of the level
+    (10, 300, True),
+    # max_time through a block averages the full resolution
+    (5, 303, False),
+])
+def test_stored_level_matches_averaging(preprocessed_file, interval,
+                                        num_timesteps, uses_level):
+    max_time = None if num_timesteps is None \
+        else _time_of_step(preprocessed_file, num_timesteps)
+    _assert_level_matches_averaging(preprocessed_file, interval, max_time,
+                                    'end', uses_level)
+
+
+def test_stored_begin_level_matches_averaging(run_network, raw_xml_file):
+    from trafficgraphnn.preprocessing.preprocess import write_per_lane_tables
+
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, '0001.h5')
+        write_per_lane_tables(filename, run_network, raw_xml_file,
+                              update_manifest=False, pyramid_intervals=[5],
+                              when_per_cycle='begin')
+        _assert_level_matches_averaging(filename, 5, None, 'begin', True)
+        # cycles ending after max_time could put values into the level
+        _assert_level_matches_averaging(
+            filename, 5, _time_of_step(filename, 300), 'begin', False)
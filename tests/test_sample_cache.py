@@ -0,0 +1,45 @@
+import numpy as np
+
+from trafficgraphnn.sample_cache import SampleCache
+
+
+def _touch(path):
+    path.write_text('x')
+    return str(path)
+
+
+def test_sample_cache_lru_eviction(tmp_path):
+    files = [_touch(tmp_path / 'sim_{}.h5'.format(i)) for i in range(3)]
+    loads = []
+
+    def load(filename):
+        loads.append(filename)
+        return (np.zeros(10, dtype=np.float32),) # 40 bytes
+
+    cache = SampleCache(max_bytes=100)
+    for filename in files:
+        cache.get_or_load(filename, {}, load)
+    assert len(cache) == 2
+    assert cache.evictions == 1
+
+    cache.get_or_load(files[2], {}, load)
+    assert cache.hits == 1
+    cache.get_or_load(files[0], {'max_time': 10}, load)
+    assert loads == files + [files[0]]
+
+
+def test_sample_cache_snapshot(tmp_path):
+    filename = _touch(tmp_path / 'sim_1.h5')
+    sample = (np.arange(6, dtype=np.float32).reshape(2, 3),
+              np.array([b'lane_0', b'lane_1']))
+
+    SampleCache(max_bytes=0, snapshot_dir=str(tmp_path / 'cache')) \
+        .get_or_load(filename, {}, lambda f: sample)
+
+    def fail(filename):
+        raise AssertionError('should be read from the snapshot')
+
+    cache = SampleCache(snapshot_dir=str(tmp_path / 'cache'))
+    loaded = cache.get_or_load(filename, {}, fail)
+    np.testing.assert_array_equal(loaded[0], sample[0])
+    np.testing.assert_array_equal(loaded[1], sample[1])
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('attn_heads_reduction', ['concat', 'average'])
+@pytest.mark.parametrize('highway_connection', [False, True])
+def test_matches_dense_layer(attn_heads_reduction, highway_connection):
+    from keras import backend as K
+    from trafficgraphnn.layers import (BatchMultigraphAttention,
+                                       SegmentMultigraphAttention)
+
+    random_state = np.random.RandomState(0)
+    num_nodes, num_edge_types, num_features = 6, 2, 4
+    X = random_state.normal(size=(1, num_nodes, num_features))
+    A = random_state.uniform(size=(1, num_edge_types, num_nodes,
+                                   num_nodes)) < .3
+    # every node has edges of every type
+    A[:, :, np.arange(num_nodes), np.arange(num_nodes)] = True
+    edges = np.argwhere(A[0]).astype(np.int32)
+
+    kwargs = dict(attn_heads=2, attn_heads_reduction=attn_heads_reduction,
+                  highway_connection=highway_connection, attn_dropout=0.,
+                  bias_initializer='glorot_uniform')
+    dense = BatchMultigraphAttention(3, **kwargs)
+    segment = SegmentMultigraphAttention(3, num_edge_types, **kwargs)
+
+    dense_output = dense([K.constant(X), K.constant(A.astype(np.float32))])
+    segment_output = segment([K.constant(X), K.constant(edges, 'int32')])
+    segment.set_weights(dense.get_weights())
+
+    np.testing.assert_allclose(K.eval(segment_output), K.eval(dense_output),
+                               rtol=1e-5, atol=1e-6)
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from trafficgraphnn.simulation_farm import ProducerConsumerScheduler
+
+
+def test_scheduler_runs_all_stages():
+    scheduler = ProducerConsumerScheduler(
+        lambda x: x + 1,
+        [('double', lambda x: 2 * x), ('negate', lambda x: -x)],
+        num_producers=3)
+    outputs = scheduler.run(range(10))
+
+    assert sorted(outputs) == sorted(-2 * (x + 1) for x in range(10))
+    assert [stats.count for stats in scheduler.stats] == [10, 10, 10]
+    assert len(scheduler.format_stats()) == 3
+
+
+def test_scheduler_backpressure():
+    in_flight = []
+    max_in_flight = [0]
+    lock = threading.Lock()
+
+    def produce(x):
+        with lock:
+            in_flight.append(x)
+            max_in_flight[0] = max(max_in_flight[0], len(in_flight))
+        return x
+
+    def consume(x):
+        time.sleep(.01)
+        with lock:
+            in_flight.remove(x)
+        return x
+
+    scheduler = ProducerConsumerScheduler(
+        produce, [('consume', consume)], num_producers=2, max_queue_size=1)
+    scheduler.run(range(20))
+
+    # one item being consumed, one queued, one blocked per producer
+    assert max_in_flight[0] <= 1 + 1 + 2
+
+
+def test_scheduler_producer_error():
+    def produce(x):
+        if x == 3:
+            raise ValueError('bad item')
+        return x
+
+    scheduler = ProducerConsumerScheduler(produce, [('id', lambda x: x)])
+    with pytest.raises(RuntimeError):
+        scheduler.run(range(5))
+
+
+def test_scheduler_consumes_finished_products_on_producer_error():
+    def produce(x):
+        time.sleep(.1 if x == 0 else .3)
+        if x == 0:
+            raise ValueError('bad item')
+        return x
+
+    scheduler = ProducerConsumerScheduler(
+        produce, [('id', lambda x: x)], num_producers=2)
+    with pytest.raises(RuntimeError):
+        scheduler.run([0, 1, 2, 3])
+
+    # item 1 was in flight when item 0 failed, later items never started
+    assert scheduler.outputs == [1]
+    assert scheduler.unconsumed == []
+
+
+def test_scheduler_cancels_producers_on_consumer_error():
+    cancelled = threading.Event()
+
+    def produce(x):
+        if x > 0:
+            # a long-running producer that only returns when cancelled
+            assert cancelled.wait(timeout=30)
+        return x
+
+    def consume(x):
+        raise ValueError('bad product')
+
+    scheduler = ProducerConsumerScheduler(
+        produce, [('consume', consume)], num_producers=3,
+        cancel=cancelled.set, join_timeout=10)
+    t0 = time.time()
+    with pytest.raises(ValueError):
+        scheduler.run(range(3))
+
+    assert cancelled.is_set()
+    assert time.time() - t0 < 10
+    assert sorted(scheduler.unconsumed) == [1, 2]
+
+
+def test_scheduler_join_timeout():
+    def produce(x):
+        if x > 0:
+            time.sleep(5)
+        return x
+
+    def consume(x):
+        raise ValueError('bad product')
+
+    scheduler = ProducerConsumerScheduler(
+        produce, [('consume', consume)], num_producers=2, join_timeout=.5)
+    t0 = time.time()
+    with pytest.raises(ValueError):
+        scheduler.run(range(2))
+    assert time.time() - t0 < 4
@@ -0,0 +1,139 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+
+import pandas as pd
+import pytest
+
+from trafficgraphnn.preprocessing.io import detector_output_xml_to_df, read_raw_df
+from trafficgraphnn.preprocessing.stream import (StreamIngest,
+                                                 ingest_streams_to_hdf,
+                                                 make_fifos, remove_fifos,
+                                                 replay_xml_to_fifo)
+
+E1_XML = """<detector>
+""" + "".join(
+    '    <interval begin="{0}.00" end="{1}.00" id="e1_0" nVehContrib="{2}" '
+    'flow="{3}.00" occupancy="{4}.00" speed="{5}.00" length="5.00" '
+    'nVehEntered="{2}"/>\n'.format(t, t + 1, t % 3, 3600 * (t % 3), t % 7,
+                                    t % 13)
+    for t in range(500)) + "</detector>\n"
+
+
+@pytest.fixture()
+def recorded_xml():
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'recorded_e1_0.xml')
+        with open(filename, 'w') as f:
+            f.write(E1_XML)
+        yield filename
+
+
+def test_ingest_matches_file_parse(recorded_xml):
+    out_dir = os.path.dirname(recorded_xml)
+    fifo = os.path.join(out_dir, 'stream', 'net_e1_0.xml')
+    make_fifos([fifo])
+
+    writer = multiprocessing.Process(
+        target=replay_xml_to_fifo, args=(recorded_xml, fifo, 1024, .001))
+    writer.start()
+    hdf_filename = os.path.join(out_dir, 'raw_xml.hdf')
+    failed = ingest_streams_to_hdf([fifo], [], hdf_filename)
+    writer.join()
+    remove_fifos([fifo])
+
+    assert failed == []
+    expected = detector_output_xml_to_df(recorded_xml)['e1_0']
+    with pd.HDFStore(hdf_filename, 'r') as store:
+        streamed = read_raw_df(store, 'raw_xml/e1_0')
+    pd.testing.assert_frame_equal(streamed, expected)
+    assert not os.path.exists(fifo)
+
+
+# larger than a pipe buffer, so the writer blocks unless the pipe is drained
+BAD_XML = {
+    'unparseable': '<detector>\n<interval begin="0.00" <<<\n' + 'x' * 300000,
+    'unexpected': E1_XML.replace('speed="1.00"', 'speed="fast"')
+                  + '<!--' + 'x' * 300000 + '-->\n',
+}
+
+
+@pytest.mark.parametrize('kind', sorted(BAD_XML))
+def test_ingest_drains_failed_stream(kind):
+    with tempfile.TemporaryDirectory() as out_dir:
+        recorded = os.path.join(out_dir, 'recorded_e1_0.xml')
+        with open(recorded, 'w') as f:
+            f.write(BAD_XML[kind])
+        fifo = os.path.join(out_dir, 'stream', 'net_e1_0.xml')
+        make_fifos([fifo])
+
+        writer = multiprocessing.Process(
+            target=replay_xml_to_fifo, args=(recorded, fifo))
+        writer.start()
+        failed_event = multiprocessing.Event()
+        failed = ingest_streams_to_hdf(
+            [fifo], [], os.path.join(out_dir, 'raw_xml.hdf'),
+            failed_event=failed_event)
+        writer.join(30)
+        remove_fifos([fifo])
+
+        assert failed == [fifo]
+        assert failed_event.is_set()
+        assert writer.exitcode == 0
+
+
+def test_watchdog_kills_writer_on_failed_stream():
+    with tempfile.TemporaryDirectory() as out_dir:
+        addlfile = os.path.join(out_dir, 'net.add.xml')
+        with open(addlfile, 'w') as f:
+            f.write('<additional><e1Detector id="e1_0" lane="a_0" pos="1" '
+                    'freq="1" file="stream/net_e1_0.xml"/></additional>')
+        ingest = StreamIngest([addlfile], out_dir).start()
+        fifo, = ingest.paths
+        # stands in for a SUMO that keeps writing garbage
+        writer = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys\n'
+             'f = open(sys.argv[1], "wb")\n'
+             'while True:\n'
+             '    f.write(b"<<not xml>>" * 1000)\n'
+             '    f.flush()\n', fifo])
+        try:
+            with pytest.raises(RuntimeError):
+                ingest.wait_for_writer(writer, poll_interval=.1)
+        finally:
+            if writer.poll() is None:
+                writer.kill()
+            ingest.terminate()
+        assert writer.returncode != 0
+        assert not ingest.process.is_alive()
+        assert not os.path.exists(fifo)
+
+
+def test_failed_stream_raises_after_writer_exits():
+    with tempfile.TemporaryDirectory() as out_dir:
+        addlfile = os.path.join(out_dir, 'net.add.xml')
+        with open(addlfile, 'w') as f:
+            f.write('<additional><e1Detector id="e1_0" lane="a_0" pos="1" '
+                    'freq="1" file="stream/net_e1_0.xml"/></additional>')
+        ingest = StreamIngest([addlfile], out_dir).start()
+        fifo, = ingest.paths
+        # exits right after writing, usually before ingest notices the error
+        writer = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys\n'
+             'with open(sys.argv[1], "wb") as f:\n'
+             '    f.write(b"<<not xml>>" * 100000)\n', fifo])
+        try:
+            with pytest.raises(RuntimeError):
+                ingest.wait_for_writer(writer, poll_interval=5.)
+        finally:
+            if writer.poll() is None:
+                writer.kill()
+            ingest.terminate()
+        # the pipe kept a reader, so the writer finished its writes
+        assert writer.returncode == 0
+        assert not ingest.process.is_alive()
+        assert not os.path.exists(fifo)
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+
+from trafficgraphnn.load_data import (read_from_file, x_feature_subset_default,
+                                      y_feature_subset_default)
+from trafficgraphnn.preprocessing.io import copy_preprocessed_file
+
+
+def _parse_shard(shard, max_time=None):
+    import tensorflow as tf
+    from trafficgraphnn.tfrecords import parse_example
+
+    serialized = next(tf.python_io.tf_record_iterator(shard))
+    with tf.Graph().as_default(), tf.Session() as session:
+        return session.run(parse_example(
+            tf.constant(serialized), 3, len(x_feature_subset_default),
+            len(y_feature_subset_default), max_time=max_time))
+
+
+@pytest.mark.parametrize('max_time', [None, 300.])
+def test_parse_example_matches_read_from_file(preprocessed_file, max_time):
+    from trafficgraphnn.tfrecords import export_tfrecords
+
+    with tempfile.TemporaryDirectory() as path:
+        shard, = export_tfrecords([preprocessed_file], tfrecord_dir=path,
+                                  num_workers=1)
+        A, X, Y, t, lanes, filename = _parse_shard(shard, max_time)
+
+    A_file, X_file, Y_file, t_file, lanes_file = read_from_file(
+        preprocessed_file, max_time=max_time, return_t_and_lanenames=True)
+    if max_time is not None:
+        full_t = read_from_file(preprocessed_file,
+                                return_t_and_lanenames=True)[3]
+        assert len(t) < len(full_t)
+    np.testing.assert_array_equal(A, A_file.astype(bool))
+    np.testing.assert_array_equal(X, X_file)
+    np.testing.assert_array_equal(Y, Y_file)
+    np.testing.assert_array_equal(t, t_file)
+    assert [lane.decode() for lane in lanes] == list(lanes_file)
+    assert filename.decode() == preprocessed_file
+
+
+def test_export_reuses_up_to_date_shards(preprocessed_file):
+    from trafficgraphnn.tfrecords import export_tfrecords
+
+    with tempfile.TemporaryDirectory() as path:
+        # the copies share the adjacency file copied with the first one
+        filenames = [copy_preprocessed_file(preprocessed_file, path),
+                     os.path.join(path, '0002.h5')]
+        shutil.copy(filenames[0], filenames[1])
+
+        # more than one worker runs the export in spawned processes
+        shards = export_tfrecords(filenames, num_workers=2)
+        assert [os.path.dirname(shard) for shard in shards] \
+            == [os.path.join(path, 'tfrecord')] * 2
+        mtimes = [os.path.getmtime(shard) for shard in shards]
+
+        assert export_tfrecords(filenames, num_workers=2) == shards
+        assert [os.path.getmtime(shard) for shard in shards] == mtimes
+
+        # a newer .h5 file is exported again
+        os.utime(filenames[0], (mtimes[0] + 10, mtimes[0] + 10))
+        export_tfrecords(filenames, num_workers=1)
+        assert os.path.getmtime(shards[0]) > mtimes[0]
+        assert os.path.getmtime(shards[1]) == mtimes[1]
+
+        # different parameters get their own shards
+        other_shards = export_tfrecords(filenames, num_workers=1,
+                                        per_cycle_features=[])
+        assert set(other_shards).isdisjoint(shards)
+        assert all(os.path.exists(shard) for shard in other_shards)
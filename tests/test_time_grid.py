@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from trafficgraphnn.preprocessing.time_grid import TimeGrid
+
+
+def test_from_times_and_slicing():
+    grid = TimeGrid.from_times(np.arange(10., 60., 5.))
+    assert grid == TimeGrid(10., 5., 10)
+    assert grid.end == 55.
+    np.testing.assert_array_equal(grid.offsets([10., 25., 55.]), [0, 3, 9])
+
+    # same rows as .loc[20:40] on a begin index
+    assert grid.slice(20., 40.) == slice(2, 7)
+    assert grid.slice(21., 39.) == slice(3, 6)
+    assert grid.slice(None, 12.) == slice(0, 1)
+    assert grid.slice(100., None) == slice(10, 10)
+    assert grid.subgrid(2, 7) == TimeGrid(20., 5., 5)
+
+    with pytest.raises(ValueError):
+        TimeGrid.from_times([0., 1., 3.])
+
+
+def test_covering_and_union():
+    assert TimeGrid.covering([3., 0., 1.]) == TimeGrid(0., 1., 4)
+    assert TimeGrid.union([TimeGrid(2., 1., 3), TimeGrid(0., 1., 2),
+                           TimeGrid(0., 1., 0)]) == TimeGrid(0., 1., 5)
+    with pytest.raises(ValueError):
+        TimeGrid.union([TimeGrid(0., 1., 2), TimeGrid(0., 2., 2)])
+
+    grid = TimeGrid(0., .5, 4)
+    assert TimeGrid.from_dict(grid.to_dict()) == grid
@@ -0,0 +1,77 @@
+import os
+import pytest
+import tempfile
+
+from lxml import etree
+
+from trafficgraphnn.get_tls_data import get_tls_data
+from trafficgraphnn.sumo_output_reader import TLSTimingIndex
+
+
+TLS_SWITCH_XML = """<tlsSwitches>
+    <tlsSwitch id="0" programID="0" fromLane="a_0" toLane="b_0" begin="0.00" end="33.00" duration="33.00"/>
+    <tlsSwitch id="0" programID="0" fromLane="c_0" toLane="d_0" begin="36.00" end="69.00" duration="33.00"/>
+    <tlsSwitch id="0" programID="0" fromLane="a_0" toLane="b_0" begin="72.00" end="105.00" duration="33.00"/>
+    <tlsSwitch id="0" programID="0" fromLane="a_0" toLane="e_0" begin="105.00" end="108.00" duration="3.00"/>
+    <tlsSwitch id="0" programID="0" fromLane="c_0" toLane="d_0" begin="108.00" end="141.00" duration="33.00"/>
+    <tlsSwitch id="0" programID="0" fromLane="a_0" toLane="b_0" begin="144.00" end="177.00" duration="33.00"/>
+</tlsSwitches>
+"""
+
+
+@pytest.fixture()
+def tls_xml_file():
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'tls_output.xml')
+        with open(filename, 'w') as f:
+            f.write(TLS_SWITCH_XML)
+        yield filename
+
+
+def test_fixed_cycle_estimate_matches_get_tls_data(tls_xml_file):
+    index = TLSTimingIndex.from_xml_files(tls_xml_file)
+    parsed = etree.parse(tls_xml_file)
+
+    for lane_id in ['a_0', 'c_0']:
+        assert index.fixed_cycle_estimate(lane_id) == get_tls_data(
+            parsed, lane_id)
+
+
+def test_green_intervals_merged(tls_xml_file):
+    index = TLSTimingIndex.from_xml_files(tls_xml_file)
+
+    assert index.green_intervals('a_0') == [[0, 33], [72, 108], [144, 177]]
+    assert index.green_intervals('c_0') == [[36, 69], [108, 141]]
+
+
+def test_lane_subset(tls_xml_file):
+    index = TLSTimingIndex.from_xml_files(tls_xml_file, lane_subset={'c_0'})
+
+    assert 'a_0' not in index
+    assert index.lanes() == ['c_0']
+
+
+def test_light_timing_xml_files_to_phase_df(tls_xml_file):
+    from trafficgraphnn.preprocessing.io import (
+        light_timing_xml_files_to_phase_df, light_timing_xml_to_phase_df)
+
+    df = light_timing_xml_to_phase_df(tls_xml_file)
+    assert list(df.columns) == ['a_0', 'c_0']
+    assert df['a_0'].loc[0:32].all() and not df['a_0'].loc[33:71].any()
+    # back-to-back intervals of a lane merge into one green phase
+    assert df['a_0'].loc[72:107].all()
+    assert df['c_0'].loc[108:140].all() and not df['c_0'].loc[141:].any()
+
+    # a second file with another traffic light merges into the same table
+    other_file = os.path.join(os.path.dirname(tls_xml_file), 'other.xml')
+    with open(other_file, 'w') as f:
+        f.write('<tlsSwitches>\n'
+                '    <tlsSwitch id="1" programID="0" fromLane="x_0" '
+                'toLane="y_0" begin="10.00" end="20.00" duration="10.00"/>\n'
+                '</tlsSwitches>\n')
+    merged = light_timing_xml_files_to_phase_df([tls_xml_file, other_file],
+                                                num_workers=1)
+    assert list(merged.columns) == ['a_0', 'c_0', 'x_0']
+    assert len(merged) == len(df)
+    assert merged['x_0'].sum() == 10
+    assert (merged[['a_0', 'c_0']] == df).all().all()
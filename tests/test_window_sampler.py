@@ -0,0 +1,32 @@
+import numpy as np
+
+from trafficgraphnn.load_data import WindowSampler
+from trafficgraphnn.preprocessing.time_grid import TimeGrid
+
+
+def _sampler(window_size):
+    grid = TimeGrid(0., 1., 10)
+    X = np.arange(20, dtype=np.float32).reshape(10, 2, 1)
+    A = np.ones((3, 2, 2), dtype=bool)
+    return WindowSampler(A, X, X + 100, grid, ['lane_0', 'lane_1'],
+                         window_size)
+
+
+def test_sequential_windows_cover_the_file():
+    windows = list(_sampler(4).sequential())
+    np.testing.assert_array_equal([len(w[1]) for w in windows], [4, 4, 2])
+    np.testing.assert_array_equal(windows[1][3], [4, 5, 6, 7])
+    A, X, Y, _, lanes = windows[2]
+    assert A.shape == (2, 3, 2, 2)
+    np.testing.assert_array_equal(Y, X + 100)
+
+
+def test_random_windows_start_on_stride():
+    sampler = _sampler(4)
+    np.testing.assert_array_equal(sampler.start_offsets(3), [0, 3, 6])
+    windows = list(sampler.random(
+        5, stride=3, replace=False, random_state=np.random.RandomState(0)))
+    assert len(windows) == 3
+    assert sorted(w[3][0] for w in windows) == [0, 3, 6]
+    assert all(len(w[1]) == 4 for w in windows)
+    np.testing.assert_array_equal(sampler.at(2.)[3], [2, 3, 4, 5])
@@ -1,4 +1,5 @@
 from __future__ import absolute_import, print_function, division
+import importlib
 import logging
 import logging.handlers
 logging.handlers = logging.handlers
@@ -13,6 +14,31 @@ configfile = os.path.join(
     'logging.conf')
 fileConfig(configfile)
 
-from trafficgraphnn.sumo_network import SumoNetwork
-from trafficgraphnn.genconfig import ConfigGenerator
-from trafficgraphnn.liumethod import LiuEtAlRunner
+# Heavy modules (SUMO's traci, TensorFlow/Keras) are imported on first
+# attribute access, so worker processes that only import
+# trafficgraphnn.preprocessing don't pay for them.
+_lazy_attributes = {
+    'SumoNetwork': 'trafficgraphnn.sumo_network',
+    'ConfigGenerator': 'trafficgraphnn.genconfig',
+    'LiuEtAlRunner': 'trafficgraphnn.liumethod',
+}
+
+__all__ = list(_lazy_attributes)
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+        globals()[name] = value
+        return value
+    try:
+        return importlib.import_module('{}.{}'.format(__name__, name))
+    except ModuleNotFoundError as e:
+        if e.name != '{}.{}'.format(__name__, name):
+            raise
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,105 @@
+"""Ordering simulation files into batches of similar shape.
+
+Batches are padded to their largest lane count and time length, so mixing
+short and long simulations, or small and large networks, in a batch wastes
+most of its compute on padding. These functions group files by (lanes,
+timesteps) from their manifest entries, so batches are drawn from one
+group at a time, and measure how much of each batch is padding.
+"""
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+
+def effective_shape(entry, max_time=None, average_interval=None):
+    """(lanes, timesteps) of a file as the batcher will load it.
+
+    :param entry: The file's manifest entry
+    """
+    timesteps = entry['timesteps']
+    if max_time is not None:
+        timesteps = min(
+            timesteps,
+            int(np.floor((max_time - entry['t0']) / entry['freq'] + 1e-6)) + 1)
+        timesteps = max(timesteps, 0)
+    if average_interval is not None and average_interval > 1:
+        timesteps = int(np.ceil(timesteps / average_interval))
+    return entry['lanes'], timesteps
+
+
+def bucket_key(shape, lane_boundaries=None, time_boundaries=None):
+    """Bucket of a (lanes, timesteps) shape.
+
+    Boundaries are upper-exclusive bucket edges, as in
+    `tf.data.experimental.bucket_by_sequence_length`. Without boundaries,
+    each distinct value is its own bucket.
+    """
+    lanes, timesteps = shape
+    if lane_boundaries is not None:
+        lanes = int(np.searchsorted(lane_boundaries, lanes, side='right'))
+    if time_boundaries is not None:
+        timesteps = int(np.searchsorted(time_boundaries, timesteps,
+                                        side='right'))
+    return lanes, timesteps
+
+
+def bucketed_file_order(shapes, batch_size, lane_boundaries=None,
+                        time_boundaries=None, shuffle=True,
+                        random_state=np.random):
+    """Order files so each run of `batch_size` files shares a bucket.
+
+    Files are shuffled within their bucket and cut into batches. The batch
+    order is shuffled across buckets. The files left over from each bucket
+    are put in the last batches, sorted by size.
+
+    :param shapes: Dict of filename to (lanes, timesteps)
+    :return: List of filenames
+    """
+    buckets = OrderedDict()
+    for filename in sorted(shapes):
+        key = bucket_key(shapes[filename], lane_boundaries, time_boundaries)
+        buckets.setdefault(key, []).append(filename)
+
+    batches = []
+    leftovers = []
+    for files in buckets.values():
+        if shuffle:
+            random_state.shuffle(files)
+        num_full = len(files) // batch_size * batch_size
+        batches.extend(files[i:i + batch_size]
+                       for i in range(0, num_full, batch_size))
+        leftovers.extend(files[num_full:])
+
+    if shuffle:
+        random_state.shuffle(batches)
+    leftovers.sort(key=lambda f: (shapes[f], f))
+
+    order = [f for batch in batches for f in batch]
+    order.extend(leftovers)
+    return order
+
+
+def padding_efficiency(file_order, shapes, batch_size):
+    """Padding statistics of batching `file_order` in runs of `batch_size`.
+
+    :return: Dict with the fraction of lane-timesteps that are data rather
+    than padding ('efficiency'), the number of batches and the data and
+    padded lane-timestep counts
+    """
+    data = 0
+    padded = 0
+    num_batches = 0
+    for i in range(0, len(file_order), batch_size):
+        batch_shapes = np.array([shapes[f]
+                                 for f in file_order[i:i + batch_size]])
+        data += int(np.prod(batch_shapes, axis=1).sum())
+        padded += (len(batch_shapes) * int(batch_shapes[:, 0].max())
+                   * int(batch_shapes[:, 1].max()))
+        num_batches += 1
+    return {'efficiency': data / padded if padded > 0 else 1.,
+            'num_batches': num_batches,
+            'data_lane_timesteps': data,
+            'padded_lane_timesteps': padded}
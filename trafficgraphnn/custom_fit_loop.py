@@ -5,7 +5,8 @@ import os
 import re
 import time
 import warnings
-from collections import Iterable, defaultdict, namedtuple
+from collections import defaultdict, namedtuple
+from collections.abc import Iterable
 
 import numpy as np
 import pandas as pd
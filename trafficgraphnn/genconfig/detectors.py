@@ -4,9 +4,11 @@ import os
 import logging
 import six
 import collections
+import collections.abc
 
 import sumolib
 
+from trafficgraphnn.net_cache import read_net
 from trafficgraphnn.utils import iterfy, get_net_name, get_net_dir
 
 logger = logging.getLogger(__name__)
@@ -100,7 +102,7 @@ def generate_detector_set(netfile, detector_type, distance_to_tls,
     detectors_xml = sumolib.xml.create_document("additional")
     lanes_with_detectors = set()
 
-    net = sumolib.net.readNet(netfile)
+    net = read_net(netfile)
 
     for tls in net.getTrafficLights():
         for connection in tls.getConnections():
@@ -194,7 +196,7 @@ def generate_e2_detectors(netfile, distance_to_tls, detector_def_file=None,
         )
 
     if (len(detector_length) == 1
-            and isinstance(detector_length, collections.Iterable)
+            and isinstance(detector_length, collections.abc.Iterable)
             and type(detector_length) not in six.string_types):
         detector_length = detector_length * len(distance_to_tls)
 
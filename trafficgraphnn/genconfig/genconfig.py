@@ -10,6 +10,7 @@ import logging
 from sumolib import checkBinary
 import sumolib
 
+from trafficgraphnn.net_cache import read_net
 from trafficgraphnn.utils import get_net_dir, get_net_name
 from trafficgraphnn.genconfig import detectors, tls_config
 from trafficgraphnn.gendata import RandTripGeneratorWrapper
@@ -213,13 +214,15 @@ class ConfigGenerator(object):
         self,
         tls_subset=None,
         output_file_name=None,
-        addl_file_name='tls_output.add.xml'
+        addl_file_name='tls_output.add.xml',
+        per_tls_output_files=False,
     ):
         addl_file = define_tls_output_file(
             self.net_output_file, tls_subset=tls_subset,
             output_data_dir=self.output_data_dir,
             output_file_name=output_file_name,
-            config_dir=self.net_config_dir, addl_file_name=addl_file_name)
+            config_dir=self.net_config_dir, addl_file_name=addl_file_name,
+            per_tls_output_files=per_tls_output_files)
 
         if addl_file not in self.non_detector_addl_files:
             self.non_detector_addl_files.append(addl_file)
@@ -237,7 +240,14 @@ def define_tls_output_file(
     output_file_name=None,
     config_dir=None,
     addl_file_name='tls_output.add.xml',
+    per_tls_output_files=False,
 ):
+    """Write an additional file that saves tls switch times.
+
+    :param per_tls_output_files: If True, each traffic light writes to its
+    own output file, named after `output_file_name` with the tls id
+    appended, so the outputs can be parsed in parallel.
+    """
     if config_dir is None:
         config_dir = get_net_dir(netfile)
 
@@ -258,13 +268,20 @@ def define_tls_output_file(
 
     tls_addl = sumolib.xml.create_document('additional')
 
-    net = sumolib.net.readNet(netfile)
+    net = read_net(netfile)
 
     for tls in net.getTrafficLights():
+        if tls_subset is not None and tls.getID() not in tls_subset:
+            continue
+        if per_tls_output_files:
+            root, ext = os.path.splitext(relative_output_filename)
+            dest = '{}_{}{}'.format(root, tls.getID(), ext)
+        else:
+            dest = relative_output_filename
         tls_xml_element = tls_addl.addChild('timedEvent')
         tls_xml_element.setAttribute('type', 'SaveTLSSwitchTimes')
         tls_xml_element.setAttribute('source', tls.getID())
-        tls_xml_element.setAttribute('dest', relative_output_filename)
+        tls_xml_element.setAttribute('dest', dest)
 
     tls_addl_file_fid = open(os.path.realpath(addl_file), 'w')
     tls_addl_file_fid.write(tls_addl.toXML())
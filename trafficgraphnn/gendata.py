@@ -1,7 +1,10 @@
 import logging
 import os
 import sys
+import threading
 import six
+import networkx as nx
+import numpy as np
 from lxml import etree
 
 if six.PY2:
@@ -12,8 +15,8 @@ if six.PY2:
 else:
     import subprocess
 
-import sumolib
 
+from trafficgraphnn.net_cache import read_net
 from trafficgraphnn.utils import get_sumo_tools_dir, get_net_name, get_net_dir
 
 _logger = logging.getLogger(__name__)
@@ -56,29 +59,9 @@ class RandTripGeneratorWrapper(object):
             '{}_{}.routes.xml'.format(self.net_name, tag))
 
         if self.thru_only:
-            trip_weights_prefix = os.path.join(
-                self.net_dir, 'trip-weights-temp')
-            weight_file_args = [
-                sys.executable, pyfile,
-                '--net-file', self.netfile,
-                '--output-trip-file', tripfile,
-                '--weights-output-prefix', trip_weights_prefix
-            ]
-            if self.seed is not None:
-                weight_file_args.extend(['--seed', str(self.seed)])
-            _logger.debug('Calling %s', ' '.join(weight_file_args))
-            weight_file_proc = subprocess.Popen(weight_file_args,
-                                                stdout=subprocess.PIPE,
-                                                stderr=subprocess.STDOUT,
-                                                universal_newlines=True)
-            out, _ = weight_file_proc.communicate()
-            if out is not None and len(out) > 0:
-                _logger.debug('Returned %s', out)
-            set_non_fringe_weights_to_zero(
-                trip_weights_prefix, self.netfile)
+            trip_weights_prefix = fringe_weight_files(self.netfile)
 
         randtrip_args = [
-            sys.executable, pyfile,
             '--net-file', self.netfile,
             '--output-trip-file', tripfile,
             '--route-file', routefile,
@@ -97,22 +80,234 @@ class RandTripGeneratorWrapper(object):
         if self.seed is not None:
             randtrip_args.extend(['--seed', str(self.seed)])
 
-        _logger.debug('Calling %s', ' '.join(randtrip_args))
-        tripgenproc = subprocess.Popen(randtrip_args,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT,
-                                       universal_newlines=True)
-        out, _ = tripgenproc.communicate()
-        if out is not None and len(out) > 0:
-            _logger.debug('Returned %s', out)
+        run_random_trips(randtrip_args, pyfile)
         _logger.debug('Wrote random route file to %s', routefile)
 
         self.tripfile = tripfile
         self.routefile = routefile
         return routefile
 
+    def sample(self, tripfiles, seeds):
+        """Write one trip file per seed with the vectorized sampler.
+
+        Unlike `generate`, no route files are written: SUMO routes the
+        trips when it loads them. See `sample_trip_files` for how the trips
+        differ from randomTrips'.
+
+        :return: The trip filenames
+        :rtype: list
+        """
+        assert self.thru_only, 'Vectorized sampler only samples thru trips'
+        return sample_trip_files(
+            self.netfile, tripfiles, seeds, self.period, self.binomial,
+            self.start_time, self.end_time, self.trip_attrib)
+
+
+def run_random_trips(args, pyfile=None):
+    """Run SUMO's randomTrips.py with command line arguments `args`.
+
+    The tool is imported and run in this process when possible, which
+    avoids starting an interpreter per call. Falls back to a subprocess if
+    the tool's python interface is not the one expected.
+    """
+    try:
+        import randomTrips
+        options = randomTrips.get_options(args)
+    except (ImportError, AttributeError, SystemExit):
+        _logger.debug('Could not run randomTrips in-process', exc_info=True)
+    else:
+        _logger.debug('Running randomTrips in-process with %s',
+                      ' '.join(args))
+        with _random_trips_lock: # randomTrips seeds the global RNG
+            randomTrips.main(options)
+        return
+
+    if pyfile is None:
+        pyfile = os.path.join(get_sumo_tools_dir(), 'randomTrips.py')
+    args = [sys.executable, pyfile] + list(args)
+    _logger.debug('Calling %s', ' '.join(args))
+    proc = subprocess.Popen(args,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    out, _ = proc.communicate()
+    if out is not None and len(out) > 0:
+        _logger.debug('Returned %s', out)
+
+
+_random_trips_lock = threading.Lock()
+
+
+def fringe_weight_files(netfile, vclass='passenger'):
+    """Write (once) randomTrips weight files that only allow fringe edges.
+
+    Source weights are 1 for edges without incoming edges and sink weights
+    are 1 for edges without outgoing edges. The files are kept next to the
+    network file and rewritten only if the network file is newer.
+
+    :return: Weights prefix to pass to randomTrips' --weights-prefix
+    :rtype: str
+    """
+    prefix = os.path.join(get_net_dir(netfile),
+                          '{}_fringe-weights'.format(get_net_name(netfile)))
+    src_def_file = prefix + '.src.xml'
+    dst_def_file = prefix + '.dst.xml'
+    net_mtime = os.path.getmtime(netfile)
+    if all(os.path.exists(f) and os.path.getmtime(f) >= net_mtime
+           for f in [src_def_file, dst_def_file]):
+        return prefix
+
+    fringe = _fringe_edges(netfile, vclass)
+    _write_weight_file(src_def_file, 'src', fringe.edge_ids,
+                       fringe.is_source)
+    _write_weight_file(dst_def_file, 'dst', fringe.edge_ids, fringe.is_sink)
+    _logger.debug('Wrote fringe weight files with prefix %s', prefix)
+    return prefix
+
+
+def _write_weight_file(filename, interval_id, edge_ids, weights):
+    root = etree.Element('edgedata')
+    interval = etree.SubElement(root, 'interval', begin='0',
+                                end='1e9', id=interval_id)
+    for edge_id, weight in zip(edge_ids, weights):
+        etree.SubElement(interval, 'edge', id=edge_id,
+                         value='1.00' if weight else '0.00')
+    etree.ElementTree(root).write(filename, pretty_print=True)
+
+
+class _FringeEdges(object):
+    """Fringe sources and sinks of a network, and which sinks each source
+    can reach"""
+    def __init__(self, edge_ids, is_source, is_sink, reachable_pairs):
+        self.edge_ids = edge_ids
+        self.is_source = is_source
+        self.is_sink = is_sink
+        # (num_pairs, 2) array of (source, sink) indices into edge_ids
+        self.reachable_pairs = reachable_pairs
+
+
+_fringe_cache = {}
+
+
+def _fringe_edges(netfile, vclass='passenger'):
+    key = (os.path.realpath(netfile), os.path.getmtime(netfile), vclass)
+    if key in _fringe_cache:
+        return _fringe_cache[key]
+
+    net = read_net(netfile)
+    edges = [edge for edge in net.getEdges() if edge.allows(vclass)]
+    edge_ids = [edge.getID() for edge in edges]
+    index = {edge_id: i for i, edge_id in enumerate(edge_ids)}
+    is_source = np.array([edge.is_fringe(edge.getIncoming())
+                          for edge in edges], dtype=bool)
+    is_sink = np.array([edge.is_fringe(edge.getOutgoing())
+                        for edge in edges], dtype=bool)
+
+    graph = nx.DiGraph()
+    graph.add_nodes_from(range(len(edges)))
+    graph.add_edges_from((i, index[out_edge.getID()])
+                         for i, edge in enumerate(edges)
+                         for out_edge in edge.getOutgoing()
+                         if out_edge.getID() in index)
+
+    pairs = []
+    for source in np.flatnonzero(is_source):
+        reachable = np.fromiter(nx.descendants(graph, source), dtype=int)
+        reachable = reachable[is_sink[reachable]]
+        pairs.append(np.stack(
+            [np.full(len(reachable), source), np.sort(reachable)], axis=1))
+    pairs = np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=int)
+
+    fringe = _FringeEdges(edge_ids, is_source, is_sink, pairs)
+    _fringe_cache[key] = fringe
+    return fringe
+
+
+def sample_trip_files(netfile,
+                      tripfiles,
+                      seeds,
+                      period=1.,
+                      binomial=None,
+                      start_time=0,
+                      end_time=3600,
+                      trip_attrib=('departLane="best" departSpeed="max" '
+                                   'departPos="random_free" '
+                                   'speedFactor="normc(1,0.1,0.2,2)"'),
+                      vclass='passenger'):
+    """Sample random fringe-to-fringe trips for many seeds at once.
+
+    Draws trips the way randomTrips does with the fringe weight files of
+    `fringe_weight_files`: each trip's source and sink are drawn
+    independently and uniformly from the fringe sources and sinks. Trips
+    depart every `period` seconds, or, if `binomial` is set, each second
+    has Binomial(binomial, 1 / (period * binomial)) departures. The network
+    is read and its reachability computed once per process, not once per
+    file.
+
+    The distribution differs from randomTrips' output in two ways. Trips
+    whose sink is not reachable from their source are dropped (randomTrips
+    writes them, and only routing drops them), and no route files are
+    written, so SUMO routes the trips when it loads them. The random
+    streams differ too, so the same seed does not give the same trips as
+    randomTrips.
+
+    :param tripfiles: Output filename for each seed
+    :param seeds: Seeds, one per output file
+    :return: The trip filenames
+    :rtype: list
+    """
+    assert len(tripfiles) == len(seeds)
+    fringe = _fringe_edges(netfile, vclass)
+    if len(fringe.reachable_pairs) == 0:
+        raise ValueError(
+            'No fringe sink is reachable from a fringe source in '
+            '{}'.format(netfile))
+    edge_ids = np.array(fringe.edge_ids)
+    sources = np.flatnonzero(fringe.is_source)
+    sinks = np.flatnonzero(fringe.is_sink)
+    num_edges = len(edge_ids)
+    reachable_codes = (fringe.reachable_pairs[:, 0] * num_edges
+                       + fringe.reachable_pairs[:, 1])
+    attribs = dict(etree.fromstring(
+        '<trip {}/>'.format(trip_attrib)).attrib)
+
+    for tripfile, seed in zip(tripfiles, seeds):
+        random_state = np.random.RandomState(seed)
+        if binomial is None:
+            departs = np.arange(start_time, end_time, period)
+        else:
+            steps = np.arange(start_time, end_time, 1.)
+            counts = random_state.binomial(binomial,
+                                           1. / period / binomial,
+                                           size=len(steps))
+            departs = np.repeat(steps, counts)
+        from_idx = sources[random_state.randint(len(sources),
+                                                size=len(departs))]
+        to_idx = sinks[random_state.randint(len(sinks), size=len(departs))]
+        routable = np.isin(from_idx * num_edges + to_idx, reachable_codes)
+        departs = departs[routable]
+        from_edges = edge_ids[from_idx[routable]]
+        to_edges = edge_ids[to_idx[routable]]
+
+        root = etree.Element('routes')
+        etree.SubElement(root, 'vType', id=vclass, vClass=vclass)
+        for i, (depart, from_edge, to_edge) in enumerate(
+                zip(departs, from_edges, to_edges)):
+            trip = etree.SubElement(
+                root, 'trip', id=str(i), type=vclass,
+                depart='{:.2f}'.format(depart))
+            trip.set('from', from_edge)
+            trip.set('to', to_edge)
+            for k, v in attribs.items():
+                trip.set(k, v)
+        etree.ElementTree(root).write(tripfile, pretty_print=True)
+        _logger.debug('Wrote sampled trip file %s', tripfile)
+
+    return list(tripfiles)
+
+
 def set_non_fringe_weights_to_zero(weights_file_prefix, netfile):
-    net = sumolib.net.readNet(netfile)
+    net = read_net(netfile)
 
     src_def_file = weights_file_prefix + '.src.xml'
     dst_def_file = weights_file_prefix + '.dst.xml'
@@ -29,3 +29,35 @@ def get_tls_data(parsed_xml_tls, lane_id):
                 search_finished = False
 
     return phase_start, phase_length, duration_green_light
+
+
+class TLSDataAccumulator(object):
+    """Incremental version of `get_tls_data` for a single lane.
+
+    Feed it the lane's tlsSwitch records in document order with `update`;
+    `result` then gives the same (phase_start, phase_length,
+    duration_green_light) tuple as `get_tls_data`, without needing the
+    whole parsed document.
+    """
+    def __init__(self):
+        self.search_finished = False
+        self.duration_green_light = 0
+        self.marker_toLane = None
+        self.phase_start = None
+        self.phase_length = None
+
+    def update(self, toLane, end, duration):
+        toLane = str(toLane)
+        if self.marker_toLane == toLane and not self.search_finished: #find tls for 2nd time
+            self.phase_length = int(end - self.phase_start)
+            self.search_finished = True
+
+        #searching for the longest duration in cycle
+        if duration > self.duration_green_light:
+            self.duration_green_light = duration
+            self.marker_toLane = toLane
+            self.phase_start = end
+            self.search_finished = False
+
+    def result(self):
+        return self.phase_start, self.phase_length, self.duration_green_light
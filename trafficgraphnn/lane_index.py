@@ -0,0 +1,243 @@
+"""Compact array index of a network's lanes, connections and detectors.
+
+`LaneIndex` maps lane, edge and detector ids to integers and stores the
+lane connections as a CSR matrix with per-connection direction and tls
+codes, so adjacency queries are sparse array operations instead of
+networkx graph copies.
+"""
+import logging
+
+import numpy as np
+from scipy import sparse
+
+_logger = logging.getLogger(__name__)
+
+_detector_type_codes = {'e1Detector': 0, 'inductionLoop': 0,
+                        'e2Detector': 1, 'laneAreaDetector': 1}
+
+
+class LaneIndex(object):
+    """Integer index of a lanewise network.
+
+    Lanes are numbered edge by edge, in lane index order within each edge,
+    so the lanes of edge `e` are `edge_lane_indptr[e]:edge_lane_indptr[e+1]`.
+
+    :ivar lane_ids: Array of lane ids
+    :ivar lane_edge: Edge number of each lane
+    :ivar edge_ids: Array of edge ids
+    :ivar edge_lane_indptr: Offsets of each edge's lanes
+    :ivar indptr: CSR row offsets of the lane connections
+    :ivar indices: CSR column (to-lane) indices of the lane connections
+    :ivar conn_direction: Code into `directions` of each connection
+    :ivar conn_tls: Code into `tls_ids` of each connection, -1 if none
+    :ivar detector_ids: Array of detector ids
+    :ivar detector_lane: Lane number of each detector
+    :ivar detector_type: 0 for e1 detectors, 1 for e2 detectors
+    :ivar detector_pos: Position attribute of each detector
+    :ivar has_detector: Whether each lane has a `detectors` dict in the
+    graph, which can be empty
+    """
+    def __init__(self, lane_ids, lane_edge, edge_ids, edge_lane_indptr,
+                 indptr, indices, conn_direction, directions, conn_tls,
+                 tls_ids, detector_ids, detector_lane, detector_type,
+                 detector_pos, detector_dict_lanes=None):
+        self.lane_ids = np.asarray(lane_ids, dtype=object)
+        self.lane_edge = np.asarray(lane_edge, dtype=np.int32)
+        self.edge_ids = np.asarray(edge_ids, dtype=object)
+        self.edge_lane_indptr = np.asarray(edge_lane_indptr, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.conn_direction = np.asarray(conn_direction, dtype=np.int8)
+        self.directions = list(directions)
+        self.conn_tls = np.asarray(conn_tls, dtype=np.int32)
+        self.tls_ids = list(tls_ids)
+        self.detector_ids = np.asarray(detector_ids, dtype=object)
+        self.detector_lane = np.asarray(detector_lane, dtype=np.int32)
+        self.detector_type = np.asarray(detector_type, dtype=np.int8)
+        self.detector_pos = np.asarray(detector_pos, dtype=np.float64)
+
+        self.lane_to_idx = {lane: i for i, lane in enumerate(self.lane_ids)}
+        self.edge_to_idx = {edge: i for i, edge in enumerate(self.edge_ids)}
+        self.detector_to_idx = {det: i
+                                for i, det in enumerate(self.detector_ids)}
+        if detector_dict_lanes is None:
+            detector_dict_lanes = self.detector_lane
+        self.has_detector = np.zeros(self.num_lanes, dtype=bool)
+        self.has_detector[np.asarray(detector_dict_lanes,
+                                     dtype=np.int64)] = True
+
+    @classmethod
+    def from_net_and_graph(cls, net, lane_graph, detector_graph=None):
+        """Build from a sumolib net and a lanewise graph.
+
+        :param net: sumolib net, used for edge membership and lane order
+        :param lane_graph: Directed lane graph whose edges carry 'direction'
+        and 'tls' attributes
+        :param detector_graph: Graph whose nodes carry the 'detectors'
+        dicts, defaults to `lane_graph`
+        """
+        if detector_graph is None:
+            detector_graph = lane_graph
+        lane_ids = []
+        lane_edge = []
+        edge_ids = []
+        edge_lane_indptr = [0]
+        for edge in net.getEdges():
+            lanes = sorted(edge.getLanes(), key=lambda lane: lane.getIndex())
+            edge_ids.append(edge.getID())
+            lane_ids.extend(lane.getID() for lane in lanes)
+            lane_edge.extend([len(edge_ids) - 1] * len(lanes))
+            edge_lane_indptr.append(len(lane_ids))
+        lane_to_idx = {lane: i for i, lane in enumerate(lane_ids)}
+
+        directions = []
+        tls_ids = []
+        direction_codes = {}
+        tls_codes = {}
+        rows, cols, conn_direction, conn_tls = [], [], [], []
+        for from_lane, to_lane, data in lane_graph.edges(data=True):
+            if from_lane not in lane_to_idx or to_lane not in lane_to_idx:
+                continue
+            direction = data.get('direction')
+            if direction not in direction_codes:
+                direction_codes[direction] = len(directions)
+                directions.append(direction)
+            tls = data.get('tls')
+            if tls:
+                if tls not in tls_codes:
+                    tls_codes[tls] = len(tls_ids)
+                    tls_ids.append(tls)
+                tls_code = tls_codes[tls]
+            else:
+                tls_code = -1
+            rows.append(lane_to_idx[from_lane])
+            cols.append(lane_to_idx[to_lane])
+            conn_direction.append(direction_codes[direction])
+            conn_tls.append(tls_code)
+
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.lexsort((np.asarray(cols, dtype=np.int64), rows))
+        indptr = np.zeros(len(lane_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(lane_ids)),
+                  out=indptr[1:])
+
+        detector_ids, detector_lane, detector_type, detector_pos = \
+            [], [], [], []
+        detector_dict_lanes = []
+        for lane, det_dict in detector_graph.nodes(data='detectors'):
+            if det_dict is None or lane not in lane_to_idx:
+                continue
+            detector_dict_lanes.append(lane_to_idx[lane])
+            for det_id, det_info in det_dict.items():
+                detector_ids.append(det_id)
+                detector_lane.append(lane_to_idx[lane])
+                detector_type.append(
+                    _detector_type_codes.get(det_info.get('type'), -1))
+                detector_pos.append(float(det_info.get('pos', np.nan)))
+
+        return cls(lane_ids, lane_edge, edge_ids, edge_lane_indptr,
+                   indptr, np.asarray(cols, dtype=np.int64)[order],
+                   np.asarray(conn_direction, dtype=np.int64)[order],
+                   directions,
+                   np.asarray(conn_tls, dtype=np.int64)[order],
+                   tls_ids, detector_ids, detector_lane, detector_type,
+                   detector_pos, detector_dict_lanes)
+
+    @property
+    def num_lanes(self):
+        return len(self.lane_ids)
+
+    @property
+    def num_connections(self):
+        return len(self.indices)
+
+    def lane_idx(self, lanes):
+        """Integer indices of an iterable of lane ids"""
+        return np.fromiter((self.lane_to_idx[lane] for lane in lanes),
+                           dtype=np.int64)
+
+    def lanes_of_edge(self, edge_id):
+        e = self.edge_to_idx[edge_id]
+        return self.lane_ids[
+            self.edge_lane_indptr[e]:self.edge_lane_indptr[e + 1]].tolist()
+
+    def neighboring_lanes(self, lane_id, include_input_lane=False):
+        """Ids of the lanes in the same edge as `lane_id`"""
+        i = self.lane_to_idx[lane_id]
+        e = self.lane_edge[i]
+        ids = self.lane_ids[
+            self.edge_lane_indptr[e]:self.edge_lane_indptr[e + 1]].tolist()
+        if not include_input_lane:
+            ids.remove(lane_id)
+        return ids
+
+    def lanes_with_detectors(self):
+        return self.lane_ids[self.has_detector].tolist()
+
+    def detector_to_lane(self):
+        """Dict of detector id to lane id"""
+        return dict(zip(self.detector_ids, self.lane_ids[self.detector_lane]))
+
+    def connection_mask(self, directions=None):
+        """Boolean mask over connections with a direction in `directions`"""
+        if directions is None:
+            return np.ones(self.num_connections, dtype=bool)
+        codes = [self.directions.index(d) for d in directions
+                 if d in self.directions]
+        return np.isin(self.conn_direction, codes)
+
+    def adjacency(self, lanes=None, directions=None, reverse=False,
+                  undirected=False):
+        """Sparse boolean lane adjacency matrix.
+
+        :param lanes: Lane ids giving the row/column order, defaults to all
+        :param directions: Only include connections with these directions
+        (e.g. ['l', 'r']), defaults to all
+        :param reverse: If True, A[i, j] means lane j flows into lane i
+        :param undirected: If True, return the symmetrized matrix
+        :rtype: scipy.sparse.csr_matrix
+        """
+        mask = self.connection_mask(directions)
+        rows = np.repeat(np.arange(self.num_lanes), np.diff(self.indptr))
+        A = sparse.csr_matrix(
+            (np.ones(mask.sum(), dtype=bool),
+             (rows[mask], self.indices[mask])),
+            shape=(self.num_lanes, self.num_lanes))
+        if reverse:
+            A = A.T.tocsr()
+        if undirected:
+            A = (A + A.T).tocsr()
+        return self._subset(A, lanes)
+
+    def neighbor_adjacency(self, lanes=None, include_self_adjacency=True):
+        """Sparse boolean matrix connecting lanes in the same edge"""
+        counts = np.diff(self.edge_lane_indptr)
+        # each lane is adjacent to every lane of its edge
+        row_counts = counts[self.lane_edge]
+        rows = np.repeat(np.arange(self.num_lanes), row_counts)
+        starts = np.repeat(self.edge_lane_indptr[self.lane_edge], row_counts)
+        offsets = np.arange(len(rows)) - np.repeat(
+            np.cumsum(row_counts) - row_counts, row_counts)
+        cols = starts + offsets
+        if not include_self_adjacency:
+            keep = rows != cols
+            rows, cols = rows[keep], cols[keep]
+        A = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, cols)),
+            shape=(self.num_lanes, self.num_lanes))
+        return self._subset(A, lanes)
+
+    def _subset(self, A, lanes):
+        if lanes is None:
+            return A
+        idx = self.lane_idx(lanes)
+        return A[idx][:, idx]
+
+    def edge_list(self, A, lanes=None):
+        """(from, to) lane id pairs of the nonzeros of an adjacency matrix"""
+        if lanes is None:
+            lanes = self.lane_ids
+        else:
+            lanes = np.asarray(lanes, dtype=object)
+        A = A.tocoo()
+        return list(zip(lanes[A.row], lanes[A.col]))
@@ -1,8 +1,32 @@
-from .batch_graph_attention_layer import BatchGraphAttention
-from .batch_multigraph_attention_layer import BatchMultigraphAttention
-from .reshape_layers import (ReshapeFoldInLanes, ReshapeForLSTM,
-                             ReshapeForOutput, ReshapeUnfoldLanes)
-from .time_distributed_multi_input import TimeDistributedMultiInput
-from .layer_normalization import LayerNormalization
-
-from .modified_thirdparty.causal_attention_decoder import DenseCausalAttention
+import importlib
+
+# Layers are imported on first access so that importing this package does
+# not import Keras and TensorFlow.
+_lazy_attributes = {
+    'BatchGraphAttention': '.batch_graph_attention_layer',
+    'BatchMultigraphAttention': '.batch_multigraph_attention_layer',
+    'SegmentMultigraphAttention': '.segment_multigraph_attention_layer',
+    'ReshapeFoldInLanes': '.reshape_layers',
+    'ReshapeForLSTM': '.reshape_layers',
+    'ReshapeForOutput': '.reshape_layers',
+    'ReshapeUnfoldLanes': '.reshape_layers',
+    'TimeDistributedMultiInput': '.time_distributed_multi_input',
+    'LayerNormalization': '.layer_normalization',
+    'DenseCausalAttention': '.modified_thirdparty.causal_attention_decoder',
+}
+
+__all__ = list(_lazy_attributes)
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        module = importlib.import_module(_lazy_attributes[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,155 @@
+from __future__ import absolute_import
+
+import tensorflow as tf
+from keras import backend as K
+from trafficgraphnn.layers.batch_multigraph_attention_layer import \
+    BatchMultigraphAttention
+
+
+class SegmentMultigraphAttention(BatchMultigraphAttention):
+    """Multigraph attention over an edge list instead of dense adjacency.
+
+    Takes the graph as (edge type, row node, column node) triples, so memory
+    scales with the number of edges rather than nodes squared. Use it with
+    disjoint union batches, where the nodes of every sample in a batch form
+    one graph (see `trafficgraphnn.load_data.disjoint_union_batch`).
+
+    Inputs are the node features (..., N, F) and the int edge list
+    (num_edges, 3). Node i attends to node j over edge type c for each edge
+    (c, i, j). Weights are those of `BatchMultigraphAttention`, and so are
+    the outputs of nodes that have at least one edge of every type, with
+    attention dropout shared across edge types as in the dense layer.
+
+    Nodes with no edges of a type get zeros (plus bias) for that type. The
+    dense layer's masked softmax instead averages over every node of the
+    graph, which in padded batches includes padding lanes and in a disjoint
+    union would mix samples.
+    """
+    def __init__(self, F_, num_edge_types, **kwargs):
+        self.num_edge_types = num_edge_types
+        super(SegmentMultigraphAttention, self).__init__(F_, **kwargs)
+
+    def build(self, input_shape):
+        assert len(input_shape) == 2 # data tensor and edge tensor
+        assert len(input_shape[1]) == 2 # dimensions: edge, (type, row, col)
+        super(SegmentMultigraphAttention, self).build(
+            [input_shape[0], (None, self.num_edge_types, None, None)])
+
+    def call(self, inputs, training=None):
+        X = inputs[0]  # Node features (... x N x F)
+        edges = K.cast(inputs[1], 'int32')  # (num_edges x 3)
+        edge_type, rows, cols = edges[:, 0], edges[:, 1], edges[:, 2]
+
+        X_shape = K.shape(X)
+        num_nodes = X_shape[-2]
+        F = K.int_shape(X)[-1]
+        # nodes first so edges index the leading axis (N x L x F)
+        X_flat = K.permute_dimensions(K.reshape(X, [-1, num_nodes, F]),
+                                      [1, 0, 2])
+        num_leading = K.shape(X_flat)[1]
+
+        # attention is normalized per (edge type, row node)
+        segments = edge_type * num_nodes + rows
+        num_segments = self.num_edge_types * num_nodes
+        neigh_index = K.stack([cols, edge_type], 1)
+        # attention dropout noise is drawn per (row, col) node pair and
+        # shared across edge types, like the dense layer's noise shape
+        node_pairs, pair_index = tf.unique(rows * num_nodes + cols)
+        noise_shape = K.stack([K.shape(node_pairs)[0], num_leading])
+
+        outputs = []
+        for h in range(self.attn_heads):
+            kernel = self.kernels[h]
+            attn_kernel_self = self.attn_kernels_self[h]
+            attn_kernel_neighs = self.attn_kernels_neighs[h]
+
+            features = K.dot(X_flat, kernel)  # (N x L x F')
+
+            attn_for_self = K.dot(features, attn_kernel_self)[..., 0]  # (N x L)
+            attn_for_neighs = K.stack(
+                [K.dot(features, k)[..., 0] for k in attn_kernel_neighs],
+                1)  # (N x E x L)
+
+            scores = (K.gather(attn_for_self, rows)
+                      + tf.gather_nd(attn_for_neighs, neigh_index))  # (num_edges x L)
+
+            # Add nonlinearty
+            scores = K.relu(scores, alpha=0.2)
+
+            # Softmax over each segment's edges
+            segment_max = tf.unsorted_segment_max(scores, segments,
+                                                  num_segments)
+            exp_scores = K.exp(scores - K.gather(segment_max, segments))
+            segment_sum = tf.unsorted_segment_sum(exp_scores, segments,
+                                                  num_segments)
+            softmax = exp_scores / K.gather(segment_sum, segments)
+
+            dropout = K.in_train_phase(
+                lambda: self._pair_dropout(softmax, pair_index,
+                                           noise_shape),
+                softmax, training=training)
+
+            # Linear combination with neighbors' features
+            messages = K.expand_dims(dropout, -1) * K.gather(features, cols)
+            node_features = tf.unsorted_segment_sum(
+                messages, segments, num_segments)  # (EN x L x F')
+            node_features = K.reshape(
+                node_features,
+                K.stack([self.num_edge_types, num_nodes, num_leading,
+                         self.F_]))
+            node_features = K.permute_dimensions(node_features,
+                                                 [2, 1, 0, 3])  # (L x N x E x F')
+            if self.highway_connection:
+                node_features = K.concatenate(
+                    [node_features,
+                     K.expand_dims(K.permute_dimensions(features, [1, 0, 2]),
+                                   -2)], -2)
+
+            node_features = K.reshape(
+                node_features,
+                K.stack([num_leading, num_nodes,
+                         self.F_ * self._num_output_edge_types()]))  # (L x N x EF')
+
+            if self.use_bias:
+                node_features = K.bias_add(node_features, self.biases[h])
+
+            outputs.append(node_features)
+
+        # Reduce the attention heads output according to the reduction method
+        if self.attn_heads_reduction == 'concat':
+            output = K.concatenate(outputs, -1)  # (L x N x EKF')
+        else:
+            output = K.mean(K.stack(outputs, axis=0), axis=0)  # (L x N x EF')
+
+        output = self.activation(output)
+        output = K.reshape(
+            output, K.concatenate([X_shape[:-1],
+                                   [self.output_dim
+                                    * self._num_output_edge_types()]]))
+        if 0. < self.attn_dropout < 1.:
+            output._uses_learning_phase = True
+
+        return output
+
+    def _pair_dropout(self, softmax, pair_index, noise_shape):
+        if not 0. < self.attn_dropout < 1.:
+            return softmax
+        keep_prob = 1. - self.attn_dropout
+        keep = tf.floor(keep_prob + tf.random_uniform(noise_shape))
+        return softmax / keep_prob * K.gather(keep, pair_index)
+
+    def _num_output_edge_types(self):
+        if self.highway_connection:
+            return self.num_edge_types + 1
+        return self.num_edge_types
+
+    def compute_output_shape(self, input_shape):
+        assert len(input_shape) == 2
+        output_shape = list(input_shape[0])
+        output_shape[-1] = self.output_dim * self._num_output_edge_types()
+        return tuple(output_shape)
+
+    def get_config(self):
+        config = super(SegmentMultigraphAttention, self).get_config()
+        config['num_edge_types'] = self.num_edge_types
+        return config
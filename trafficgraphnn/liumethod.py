@@ -1,12 +1,16 @@
+import contextlib
 import logging
+import multiprocessing
 import os
+import queue
+import traceback
 from collections import OrderedDict, namedtuple
 
 import numpy as np
 import pandas as pd
 import math
 
-from trafficgraphnn.utils import iterfy
+from trafficgraphnn.utils import AsyncHDFAppender, iterfy
 from trafficgraphnn.sumo_output_reader import SumoNetworkOutputReader, SumoLaneOutputReader
 
 
@@ -22,7 +26,11 @@ class LiuEtAlRunner(object):
                  store_while_running = True,
                  use_started_halts = False,
                  sim_num = 0,
-                 test_data = False):
+                 test_data = False,
+                 tls_subset = None,
+                 num_workers = None,
+                 write_buffer_rows = 5000,
+                 write_buffer_seconds = 10.):
         self.reader = SumoNetworkOutputReader(sumo_network)
         self.sumo_network = sumo_network
         self.df_estimation_results = pd.DataFrame()
@@ -31,6 +39,15 @@ class LiuEtAlRunner(object):
         self.sim_num = sim_num
         self.test_data = test_data
         self.input_data_hdf_file = input_data_hdf_file
+        self.time_window = time_window
+        # with more than one worker, intersections are run in worker processes
+        # (see run_up_to_phase_parallel)
+        self.num_workers = num_workers
+        # with store_while_running, results are written by a background
+        # writer in batches of this many phases (or after this many seconds)
+        self.write_buffer_rows = write_buffer_rows
+        self.write_buffer_seconds = write_buffer_seconds
+        self._results_writer = None
         # verify all lanes requested are actually in the network
         if lane_subset is None:
             # process all lanes
@@ -53,9 +70,12 @@ class LiuEtAlRunner(object):
                 ]
 
         # create LiuIntersection objects for each intersection
+        if tls_subset is not None:
+            tls_subset = set(iterfy(tls_subset))
         self.liu_intersections = [
             LiuIntersection(tls, self, time_window=time_window)
             for tls in self.net.getTrafficLights()
+            if tls_subset is None or tls.getID() in tls_subset
         ]
         _logger.info('Created %s LiuIntersection objects',
                      len(self.liu_intersections))
@@ -66,7 +86,13 @@ class LiuEtAlRunner(object):
 
         self.parse_phase_timings()
         self._init_max_per_green_estimates()
-        self._init_detector_parsers()
+        if not self.parallel:
+            # in parallel mode the workers open their own parsers
+            self._init_detector_parsers()
+
+    @property
+    def parallel(self):
+        return self.num_workers is not None and self.num_workers > 1
 
     @property
     def graph(self):
@@ -77,8 +103,8 @@ class LiuEtAlRunner(object):
         return self.reader.net
 
     @property
-    def parsed_xml_tls(self):
-        return self.reader.parsed_xml_tls
+    def tls_timing_index(self):
+        return self.reader.tls_timing_index
 
     def _init_max_per_green_estimates(self):
         for lane in self.liu_lanes.values():
@@ -92,24 +118,113 @@ class LiuEtAlRunner(object):
             lane._init_detector_parsers()
 
     def run_up_to_phase(self, max_num_phase):
+        if self.parallel:
+            return self.run_up_to_phase_parallel(max_num_phase)
         # iterate on the single-step methods for each intersection until
         # reaching the given time
         # for num_phase in range(1, max_num_phase):
-        for num_phase in range(0, max_num_phase):
-            _logger.info(
-                'Running estimation for every lane in every intersection in phase %g',
-                num_phase)
-            self.df_estimation_results = pd.DataFrame() #reset df for case of online storage
-            for intersection in self.liu_intersections:
-                intersection.run_next_phase(num_phase)
-                if self.store_while_running == True:
-                    intersection.add_estimation_to_df(self.store_while_running, num_phase)
-            if self.store_while_running == True:
-                self.append_results(num_phase)
+        if self.store_while_running == True:
+            with self._open_results_writer():
+                for num_phase in range(0, max_num_phase):
+                    self._run_phase_for_intersections(num_phase)
+                    self.append_results(num_phase)
+        else:
+            for num_phase in range(0, max_num_phase):
+                self._run_phase_for_intersections(num_phase)
+            self.store_results(unload_data = True)
 
-        if self.store_while_running == False:
+    def _run_phase_for_intersections(self, num_phase):
+        _logger.info(
+            'Running estimation for every lane in every intersection in phase %g',
+            num_phase)
+        self.df_estimation_results = pd.DataFrame() #reset df for case of online storage
+        for intersection in self.liu_intersections:
+            intersection.run_next_phase(num_phase)
+            if self.store_while_running == True:
+                intersection.add_estimation_to_df(self.store_while_running, num_phase)
+        return self.df_estimation_results
+
+    def run_up_to_phase_parallel(self, max_num_phase, num_workers=None):
+        """Run the estimation with the intersections sharded across processes.
+
+        Each worker builds its own network, readers and parsers for its shard
+        of intersections and sends each phase's results back as soon as it
+        has run that phase. A phase is merged in intersection order and
+        written by this process once every shard has sent it, so results are
+        stored while the workers run and the results file is the same as
+        with `run_up_to_phase`. Lane result arrays are copied back to this
+        runner's LiuLane objects when the workers finish.
+        """
+        if num_workers is None:
+            num_workers = self.num_workers
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        num_workers = max(1, min(num_workers, len(self.liu_intersections)))
+
+        tls_ids = [i.sumolib_tls.getID() for i in self.liu_intersections]
+        shards = [list(shard) for shard in np.array_split(tls_ids, num_workers)
+                  if len(shard) > 0]
+
+        runner_kwargs = dict(input_data_hdf_file=self.input_data_hdf_file,
+                             time_window=self.time_window,
+                             store_while_running=self.store_while_running,
+                             use_started_halts=self.use_started_halts,
+                             sim_num=self.sim_num,
+                             test_data=self.test_data)
+        network_kwargs = _sumo_network_init_kwargs(self.sumo_network)
+
+        _logger.info('Running estimation for %g intersections in %g processes',
+                     len(tls_ids), len(shards))
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+                       target=_run_liu_shard,
+                       args=(shard_index, network_kwargs, runner_kwargs, shard,
+                             max_num_phase, results))
+                   for shard_index, shard in enumerate(shards)]
+        for worker in workers:
+            worker.start()
+        try:
+            if self.store_while_running == True:
+                with self._open_results_writer():
+                    self._collect_shard_results(results, workers)
+            else:
+                self._collect_shard_results(results, workers)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+        if self.store_while_running != True:
             self.store_results(unload_data = True)
 
+    def _collect_shard_results(self, results, workers, poll_interval=1.):
+        """Append each phase as soon as every shard has sent it, and set the
+        lane result arrays sent by shards that are done"""
+        pending_phases = {}
+        next_phase = 0
+        num_done = 0
+        while num_done < len(workers):
+            message = _get_shard_message(results, workers, poll_interval)
+            kind, shard_index = message[:2]
+            if kind == 'phase':
+                num_phase, df = message[2:]
+                pending_phases.setdefault(num_phase, {})[shard_index] = df
+                while len(pending_phases.get(next_phase, ())) == len(workers):
+                    phase_dfs = pending_phases.pop(next_phase)
+                    self.df_estimation_results = pd.concat(
+                        [phase_dfs[i] for i in range(len(workers))], axis=1)
+                    self.append_results(next_phase)
+                    next_phase += 1
+            elif kind == 'done':
+                for lane_id, state in message[2].items():
+                    self.liu_lanes[lane_id].set_results_state(state)
+                num_done += 1
+            else:
+                raise RuntimeError(
+                    'Liu estimation failed for shard {}:\n{}'.format(
+                        shard_index, message[2]))
+
     def run_next_phase(self, num_phase):
         # run the single-phase method for each intersection
         for intersection in self.liu_intersections:
@@ -208,14 +323,35 @@ class LiuEtAlRunner(object):
             self.df_estimation_results = None
             print('Unload data from liu-method')
 
-    def append_results(self, num_phase):
-
+    def _results_filename(self):
         if self.test_data:
-            file_name = os.path.join(os.path.dirname(
+            return os.path.join(os.path.dirname(
                 self.sumo_network.netfile), 'liu_estimation_results_test_data_' + str(self.sim_num) + '.h5')
         else:
-            file_name = os.path.join(os.path.dirname(
+            return os.path.join(os.path.dirname(
                 self.sumo_network.netfile), 'liu_estimation_results' + str(self.sim_num) + '.h5')
+
+    @contextlib.contextmanager
+    def _open_results_writer(self):
+        """Start a background writer that `append_results` passes results to
+        until the context is left"""
+        writer = AsyncHDFAppender(self._results_filename(),
+                                  'df_estimation_results',
+                                  max_rows=self.write_buffer_rows,
+                                  max_wait=self.write_buffer_seconds)
+        self._results_writer = writer
+        try:
+            with writer:
+                yield writer
+        finally:
+            self._results_writer = None
+
+    def append_results(self, num_phase):
+        if self._results_writer is not None:
+            self._results_writer.append(self.df_estimation_results)
+            return
+
+        file_name = self._results_filename()
         if not os.path.exists(file_name) or num_phase == 0:
             self.df_estimation_results.to_hdf(file_name,
                     key = 'df_estimation_results', format='table')
@@ -241,6 +377,58 @@ class LiuEtAlRunner(object):
             self.sumo_network.netfile), 'liu_estimation_results' + str(self.sim_num) + '.h5')
 
 
+def _sumo_network_init_kwargs(sumo_network):
+    return dict(netfile=sumo_network.netfile,
+                lanewise=sumo_network.lanewise,
+                undirected_graph=sumo_network.undirected_graph,
+                routefile=sumo_network.routefile,
+                addlfiles=list(sumo_network.additional_files),
+                output_dir=sumo_network.output_dir)
+
+
+def _get_shard_message(results, workers, poll_interval):
+    """Next message from the shard workers, raising if a worker died without
+    sending one"""
+    while True:
+        try:
+            return results.get(timeout=poll_interval)
+        except queue.Empty:
+            dead = [worker for worker in workers
+                    if not worker.is_alive() and worker.exitcode != 0]
+            if len(dead) > 0:
+                raise RuntimeError(
+                    'Liu estimation worker exited with code {}'.format(
+                        dead[0].exitcode))
+
+
+def _run_liu_shard(shard_index, network_kwargs, runner_kwargs, tls_ids,
+                   max_num_phase, results):
+    """Worker function: run the Liu method for a subset of intersections.
+
+    Puts ('phase', shard_index, num_phase, df) on the `results` queue after
+    each phase (if storing while running), then ('done', shard_index,
+    lane_states) with the result arrays of every lane in the shard, or
+    ('error', shard_index, traceback) if the shard fails.
+    """
+    try:
+        from trafficgraphnn.sumo_network import SumoNetwork
+        sumo_network = SumoNetwork(**network_kwargs)
+        runner = LiuEtAlRunner(sumo_network, tls_subset=tls_ids,
+                               **runner_kwargs)
+
+        for num_phase in range(0, max_num_phase):
+            df = runner._run_phase_for_intersections(num_phase)
+            if runner.store_while_running == True:
+                results.put(('phase', shard_index, num_phase, df))
+
+        lane_states = {lane_id: lane.get_results_state()
+                       for lane_id, lane in runner.liu_lanes.items()}
+        runner.reader.close_hdfstores()
+        results.put(('done', shard_index, lane_states))
+    except Exception:
+        results.put(('error', shard_index, traceback.format_exc()))
+
+
 class LiuIntersection(object):
     # LiuLane objects corresponding to its component
     # lanes as well as intersection-level info like traffic light definition
@@ -306,6 +494,7 @@ class LiuIntersection(object):
         return max_phase_length
 
     def add_estimation_to_df(self, while_running, phase_cnt):
+        lane_dfs = [self.parent.df_estimation_results]
         for lane in self.liu_lanes.values():
             time, real_queue, estimated_queue, estimated_queue_pure_liu, phase_start, phase_end, tls_start, tls_end = lane.get_estimation_data(while_running)
 
@@ -331,7 +520,9 @@ class LiuIntersection(object):
             df_lane[lane_ID, 'tls start'] = tls_start
             df_lane[lane_ID, 'tls end'] = tls_end
 
-            self.parent.df_estimation_results = pd.concat([self.parent.df_estimation_results, df_lane], axis = 1)
+            lane_dfs.append(df_lane)
+
+        self.parent.df_estimation_results = pd.concat(lane_dfs, axis = 1)
 
     def unload_data(self):
         for lane in self.liu_lanes.values():
@@ -375,6 +566,19 @@ class LiuLane(object):
         self.k_j = JAM_DENSITY #jam density
         self.v_2 = -6.5 #just for initialization
 
+    _result_attrs = ['arr_breakpoint_A', 'arr_breakpoint_B', 'arr_breakpoint_C',
+                     'arr_breakpoint_C_stopbar',
+                     'arr_estimated_max_queue_length',
+                     'arr_estimated_max_queue_length_pure_liu',
+                     'arr_estimated_time_max_queue', 'used_method',
+                     'max_veh_leaving_on_green', 'v_2']
+    _reader_result_attrs = ['arr_real_max_queue_length',
+                            'arr_maxJamLengthInMeters',
+                            'arr_maxJamLengthInVehicles',
+                            'arr_maxJamLengthInVehiclesSum',
+                            'arr_phase_start', 'arr_phase_end',
+                            'arr_green_phase_start', 'arr_green_phase_end']
+
     def _init_result_arrays(self):
         self.arr_breakpoint_A = []
         self.arr_breakpoint_B = []
@@ -999,6 +1203,19 @@ class LiuLane(object):
     def get_lane_ID(self):
         return self.sumolib_in_lane.getID()
 
+    def get_results_state(self):
+        """Return the estimation results of this lane as a picklable dict"""
+        state = {attr: getattr(self, attr) for attr in self._result_attrs}
+        state.update((attr, getattr(self.reader, attr))
+                     for attr in self._reader_result_attrs)
+        return state
+
+    def set_results_state(self, state):
+        for attr in self._result_attrs:
+            setattr(self, attr, state[attr])
+        for attr in self._reader_result_attrs:
+            setattr(self.reader, attr, state[attr])
+
     def unload_data(self):
         self.parsed_xml_e1_stopbar_detector = None
         self.parsed_xml_e1_adv_detector = None
@@ -1,37 +1,32 @@
 import logging
-from collections import defaultdict
 from itertools import zip_longest
 
 import numpy as np
 import pandas as pd
 import six
 
-from trafficgraphnn.preprocessing.io import get_preprocessed_filenames, queueing_intervals_from_lane_light_df
+from trafficgraphnn.preprocessing.codec import decode_table, get_storer_codecs
+from trafficgraphnn.preprocessing.cycles import (BOUNDS_KEY, X_CYCLE_KEY,
+                                                 Y_CYCLE_KEY, aggregate_cycles,
+                                                 cycle_feature_names,
+                                                 cycle_info_matches,
+                                                 get_storer_cycle_info,
+                                                 mask_per_cycle_features)
+from trafficgraphnn.preprocessing.features import (cycle_aggregations_default,
+                                                   get_pad_value_for_feature,
+                                                   pad_value_for_feature,
+                                                   per_cycle_features_default)
+from trafficgraphnn.preprocessing.io import (adjacency_ref,
+                                             get_preprocessed_filenames,
+                                             read_adjacency_file)
+from trafficgraphnn.preprocessing.pyramid import (downsample_time_axis,
+                                                  get_storer_pyramid,
+                                                  level_matches, pyramid_key)
+from trafficgraphnn.preprocessing.time_grid import TimeGrid, get_storer_grid
 from trafficgraphnn.utils import flatten, iterfy, string_list_decode
 
 _logger = logging.getLogger(__name__)
 
-pad_value_for_feature = defaultdict(lambda: 0,
-                                    occupancy=0.,
-                                    speed=-1.,
-                                    liu_estimated_m=-1.,
-                                    liu_estimated_veh=-1.,
-                                    green=0.,
-                                    nVehSeen=0.,
-                                    maxJamLengthInMeters=-1.,
-                                    maxJamLengthInVehicles=-1.,
-                                   )
-
-pad_value_for_feature.update(
-    [('e1_0/occupancy', 0.),
-    ('e1_0/speed', -1.),
-    ('e1_1/occupancy', 0.),
-    ('e1_1/speed', -1.),
-    ('e2_0/nVehSeen', 0.),
-    ('e2_0/maxJamLengthInMeters', -1.),
-    ('e2_0/maxJamLengthInVehicles', -1.),
-])
-
 x_feature_subset_default = ['e1_0/occupancy',
                             'e1_0/speed',
                             'e1_1/occupancy',
@@ -45,13 +40,6 @@ y_feature_subset_default = ['e2_0/nVehSeen',
 All_A_name_list = ['A_downstream', 'A_upstream', 'A_neighbors',
                    'A_turn_movements', 'A_through_movements', 'A_eye']
 
-per_cycle_features_default = ['maxJamLengthInMeters',
-                              'maxJamLengthInVehicles',
-                              'e2_0/maxJamLengthInMeters',
-                              'e2_0/maxJamLengthInVehicles',
-                              'liu_estimated_veh',
-                              'liu_estimated_m']
-
 
 class Batch(object):
     """Convenience class for holding a batch of sim readers.
@@ -85,6 +73,14 @@ class Batch(object):
                                       self.pad_scalars,
                                       try_broadcast_A=try_broadcast_A)
 
+    def iterate_disjoint_union(self):
+        """Iterate over batches as single graphs of all the batch's lanes.
+
+        See `disjoint_union_batch`.
+        """
+        for output in self.readers:
+            yield disjoint_union_batch(output, self.pad_scalars)
+
 
 def batches_from_directories(directories,
                              batch_size,
@@ -225,6 +221,66 @@ def pad_and_stack_batch(outputs, pad_scalars, try_broadcast_A=False):
     return A, X, Y
 
 
+def disjoint_union_batch(outputs, pad_scalars):
+    """Stack a batch as one graph made of the lanes of all its samples.
+
+    Instead of padding every sample to the batch's largest lane count with
+    dense zero adjacency, the samples' lanes are concatenated along the lane
+    axis and their adjacency is kept as an edge list with global lane
+    numbers, so the graph layers (see `SegmentMultigraphAttention`) never
+    see padded lanes. Only the time axis is padded.
+
+    :param outputs: Per-sample (A, X, Y, ...) tuples, or None where a sample
+    has no data. A is (depth, lanes, lanes), optionally with a leading time
+    axis, and is read from its first timestep. X and Y are (time, lanes,
+    features)
+    :return: X and Y of shape (1, time, total lanes, features), the int32
+    edges (num edges, 3) as (edge type, row lane, column lane) of each
+    nonzero of A, and the int32 index into `outputs` of each lane's sample
+    """
+    samples = [(g, output) for g, output in enumerate(outputs)
+               if output is not None]
+    max_timesteps = max([output[1].shape[0] for _, output in samples],
+                        default=0)
+
+    edges = [np.zeros((0, 3), dtype=np.int32)]
+    X_per_gen = [np.zeros((max_timesteps, 0, len(pad_scalars[1])),
+                          dtype=np.float32)]
+    Y_per_gen = [np.zeros((max_timesteps, 0, len(pad_scalars[2])),
+                          dtype=np.float32)]
+    lane_to_sample = [np.zeros(0, dtype=np.int32)]
+    lane_offset = 0
+    for g, output in samples:
+        A = np.asarray(output[0])
+        X = output[1].astype(np.float32)
+        Y = output[2].astype(np.float32)
+
+        if A.ndim == 2: # no depth dimension
+            A = A[np.newaxis]
+        elif A.ndim == 4: # static over time
+            A = A[0]
+
+        edge_type, rows, cols = np.nonzero(A)
+        edges.append(np.stack(
+            [edge_type, rows + lane_offset, cols + lane_offset],
+            -1).astype(np.int32))
+
+        data_pad_dims = ((0, max_timesteps - X.shape[0]), (0, 0), (0, 0))
+        X_per_gen.append(_split_pad_concat(X, data_pad_dims, pad_scalars[1]))
+        Y_per_gen.append(_split_pad_concat(Y, data_pad_dims, pad_scalars[2]))
+
+        num_lanes = X.shape[1]
+        lane_to_sample.append(np.full(num_lanes, g, dtype=np.int32))
+        lane_offset += num_lanes
+
+    X = np.concatenate(X_per_gen, 1)[np.newaxis]
+    Y = np.concatenate(Y_per_gen, 1)[np.newaxis]
+    edges = np.concatenate(edges)
+    lane_to_sample = np.concatenate(lane_to_sample)
+
+    return X, Y, edges, lane_to_sample
+
+
 def _split_pad_concat(array, pad_dims, scalars):
     assert array.shape[-1] == len(scalars)
     split = np.split(array, array.shape[-1], -1)
@@ -314,7 +370,14 @@ def read_from_file(
     when_per_cycle='end', # begin = on green, # end = on red
     return_X_Y_as_dfs=False,
     max_time=None,
-    return_t_and_lanenames=False):
+    return_t_and_lanenames=False,
+    average_interval=None):
+    """Read a preprocessed file.
+
+    :param average_interval: If given, average X and Y over blocks of this
+    many timesteps (see `downsample_time_axis`), reading the file's
+    precomputed level for the interval when it has a matching one
+    """
 
     # Input handling if we came from TF
     if isinstance(filename, np.ndarray):
@@ -333,64 +396,21 @@ def read_from_file(
         [A_name_list, x_feature_subset, y_feature_subset])
     assert all([A_name in All_A_name_list for A_name in A_name_list])
 
-    with pd.HDFStore(filename, 'r') as store:
-        A_df = store['A']
-        lane_list = A_df.index
-        num_lanes = len(lane_list)
-
-        A = []
-        for A_name in A_name_list:
-            if A_name == 'A_eye':
-                A.append(np.eye(num_lanes, dtype=bool))
-            elif A_name in A_df:
-                A.append(A_df[A_name])
-            else:
-                A.append(np.zeros((num_lanes, num_lanes), dtype='bool'))
-        A = np.stack(A)
-
-        X_df = store['X'].loc[:,x_feature_subset]
-        X_df = X_df.fillna(pad_value_for_feature).astype(np.float32)
-
-        Y_df = store['Y'].loc[:,y_feature_subset]
-        Y_df = Y_df.fillna(pad_value_for_feature).astype(np.float32)
-
-        if max_time is not None:
-            X_df = X_df.loc[pd.IndexSlice[:, :max_time], :]
-            Y_df = Y_df.loc[pd.IndexSlice[:, :max_time], :]
-
-        timesteps = np.float32(X_df.index.get_level_values('begin').unique())
-
-        # masking out Y features only predicted per cycle
-        if 'green' in X_df and len(per_cycle_features) > 0:
-            if when_per_cycle == 'end':
-                index = 1
-            elif when_per_cycle == 'begin':
-                index = 0
-            cycle_intervals = [item for _, series
-                               in X_df['green'].groupby('lane') for item in
-                               queueing_intervals_from_lane_light_df(series)]
-
-            feats_to_mask = [feat for feat in per_cycle_features
-                             if feat in Y_df]
-
-            for feat in feats_to_mask:
-                series = Y_df[feat]
-                keys = [cycle[index] for cycle in cycle_intervals]
-                values = [series.loc[cycle[0]:cycle[1]].max()
-                          for cycle in cycle_intervals]
-                # return keys, values
-                Y_df[feat] = np.float32(get_pad_value_for_feature(feat))
-                Y_df.loc[keys, feat] = values
-
-    len_x = len(x_feature_subset)
-    len_y = len(y_feature_subset)
+    A, X, Y, grid, lane_list = _read_arrays_from_file(
+        filename, A_name_list, x_feature_subset, y_feature_subset,
+        per_cycle_features, when_per_cycle, max_time, average_interval)
+    timesteps = np.float32(grid.times())
 
     if not return_X_Y_as_dfs:
-        X = X_df.values.reshape(num_lanes, -1, len_x).transpose([1, 0, 2])
-        Y = Y_df.values.reshape(num_lanes, -1, len_y).transpose([1, 0, 2])
+        X = X.transpose([1, 0, 2])
+        Y = Y.transpose([1, 0, 2])
     else:
-        X = X_df
-        Y = Y_df
+        index = pd.MultiIndex.from_product([lane_list, grid.times()],
+                                           names=['lane', 'begin'])
+        X = pd.DataFrame(X.reshape(-1, len(x_feature_subset)), index=index,
+                         columns=x_feature_subset)
+        Y = pd.DataFrame(Y.reshape(-1, len(y_feature_subset)), index=index,
+                         columns=y_feature_subset)
 
     A = np.expand_dims(A, 0)
     if repeat_A_over_time:
@@ -402,78 +422,392 @@ def read_from_file(
         return A, X, Y
 
 
-def generator_prefetch_all_from_file(
+def _read_arrays_from_file(filename, A_name_list, x_feature_subset,
+                           y_feature_subset, per_cycle_features,
+                           when_per_cycle, max_time, average_interval=None):
+    """Read a preprocessed file as arrays.
+
+    :return: A (depth, lanes, lanes), X and Y (lanes, time, feature), the
+    TimeGrid of the X and Y time axis, and the lane list
+    :rtype: tuple
+    """
+    with pd.HDFStore(filename, 'r') as store:
+        lane_list, A_dict = _read_A_for_store(store, filename)
+        num_lanes = len(lane_list)
+        A = _stack_A(A_dict, A_name_list, num_lanes)
+
+        if average_interval is not None and average_interval > 1:
+            num_intervals = _pyramid_level_length(
+                store, average_interval, max_time, x_feature_subset,
+                y_feature_subset, per_cycle_features, when_per_cycle)
+            if num_intervals is not None:
+                X, grid = _read_lane_table(
+                    store, pyramid_key('X', average_interval),
+                    x_feature_subset, num_lanes)
+                Y, _ = _read_lane_table(
+                    store, pyramid_key('Y', average_interval),
+                    y_feature_subset, num_lanes)
+                grid = grid.subgrid(0, num_intervals)
+                return (A, X[:, :num_intervals], Y[:, :num_intervals], grid,
+                        lane_list)
+
+        X, X_grid = _read_lane_table(store, 'X', x_feature_subset, num_lanes)
+        Y, Y_grid = _read_lane_table(store, 'Y', y_feature_subset, num_lanes)
+    assert X_grid == Y_grid
+    grid = X_grid
+
+    if max_time is not None:
+        num_timesteps = grid.slice(None, max_time).stop
+        grid = grid.subgrid(0, num_timesteps)
+        X = X[:, :num_timesteps]
+        Y = Y[:, :num_timesteps]
+
+    # masking out Y features only predicted per cycle
+    if 'green' in x_feature_subset and len(per_cycle_features) > 0:
+        feats_to_mask = [feat for feat in per_cycle_features
+                         if feat in y_feature_subset]
+        mask_per_cycle_features(
+            X[:, :, x_feature_subset.index('green')], Y,
+            [y_feature_subset.index(feat) for feat in feats_to_mask],
+            [get_pad_value_for_feature(feat) for feat in feats_to_mask],
+            when_per_cycle)
+
+    if average_interval is not None and average_interval > 1:
+        X = downsample_time_axis(X, average_interval, x_feature_subset,
+                                 per_cycle_features)
+        Y = downsample_time_axis(Y, average_interval, y_feature_subset,
+                                 per_cycle_features)
+        grid = TimeGrid(grid.t0, grid.freq * average_interval, X.shape[1])
+
+    return A, X, Y, grid, lane_list
+
+
+def _stack_A(A_dict, A_name_list, num_lanes):
+    """(depth, lanes, lanes) stack of the named adjacency matrices"""
+    A = []
+    for A_name in A_name_list:
+        if A_name == 'A_eye':
+            A.append(np.eye(num_lanes, dtype=bool))
+        elif A_name in A_dict:
+            A.append(A_dict[A_name])
+        else:
+            A.append(np.zeros((num_lanes, num_lanes), dtype='bool'))
+    return np.stack(A)
+
+
+def _pyramid_level_length(store, interval, max_time, x_feature_subset,
+                          y_feature_subset, per_cycle_features,
+                          when_per_cycle):
+    """Number of rows to read from the file's precomputed `interval` level,
+    or None if it has no level matching the requested loading"""
+    X_key = pyramid_key('X', interval)
+    if '/' + X_key not in store.keys():
+        return None
+    info = get_storer_pyramid(store, X_key)
+    if info is None or not level_matches(info, x_feature_subset,
+                                         y_feature_subset, per_cycle_features,
+                                         when_per_cycle):
+        return None
+
+    grid = get_storer_grid(store, 'X')
+    num_intervals = int(np.ceil(len(grid) / interval))
+    if max_time is None:
+        return num_intervals
+    num_timesteps = grid.slice(None, max_time).stop
+    if num_timesteps == len(grid):
+        return num_intervals
+    if num_timesteps % interval != 0:
+        # max_time cuts through a block of the level
+        return None
+    if info['masked'] and info['when_per_cycle'] == 'begin':
+        # the level has values of cycles that end after max_time
+        return None
+    return num_timesteps // interval
+
+
+def _read_lane_table(store, key, features, num_lanes):
+    """Read a preprocessed X or Y table as a padded (lanes, time, feature)
+    float32 array and its TimeGrid"""
+    df = store[key].loc[:, features]
+    grid = get_storer_grid(store, key)
+    if grid is None: # older files index rows by (lane, begin)
+        grid = TimeGrid.from_times(
+            df.index.get_level_values('begin').unique())
+
+    codecs = get_storer_codecs(store, key)
+    if codecs is None: # older files store float64
+        values = df.fillna(pad_value_for_feature).values.astype(np.float32)
+    else:
+        values = decode_table(df, features, codecs)
+        # only float32 columns can hold blanks
+        for i, feat in enumerate(features):
+            if feat in pad_value_for_feature:
+                column = values[:, i]
+                column[np.isnan(column)] = pad_value_for_feature[feat]
+    return values.reshape(num_lanes, len(grid), len(features)), grid
+
+
+def read_cycles_from_file(
     filename,
-    chunk_size=None,
-    repeat_A_over_time=True,
+    repeat_A_over_cycles=True,
     A_name_list=['A_downstream',
                  'A_upstream',
                  'A_neighbors'],
     x_feature_subset=x_feature_subset_default,
     y_feature_subset=y_feature_subset_default,
-    per_cycle_features=per_cycle_features_default):
-
-    A, X_df, Y_df = read_from_file(filename,
-                                   repeat_A_over_time,
-                                   A_name_list,
-                                   x_feature_subset,
-                                   y_feature_subset,
-                                   per_cycle_features,
-                                   return_X_Y_as_dfs=True)
-    try:
-        t_begin = 0
-        t_end = chunk_size - 1
-        num_lanes = A.shape[-1]
-
-        if X_df.index.names[0] == 'lane':
-            def get_slice(df, time_start, time_end):
-                subdf = df.loc[pd.IndexSlice[:, time_start:time_end], :]
-                lanes = subdf.index.get_level_values(0).unique()
-                timesteps = subdf.index.get_level_values(1).unique()
-                num_timesteps = len(timesteps)
-                num_feats = subdf.shape[-1]
-                return (subdf.values
-                             .reshape((num_lanes, num_timesteps, num_feats))
-                             .transpose((1, 0, 2)),
-                        timesteps,
-                        lanes)
-        elif X_df.index.names[1] == 'lane':
-            def get_slice(df, time_start, time_end):
-                subdf = df.loc[pd.IndexSlice[:, time_start:time_end], :]
-                lanes = subdf.index.get_level_values(1).unique()
-                timesteps = subdf.index.get_level_values(0).unique()
-                num_timesteps = len(timesteps)
-                num_feats = subdf.shape[-1]
-                return (subdf.values.reshape((num_timesteps, num_lanes,
-                                             num_feats)),
-                        timesteps,
-                        lanes)
+    per_cycle_features=per_cycle_features_default,
+    aggregations=cycle_aggregations_default,
+    histogram_bins=None,
+    max_time=None,
+    return_t_and_lanenames=False):
+    """Read a preprocessed file with one step per light cycle.
 
-        while True:
-            X_slice, X_timesteps, X_lanes = get_slice(X_df, t_begin, t_end)
-            Y_slice, Y_timesteps, Y_lanes = get_slice(Y_df, t_begin, t_end)
+    Uses the file's stored cycle tables if they hold the requested features
+    (see `trafficgraphnn.preprocessing.cycles`), otherwise aggregates the
+    full-resolution data with `aggregate_cycles`. Only cycles that end
+    before `max_time` are read. The file needs a `green` feature.
+
+    :return: A, X (cycle, lane, cycle feature) with the columns of
+    `cycle_feature_names`, Y (cycle, lane, feature) and, with
+    `return_t_and_lanenames`, the (cycle, lane) begin times of the cycles
+    (NaN for padding) and the lane list
+    """
+    if isinstance(filename, six.binary_type):
+        filename = filename.decode()
+    A_name_list, x_feature_subset, y_feature_subset = map(
+        string_list_decode,
+        [A_name_list, x_feature_subset, y_feature_subset])
+    assert all([A_name in All_A_name_list for A_name in A_name_list])
 
-            assert (X_timesteps == Y_timesteps).all()
-            assert (X_lanes == Y_lanes).all()
-            timesteps = X_timesteps
-            lanes = X_lanes
+    A, X, Y, bounds, grid, lane_list = _read_cycle_arrays_from_file(
+        filename, A_name_list, x_feature_subset, y_feature_subset,
+        per_cycle_features, aggregations, histogram_bins, max_time)
 
-            if X_slice.size == 0:
-                assert Y_slice.size == 0
-                return
+    X = X.transpose([1, 0, 2])
+    Y = Y.transpose([1, 0, 2])
+    A = np.expand_dims(A, 0)
+    if repeat_A_over_cycles:
+        A = np.repeat(A, X.shape[0], axis=0)
+
+    if return_t_and_lanenames:
+        begins = bounds[:, :, 0].T
+        cycle_times = np.where(begins >= 0, grid.t0 + begins * grid.freq,
+                               np.nan)
+        return A, X, Y, cycle_times, lane_list
+    else:
+        return A, X, Y
 
-            if repeat_A_over_time:
-                A_slice = A[t_begin:t_begin+chunk_size]
-            else:
-                A_slice = A
 
-            yield A_slice, X_slice, Y_slice, timesteps, lanes
+def _read_cycle_arrays_from_file(filename, A_name_list, x_feature_subset,
+                                 y_feature_subset, per_cycle_features,
+                                 aggregations, histogram_bins, max_time):
+    """Cycle-level version of `_read_arrays_from_file`.
 
-            t_begin += chunk_size
-            t_end += chunk_size
-    except TypeError:
-        return
+    :return: A, X (lanes, cycle, cycle feature), Y (lanes, cycle, feature),
+    the cycle bounds (see `aggregate_cycles`), the full-resolution TimeGrid
+    and the lane list
+    """
+    x_columns = cycle_feature_names(x_feature_subset, aggregations,
+                                    histogram_bins)
+    with pd.HDFStore(filename, 'r') as store:
+        if _stored_cycles_match(store, x_columns, y_feature_subset,
+                                per_cycle_features, histogram_bins):
+            lane_list, A_dict = _read_A_for_store(store, filename)
+            num_lanes = len(lane_list)
+            A = _stack_A(A_dict, A_name_list, num_lanes)
+            X, _ = _read_lane_table(store, X_CYCLE_KEY, x_columns, num_lanes)
+            Y, _ = _read_lane_table(store, Y_CYCLE_KEY, y_feature_subset,
+                                    num_lanes)
+            bounds, _ = _read_lane_table(store, BOUNDS_KEY, ['begin', 'end'],
+                                         num_lanes)
+            bounds = bounds.astype(np.int64)
+            grid = get_storer_grid(store, 'X')
+            if max_time is not None:
+                X, Y, bounds = _drop_cycles_after(
+                    X, Y, bounds, grid.slice(None, max_time).stop,
+                    x_columns, y_feature_subset)
+            return A, X, Y, bounds, grid, lane_list
+
+    x_read = list(x_feature_subset)
+    if 'green' not in x_read:
+        x_read.append('green')
+    # per-cycle features are aggregated from the unmasked series
+    A, X, Y, grid, lane_list = _read_arrays_from_file(
+        filename, A_name_list, x_read, y_feature_subset, [], 'end', max_time)
+    X_cycle, Y_cycle, bounds = aggregate_cycles(
+        X[:, :, :len(x_feature_subset)], Y, X[:, :, x_read.index('green')],
+        x_feature_subset, y_feature_subset, per_cycle_features, aggregations,
+        histogram_bins, grid.freq)
+    return A, X_cycle, Y_cycle, bounds, grid, lane_list
+
+
+def _stored_cycles_match(store, x_columns, y_feature_subset,
+                         per_cycle_features, histogram_bins):
+    if '/' + X_CYCLE_KEY not in store.keys():
+        return False
+    info = get_storer_cycle_info(store, X_CYCLE_KEY)
+    if info is None or not cycle_info_matches(info, y_feature_subset,
+                                              per_cycle_features,
+                                              histogram_bins):
+        return False
+    stored_x = get_storer_codecs(store, X_CYCLE_KEY)
+    stored_y = get_storer_codecs(store, Y_CYCLE_KEY)
+    return (all(col in stored_x for col in x_columns)
+            and all(feat in stored_y for feat in y_feature_subset))
+
+
+def _drop_cycles_after(X, Y, bounds, num_timesteps, x_columns, y_features):
+    """Pad out cycles that end at or after timestep `num_timesteps`"""
+    dropped = bounds[:, :, 1] >= num_timesteps
+    X[dropped] = [get_pad_value_for_feature(col) for col in x_columns]
+    Y[dropped] = [get_pad_value_for_feature(feat) for feat in y_features]
+    bounds[dropped] = -1
+    num_cycles = int((bounds[:, :, 1] >= 0).sum(1).max(initial=0))
+    return X[:, :num_cycles], Y[:, :num_cycles], bounds[:, :num_cycles]
+
+
+def _read_A_for_store(store, filename):
+    """Lane list and dict of adjacency arrays for a preprocessed file.
+
+    Newer files reference an adjacency file shared across simulations,
+    which is read once per process. Older files hold a dense 'A' table.
+    """
+    A_filename, A_hash = adjacency_ref(store, filename)
+    if A_filename is not None:
+        return read_adjacency_file(A_filename, A_hash)
+
+    A_df = store['A']
+    A_dict = {A_name: A_df[A_name].values
+              for A_name in A_df.columns.get_level_values(0).unique()}
+    return A_df.index, A_dict
+
+
+class WindowSampler(object):
+    """Time windows of one preprocessed file, drawn from arrays in memory.
 
+    The file is read once. Its `TimeGrid` maps window start times to row
+    offsets, so every window is a slice of the arrays and costs O(window)
+    to draw, wherever it starts. Windows are `window_size` time units long
+    and are yielded as (A, X, Y, t, lanes) with X and Y (time, lane,
+    feature).
 
-def get_pad_value_for_feature(feature):
-    return pad_value_for_feature[feature]
+    :param A: (depth, lanes, lanes) adjacency
+    :param X: (time, lanes, feature) array
+    :param Y: (time, lanes, feature) array
+    :param grid: TimeGrid of the time axis
+    """
+    def __init__(self, A, X, Y, grid, lanes, window_size,
+                 repeat_A_over_time=True):
+        self.A = np.expand_dims(A, 0)
+        self.X = X
+        self.Y = Y
+        self.grid = grid
+        self.times = grid.times()
+        self.lanes = lanes
+        self.window_size = window_size
+        self.repeat_A_over_time = repeat_A_over_time
+
+    @classmethod
+    def from_file(cls,
+                  filename,
+                  window_size,
+                  repeat_A_over_time=True,
+                  A_name_list=['A_downstream',
+                               'A_upstream',
+                               'A_neighbors'],
+                  x_feature_subset=x_feature_subset_default,
+                  y_feature_subset=y_feature_subset_default,
+                  per_cycle_features=per_cycle_features_default,
+                  when_per_cycle='end',
+                  max_time=None):
+        A_name_list, x_feature_subset, y_feature_subset = map(
+            string_list_decode,
+            [A_name_list, x_feature_subset, y_feature_subset])
+        A, X, Y, grid, lanes = _read_arrays_from_file(
+            filename, A_name_list, x_feature_subset, y_feature_subset,
+            per_cycle_features, when_per_cycle, max_time)
+        return cls(A, X.transpose((1, 0, 2)), Y.transpose((1, 0, 2)), grid,
+                   lanes, window_size, repeat_A_over_time)
+
+    @property
+    def window_rows(self):
+        """Number of grid rows in a window that starts on the grid"""
+        return int(np.floor((self.window_size - 1) / self.grid.freq
+                            + 1e-6)) + 1
+
+    def at(self, t_begin):
+        """The window of times in [t_begin, t_begin + window_size)"""
+        return self._window(
+            self.grid.slice(t_begin, t_begin + self.window_size - 1))
+
+    def at_offset(self, start):
+        """The window starting at grid row `start`"""
+        return self._window(slice(start, min(start + self.window_rows,
+                                             len(self.grid))))
+
+    def sequential(self, t_begin=0):
+        """Consecutive windows from `t_begin` on, for stateful models"""
+        while True:
+            window = self.at(t_begin)
+            if len(window[1]) == 0:
+                return
+            yield window
+            t_begin += self.window_size
+
+    def start_offsets(self, stride=1):
+        """Grid rows where a full window can start, every `stride` rows"""
+        return np.arange(0, len(self.grid) - self.window_rows + 1, stride)
+
+    def random(self, num_windows, stride=1, replace=True,
+               random_state=np.random):
+        """`num_windows` full windows at random starts.
+
+        :param stride: Windows start on multiples of this many rows
+        :param replace: If False, no start is drawn twice (so at most
+        `len(start_offsets(stride))` windows are drawn)
+        """
+        starts = self.start_offsets(stride)
+        if len(starts) == 0:
+            return
+        if not replace:
+            num_windows = min(num_windows, len(starts))
+        for start in random_state.choice(starts, num_windows,
+                                         replace=replace):
+            yield self.at_offset(start)
+
+    def _window(self, rows):
+        X = self.X[rows]
+        if self.repeat_A_over_time:
+            A = np.repeat(self.A, len(X), axis=0)
+        else:
+            A = self.A
+        return A, X, self.Y[rows], self.times[rows], self.lanes
+
+
+def generator_prefetch_all_from_file(
+    filename,
+    chunk_size=None,
+    repeat_A_over_time=True,
+    A_name_list=['A_downstream',
+                 'A_upstream',
+                 'A_neighbors'],
+    x_feature_subset=x_feature_subset_default,
+    y_feature_subset=y_feature_subset_default,
+    per_cycle_features=per_cycle_features_default,
+    num_random_windows=None,
+    window_stride=1):
+    """Yield windows of `chunk_size` time units of a file.
+
+    :param num_random_windows: If given, yield this many windows at random
+    starts on multiples of `window_stride` grid rows instead of consecutive
+    windows (see `WindowSampler`)
+    """
+    if chunk_size is None:
+        return
+    sampler = WindowSampler.from_file(
+        filename, chunk_size, repeat_A_over_time, A_name_list,
+        x_feature_subset, y_feature_subset, per_cycle_features)
+    if num_random_windows is None:
+        yield from sampler.sequential()
+    else:
+        yield from sampler.random(num_random_windows, window_stride)
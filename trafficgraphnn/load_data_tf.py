@@ -5,18 +5,89 @@ import numpy as np
 import tensorflow as tf
 
 from keras import backend as K
-from trafficgraphnn.load_data import (pad_value_for_feature,
+from trafficgraphnn.bucketing import (bucketed_file_order, effective_shape,
+                                      padding_efficiency)
+from trafficgraphnn.load_data import (cycle_aggregations_default,
+                                      cycle_feature_names,
+                                      get_pad_value_for_feature,
+                                      pad_value_for_feature,
                                       per_cycle_features_default,
-                                      read_from_file,
+                                      read_cycles_from_file, read_from_file,
                                       windowed_unpadded_batch_of_generators,
                                       x_feature_subset_default,
                                       y_feature_subset_default)
-from trafficgraphnn.preprocessing.io import get_preprocessed_filenames
+from trafficgraphnn.preprocessing.manifest import (DatasetManifest,
+                                                   assign_splits,
+                                                   entry_from_file)
+from trafficgraphnn.sample_cache import SampleCache
+from trafficgraphnn.tfrecords import export_tfrecords, parse_example
 from trafficgraphnn.utils import get_num_cpus, iterfy
 
 _logger = logging.getLogger(__name__)
 
 
+def files_from_manifests(filenames_or_dirs, val_proportion=.1,
+                         test_proportion=.1):
+    """Manifest entries of preprocessed files and directories.
+
+    Each directory's manifest is synced with its files and splits are
+    assigned to files that have none, in proportion to all files of the
+    directory. Files keep their split across calls. Files that are listed
+    individually are split in proportion to the listed files instead, and
+    files the manifest does not cover (e.g. not named like preprocessed
+    files) get entries read from the file.
+
+    Manifests of directories that are not writable are used without being
+    saved.
+
+    :return: Dict of filename to manifest entry
+    :rtype: dict
+    """
+    wanted = {}
+    for entry in iterfy(filenames_or_dirs):
+        if os.path.isfile(entry):
+            directory = os.path.dirname(os.path.abspath(entry))
+            names = wanted.setdefault(directory, set())
+            if names is not None:
+                names.add(os.path.basename(entry))
+        elif os.path.isdir(entry):
+            wanted[os.path.abspath(entry)] = None # all files
+
+    file_info = {}
+    listed_info = {}
+    for directory, names in wanted.items():
+        manifest = _synced_manifest(directory, val_proportion,
+                                    test_proportion)
+        if names is None:
+            file_info.update((os.path.join(directory, name), entry)
+                             for name, entry in manifest.entries.items())
+            continue
+        for name in names:
+            filename = os.path.join(directory, name)
+            entry = manifest.entries.get(name)
+            if entry is None:
+                entry = entry_from_file(filename)
+            listed_info[filename] = dict(entry, split=None)
+
+    assign_splits(listed_info, val_proportion, test_proportion)
+    file_info.update(listed_info)
+    return file_info
+
+
+def _synced_manifest(directory, val_proportion, test_proportion):
+    try:
+        with DatasetManifest.locked(directory) as manifest:
+            manifest.sync()
+            manifest.assign_splits(val_proportion, test_proportion)
+    except OSError:
+        _logger.warning('Could not update the manifest of %s, using an '
+                        'unsaved one', directory, exc_info=True)
+        manifest = DatasetManifest.load(directory)
+        manifest.sync()
+        manifest.assign_splits(val_proportion, test_proportion)
+    return manifest
+
+
 class TFBatch(object):
     def __init__(self, filenames, filename_ph, initializer):
         self.filenames = filenames
@@ -61,20 +132,46 @@ def make_dataset_fast(filename_ph,
                       average_interval=None,
                       num_parallel_calls=None,
                       max_time=None,
-                      gpu_prefetch=True):
+                      gpu_prefetch=True,
+                      sample_cache=None):
+    """
+    :param average_interval: Average over blocks of this many timesteps
+    when reading each file, from the file's precomputed level if it has one
+    :param sample_cache: Optional `SampleCache` that keeps each file's
+    arrays across epochs
+    """
 
     if num_parallel_calls is None:
         num_parallel_calls = get_num_cpus()
 
     dataset = tf.data.Dataset.from_tensor_slices(filename_ph)
 
+    cache_params = {'A_name_list': A_name_list,
+                    'x_feature_subset': x_feature_subset,
+                    'y_feature_subset': y_feature_subset,
+                    'per_cycle_features': per_cycle_features,
+                    'max_time': max_time,
+                    'average_interval': average_interval}
+
+    def _load(filename):
+        A, X, Y, t, lanes = read_from_file(filename,
+                                           repeat_A_over_time=False,
+                                           A_name_list=A_name_list,
+                                           x_feature_subset=x_feature_subset,
+                                           y_feature_subset=y_feature_subset,
+                                           per_cycle_features=per_cycle_features,
+                                           max_time=max_time,
+                                           return_t_and_lanenames=True,
+                                           average_interval=average_interval)
+        return A, X, Y, t, np.char.encode(np.asarray(lanes, dtype=str))
+
     def _read(filename):
-        out = read_from_file(filename,
-                             A_name_list=A_name_list,
-                             x_feature_subset=x_feature_subset,
-                             y_feature_subset=y_feature_subset,
-                             max_time=max_time,
-                             return_t_and_lanenames=True)
+        if isinstance(filename, bytes):
+            filename = filename.decode()
+        if sample_cache is None:
+            out = _load(filename)
+        else:
+            out = sample_cache.get_or_load(filename, cache_params, _load)
         return (*out, filename)
 
     dataset = dataset.map(lambda filename: tf.py_func(
@@ -82,6 +179,8 @@ def make_dataset_fast(filename_ph,
         [tf.bool, tf.float32, tf.float32, tf.float32, tf.string, tf.string]))
 
     def split_for_pad(A, X, Y, t, lanes, filename):
+        # A is read once per file and repeated over time here
+        A = tf.tile(A, [tf.shape(t)[0], 1, 1, 1])
         X = tf.unstack(X, len(x_feature_subset), axis=-1)
         Y = tf.unstack(Y, len(y_feature_subset), axis=-1)
         return (A,
@@ -91,8 +190,144 @@ def make_dataset_fast(filename_ph,
 
     dataset = dataset.map(split_for_pad, num_parallel_calls)
 
-    xpad =  {x: pad_value_for_feature[x] for x in x_feature_subset}
-    ypad =  {y: pad_value_for_feature[y] for y in y_feature_subset}
+    # already averaged when read
+    return _pad_and_batch_per_file(dataset, batch_size, x_feature_subset,
+                                   y_feature_subset, per_cycle_features,
+                                   None, num_parallel_calls, gpu_prefetch)
+
+
+def make_dataset_tfrecord(filename_ph,
+                          batch_size,
+                          A_name_list=['A_downstream',
+                                       'A_upstream',
+                                       'A_neighbors'],
+                          x_feature_subset=x_feature_subset_default,
+                          y_feature_subset=y_feature_subset_default,
+                          per_cycle_features=per_cycle_features_default,
+                          average_interval=None,
+                          num_parallel_calls=None,
+                          max_time=None,
+                          gpu_prefetch=True,
+                          compression_type=None):
+    """Same batches as `make_dataset_fast`, read from TFRecord shards.
+
+    :param filename_ph: Placeholder of shard filenames (see
+    `tfrecords.export_tfrecords`). Each shard is one file of the batch
+    """
+    if num_parallel_calls is None:
+        num_parallel_calls = get_num_cpus()
+
+    dataset = tf.data.Dataset.from_tensor_slices(filename_ph)
+    # one record per shard, so a deterministic interleave keeps file order
+    dataset = dataset.apply(tf.data.experimental.parallel_interleave(
+        lambda filename: tf.data.TFRecordDataset(
+            filename, compression_type=compression_type or ''),
+        cycle_length=num_parallel_calls))
+
+    dataset = dataset.map(
+        lambda serialized: parse_example(serialized,
+                                         len(A_name_list),
+                                         len(x_feature_subset),
+                                         len(y_feature_subset),
+                                         max_time=max_time),
+        num_parallel_calls)
+
+    dataset = dataset.map(
+        lambda A, X, Y, t, lanes, filename: split_for_pad(
+            A, X, Y, t, lanes, filename,
+            x_feature_subset=x_feature_subset,
+            y_feature_subset=y_feature_subset),
+        num_parallel_calls)
+
+    return _pad_and_batch_per_file(dataset, batch_size, x_feature_subset,
+                                   y_feature_subset, per_cycle_features,
+                                   average_interval, num_parallel_calls,
+                                   gpu_prefetch)
+
+
+def make_dataset_cycles(filename_ph,
+                        batch_size,
+                        A_name_list=['A_downstream',
+                                     'A_upstream',
+                                     'A_neighbors'],
+                        x_feature_subset=x_feature_subset_default,
+                        y_feature_subset=y_feature_subset_default,
+                        per_cycle_features=per_cycle_features_default,
+                        aggregations=cycle_aggregations_default,
+                        histogram_bins=None,
+                        num_parallel_calls=None,
+                        max_time=None,
+                        gpu_prefetch=True,
+                        sample_cache=None):
+    """Batches of files read with one step per light cycle.
+
+    X has the columns of `cycle_feature_names` and t holds cycle numbers
+    (see `load_data.read_cycles_from_file`).
+    """
+    if num_parallel_calls is None:
+        num_parallel_calls = get_num_cpus()
+
+    x_columns = cycle_feature_names(x_feature_subset, aggregations,
+                                    histogram_bins)
+
+    dataset = tf.data.Dataset.from_tensor_slices(filename_ph)
+
+    cache_params = {'cycles': True,
+                    'A_name_list': A_name_list,
+                    'x_feature_subset': x_feature_subset,
+                    'y_feature_subset': y_feature_subset,
+                    'per_cycle_features': per_cycle_features,
+                    'aggregations': aggregations,
+                    'histogram_bins': histogram_bins,
+                    'max_time': max_time}
+
+    def _load(filename):
+        A, X, Y, _, lanes = read_cycles_from_file(
+            filename,
+            repeat_A_over_cycles=False,
+            A_name_list=A_name_list,
+            x_feature_subset=x_feature_subset,
+            y_feature_subset=y_feature_subset,
+            per_cycle_features=per_cycle_features,
+            aggregations=aggregations,
+            histogram_bins=histogram_bins,
+            max_time=max_time,
+            return_t_and_lanenames=True)
+        cycles = np.arange(X.shape[0], dtype=np.float32)
+        return A, X, Y, cycles, np.char.encode(np.asarray(lanes, dtype=str))
+
+    def _read(filename):
+        if isinstance(filename, bytes):
+            filename = filename.decode()
+        if sample_cache is None:
+            out = _load(filename)
+        else:
+            out = sample_cache.get_or_load(filename, cache_params, _load)
+        return (*out, filename)
+
+    dataset = dataset.map(lambda filename: tf.py_func(
+        _read, [filename],
+        [tf.bool, tf.float32, tf.float32, tf.float32, tf.string, tf.string]))
+
+    def _split(A, X, Y, t, lanes, filename):
+        A = tf.tile(A, [tf.shape(t)[0], 1, 1, 1])
+        return split_for_pad(A, X, Y, t, lanes, filename,
+                             x_feature_subset=x_columns,
+                             y_feature_subset=y_feature_subset)
+
+    dataset = dataset.map(_split, num_parallel_calls)
+
+    return _pad_and_batch_per_file(dataset, batch_size, x_columns,
+                                   y_feature_subset, per_cycle_features,
+                                   None, num_parallel_calls, gpu_prefetch)
+
+
+def _pad_and_batch_per_file(dataset, batch_size, x_feature_subset,
+                            y_feature_subset, per_cycle_features,
+                            average_interval, num_parallel_calls,
+                            gpu_prefetch):
+    xpad =  {x: get_pad_value_for_feature(x) for x in x_feature_subset}
+    ypad =  {y: get_pad_value_for_feature(y) for y in y_feature_subset}
 
     if average_interval is not None and average_interval > 1:
         dataset = dataset.map(
@@ -286,16 +521,71 @@ class TFBatcher(object):
                  per_cycle_features=per_cycle_features_default,
                  flatten_A=False,
                  max_time=None,
-                 gpu_prefetch=True):
-
-        filenames_or_dirs = iterfy(filenames_or_dirs)
-        filenames = []
-        for entry in filenames_or_dirs:
-            if os.path.isfile(entry):
-                filenames.append(entry)
-            elif os.path.isdir(entry):
-                filenames.extend(get_preprocessed_filenames(entry))
-        filenames.sort()
+                 gpu_prefetch=True,
+                 bucket_by_shape=False,
+                 lane_bucket_boundaries=None,
+                 time_bucket_boundaries=None,
+                 backend='hdf',
+                 tfrecord_dir=None,
+                 tfrecord_compression=None,
+                 cache=False,
+                 cache_max_bytes=None,
+                 cache_dir=None,
+                 cycle_level=False,
+                 cycle_aggregations=cycle_aggregations_default,
+                 histogram_bins=None):
+        """
+        :param bucket_by_shape: If True, batch files of similar (lanes,
+        timesteps) together to reduce padding
+        :param lane_bucket_boundaries: Lane count bucket edges, defaults to
+        one bucket per distinct lane count
+        :param time_bucket_boundaries: Timestep bucket edges (after
+        `max_time` and `average_interval`), defaults to one bucket per
+        distinct length
+        :param backend: 'hdf' to read the preprocessed files through
+        `tf.py_func`, or 'tfrecord' to read TFRecord copies of them with
+        native ops. Missing or outdated copies are written on construction
+        :param tfrecord_dir: Directory of the TFRecord copies, defaults to a
+        `tfrecord` directory next to each preprocessed file
+        :param tfrecord_compression: None, 'ZLIB' or 'GZIP'
+        :param cache: If True, keep the arrays read from each file across
+        epochs (hdf backend without sub_batching only)
+        :param cache_max_bytes: Memory budget of the cache, None for no limit
+        :param cache_dir: Optional directory for on-disk snapshots of the
+        cache, which are reused by later runs
+        :param cycle_level: If True, read files with one step per light
+        cycle of each lane (hdf backend without sub_batching only). X then
+        has the columns in `x_columns` and `average_interval` is ignored.
+        The manifests only know timestep counts, so this cannot be combined
+        with `bucket_by_shape` and no `padding_stats` are kept
+        :param cycle_aggregations: Aggregations of the cycle-level X
+        :param histogram_bins: Optional dict of X feature to bin edges of
+        cycle-level histograms
+        """
+        if backend not in ('hdf', 'tfrecord'):
+            raise ValueError('backend must be `hdf` or `tfrecord`')
+        if backend == 'tfrecord' and sub_batching:
+            raise ValueError('The tfrecord backend does not support '
+                             'sub_batching')
+        if cache and (backend != 'hdf' or sub_batching):
+            raise ValueError('cache is only supported by the hdf backend '
+                             'without sub_batching')
+        if cycle_level and (backend != 'hdf' or sub_batching):
+            raise ValueError('cycle_level is only supported by the hdf '
+                             'backend without sub_batching')
+        if cycle_level and bucket_by_shape:
+            raise ValueError('bucket_by_shape is not supported with '
+                             'cycle_level')
+        self.file_info = files_from_manifests(filenames_or_dirs,
+                                              val_proportion,
+                                              test_proportion)
+        self.file_shapes = {
+            f: effective_shape(entry, max_time, average_interval)
+            for f, entry in self.file_info.items()}
+        self.bucket_by_shape = bucket_by_shape
+        self.lane_bucket_boundaries = lane_bucket_boundaries
+        self.time_bucket_boundaries = time_bucket_boundaries
+        self.padding_stats = []
         self.batch_size = batch_size
         self.window_size = window_size
         self.average_interval = average_interval
@@ -307,17 +597,60 @@ class TFBatcher(object):
         self.y_feature_subset = y_feature_subset
         self.per_cycle_features = per_cycle_features
         self.flat_A = flatten_A
+        self.cycle_level = cycle_level
+        if cycle_level:
+            self.x_columns = cycle_feature_names(
+                x_feature_subset, cycle_aggregations, histogram_bins)
+        else:
+            self.x_columns = list(x_feature_subset)
 
-        num_validation = int(len(filenames) * val_proportion)
-        num_test = int(len(filenames) * test_proportion)
-
-        self.train_files = filenames[:-(num_validation+num_test)]
-        self.val_files = filenames[-(num_validation+num_test):-num_test]
-        self.test_files = filenames[-num_test:]
+        self.train_files, self.val_files, self.test_files = [
+            sorted(f for f, entry in self.file_info.items()
+                   if entry['split'] == split)
+            for split in ['train', 'val', 'test']]
 
+        self.backend = backend
+        if cache:
+            self.sample_cache = SampleCache(cache_max_bytes, cache_dir)
+        else:
+            self.sample_cache = None
         self.filename_ph = tf.placeholder(tf.string, [None], 'filenames')
 
-        if sub_batching:
+        if backend == 'tfrecord':
+            filenames = sorted(self.file_info)
+            shards = export_tfrecords(filenames,
+                                      tfrecord_dir,
+                                      A_name_list,
+                                      x_feature_subset,
+                                      y_feature_subset,
+                                      per_cycle_features,
+                                      compression_type=tfrecord_compression)
+            self.tfrecord_files = dict(zip(filenames, shards))
+            self._tf_dataset = make_dataset_tfrecord(
+                self.filename_ph,
+                batch_size,
+                A_name_list,
+                x_feature_subset,
+                y_feature_subset,
+                per_cycle_features,
+                average_interval,
+                max_time=max_time,
+                gpu_prefetch=gpu_prefetch,
+                compression_type=tfrecord_compression)
+        elif cycle_level:
+            self._tf_dataset = make_dataset_cycles(
+                self.filename_ph,
+                batch_size,
+                A_name_list,
+                x_feature_subset,
+                y_feature_subset,
+                per_cycle_features,
+                cycle_aggregations,
+                histogram_bins,
+                max_time=max_time,
+                gpu_prefetch=gpu_prefetch,
+                sample_cache=self.sample_cache)
+        elif sub_batching:
             self._tf_dataset = make_dataset(self.filename_ph,
                                             batch_size,
                                             window_size,
@@ -336,21 +669,30 @@ class TFBatcher(object):
                                                  per_cycle_features,
                                                  average_interval,
                                                  max_time=max_time,
-                                                 gpu_prefetch=gpu_prefetch)
+                                                 gpu_prefetch=gpu_prefetch,
+                                                 sample_cache=self.sample_cache)
 
         self.init_initializable_iterator()
         self._make_batches()
 
     def _make_batches(self):
+        if self.bucket_by_shape:
+            self.val_files = self._bucketed_order(self.val_files, False)
+            self.test_files = self._bucketed_order(self.test_files, False)
         self.train_file_batches = self._split_batches(self.train_files)
         self.val_file_batches = self._split_batches(self.val_files)
         self.test_file_batches = self._split_batches(self.test_files)
 
-        self.val_batches = [TFBatch(files, self.filename_ph, self.init_op)
+        self.val_batches = [self._tf_batch(files)
                             for files in self.val_file_batches]
-        self.test_batches = [TFBatch(files, self.filename_ph, self.init_op)
+        self.test_batches = [self._tf_batch(files)
                                 for files in self.test_file_batches]
 
+    def _tf_batch(self, files):
+        if self.backend == 'tfrecord':
+            files = [self.tfrecord_files[f] for f in files]
+        return TFBatch(files, self.filename_ph, self.init_op)
+
     def _split_batches(self, filename_list):
         if self.sub_batching:
             return [filename_list[i:i+self.batch_size] for i
@@ -358,16 +700,38 @@ class TFBatcher(object):
         else:
             return [filename_list]
 
+    def _bucketed_order(self, files, shuffle):
+        return bucketed_file_order(
+            {f: self.file_shapes[f] for f in files}, self.batch_size,
+            self.lane_bucket_boundaries, self.time_bucket_boundaries,
+            shuffle=shuffle)
+
     def shuffle(self):
-        np.random.shuffle(self.train_files)
+        if self.bucket_by_shape:
+            self.train_files = self._bucketed_order(self.train_files, True)
+        else:
+            np.random.shuffle(self.train_files)
 
     def init_epoch(self):
         if self.shuffle_on_epoch:
             self.shuffle()
+        elif self.bucket_by_shape:
+            self.train_files = self._bucketed_order(self.train_files, False)
         self.train_file_batches = self._split_batches(self.train_files)
-        self.train_batches = [TFBatch(files, self.filename_ph, self.init_op)
+        self.train_batches = [self._tf_batch(files)
                               for files in self.train_file_batches]
 
+        if not self.cycle_level:
+            # file_shapes count timesteps, not cycles
+            stats = padding_efficiency(self.train_files, self.file_shapes,
+                                       self.batch_size)
+            self.padding_stats.append(stats)
+            _logger.info('Epoch %d: %d batches, %.1f%% of lane-timesteps '
+                         'are data', len(self.padding_stats),
+                         stats['num_batches'], 100 * stats['efficiency'])
+        if self.sample_cache is not None:
+            _logger.info('Sample cache: %s', self.sample_cache.stats())
+
     def init_initializable_iterator(self):
         self.iterator = self._tf_dataset.make_initializable_iterator()
         self.init_op = self.iterator.initializer
@@ -0,0 +1,208 @@
+"""Process-wide cache of parsed SUMO networks.
+
+Parsing a .net.xml with sumolib takes seconds on large networks, and the
+same file is read by the network wrapper, the graph builders, the config
+generators and every worker process. `read_net` parses a file once per
+process. The lane graph and tls maps derived from the net are also pickled
+next to the .net.xml, so later processes that only need those load them
+instead of parsing. The sumolib net itself is not pickled: it holds
+lambdas in newer sumolib versions.
+
+The returned objects are shared: callers must copy before modifying them.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import threading
+
+import networkx as nx
+from sumolib.net import readNet
+
+_logger = logging.getLogger(__name__)
+
+_CACHE_VERSION = 2
+
+# (realpath, mtime, size) -> ParsedNet
+_memory_cache = {}
+_lock = threading.Lock()
+
+
+class ParsedNet(object):
+    """A parsed network and the data derived from it.
+
+    :ivar net: The sumolib net, parsed on first access if this was loaded
+    from the disk cache
+    :ivar lane_graph: Directed lane graph with lane lengths and connection
+    directions/tls ids, without detector info
+    :ivar tls_to_edges: Dict of tls id to list of (from lane, to lane)
+    """
+    def __init__(self, netfile, sha1, lane_graph, tls_to_edges, net=None):
+        self.netfile = netfile
+        self.sha1 = sha1
+        self.lane_graph = lane_graph
+        self.tls_to_edges = tls_to_edges
+        self._net = net
+        self._net_lock = threading.Lock()
+
+    @property
+    def net(self):
+        with self._net_lock:
+            if self._net is None:
+                _logger.debug('Parsing network file %s', self.netfile)
+                self._net = readNet(self.netfile)
+            return self._net
+
+    def __getstate__(self):
+        # the net is parsed again where it is needed
+        return {'netfile': self.netfile, 'sha1': self.sha1,
+                'lane_graph': self.lane_graph,
+                'tls_to_edges': self.tls_to_edges}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+def read_net(netfile):
+    """Drop-in for `sumolib.net.readNet` that uses the cache"""
+    return get_parsed_net(netfile).net
+
+
+def get_parsed_net(netfile, use_disk_cache=True):
+    """Return the cached parse of `netfile`, parsing it if needed.
+
+    The in-memory cache is keyed by path, mtime and size. The on-disk cache
+    stores the sha1 of the file contents and is only used if it matches.
+    """
+    key = _file_key(netfile)
+    with _lock:
+        if key in _memory_cache:
+            return _memory_cache[key]
+
+        sha1 = _file_sha1(netfile)
+        parsed = None
+        if use_disk_cache:
+            parsed = _load_disk_cache(netfile, sha1)
+        if parsed is None:
+            parsed = _parse(netfile, sha1)
+            if use_disk_cache:
+                _write_disk_cache(parsed)
+
+        _memory_cache[key] = parsed
+        return parsed
+
+
+def clear_cache(netfile=None, remove_disk_cache=False):
+    """Clear the memory cache for `netfile` (or every file)"""
+    with _lock:
+        if netfile is None:
+            _memory_cache.clear()
+        else:
+            path = os.path.realpath(netfile)
+            for key in [k for k in _memory_cache if k[0] == path]:
+                del _memory_cache[key]
+    if remove_disk_cache and netfile is not None:
+        try:
+            os.remove(disk_cache_filename(netfile))
+        except FileNotFoundError:
+            pass
+
+
+def disk_cache_filename(netfile):
+    return os.path.splitext(netfile)[0] + '.pkl'
+
+
+def _file_key(netfile):
+    stat = os.stat(netfile)
+    return os.path.realpath(netfile), stat.st_mtime, stat.st_size
+
+
+def _file_sha1(netfile, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(netfile, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _parse(netfile, sha1):
+    _logger.debug('Parsing network file %s', netfile)
+    net = readNet(netfile)
+    lane_graph, tls_to_edges = build_lane_graph(net)
+    return ParsedNet(netfile, sha1, lane_graph, tls_to_edges, net)
+
+
+def build_lane_graph(net):
+    """Build the directed lane graph of a sumolib net.
+
+    :return: The graph and a dict of tls id to its (from lane, to lane) pairs
+    """
+    graph = nx.DiGraph()
+
+    for edge in net.getEdges():
+        for lane in edge.getLanes():
+            graph.add_node(lane.getID(), length=lane.getLength())
+
+    tls_to_edges = {}
+
+    for node in net.getNodes():
+        for conn in node.getConnections():
+            tls_id = conn.getTLSID()
+            if tls_id not in tls_to_edges:
+                tls_to_edges[tls_id] = []
+            edge_from_to = (conn.getFromLane().getID(),
+                            conn.getToLane().getID())
+            graph.add_edge(
+                *edge_from_to,
+                direction=conn.getDirection(),
+                tls=tls_id)
+            tls_to_edges[tls_id].append(edge_from_to)
+
+    # sanity check
+    tls_to_edges_2 = {
+        tl.getID():
+        [tuple([lane.getID() for lane in conn[:-1]]) for conn in tl.getConnections()]
+        for tl in net.getTrafficLights()
+    }
+
+    assert tls_to_edges == tls_to_edges_2
+
+    return graph, tls_to_edges
+
+
+def _load_disk_cache(netfile, sha1):
+    filename = disk_cache_filename(netfile)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            version, cached_sha1 = pickle.load(f)
+            if version != _CACHE_VERSION or cached_sha1 != sha1:
+                _logger.debug('Stale network cache %s', filename)
+                return None
+            parsed = pickle.load(f)
+    except Exception: # a corrupt cache is just a cache miss
+        _logger.warning('Could not load network cache %s', filename,
+                        exc_info=True)
+        return None
+    parsed.netfile = netfile
+    _logger.debug('Loaded network cache %s', filename)
+    return parsed
+
+
+def _write_disk_cache(parsed):
+    filename = disk_cache_filename(parsed.netfile)
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmp_filename, 'wb') as f:
+            # header first so staleness checks don't unpickle the graph
+            pickle.dump((_CACHE_VERSION, parsed.sha1), f)
+            pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+    except Exception: # a missing cache is just a cache miss
+        _logger.warning('Could not write network cache %s', filename,
+                        exc_info=True)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
@@ -4,6 +4,7 @@ from keras.layers import (RNN, Dense, Dropout, GRUCell, InputSpec, Lambda,
 from trafficgraphnn.layers import (BatchGraphAttention,
                                    BatchMultigraphAttention,
                                    DenseCausalAttention, LayerNormalization,
+                                   SegmentMultigraphAttention,
                                    TimeDistributedMultiInput)
 from trafficgraphnn.layers.modified_thirdparty import BatchGraphConvolution
 from trafficgraphnn.utils import broadcast_lists, iterfy
@@ -122,7 +123,14 @@ def gat_encoder(X_tensor, A_tensor, attn_dims, num_heads,
                 gat_highway_connection=True,
                 layer_norm=False,
                 gat_activation='relu', dense_dim=None,
-                residual_connection=False):
+                residual_connection=False, num_edge_types=None):
+    """Stack of multigraph attention layers.
+
+    :param num_edge_types: If given, `A_tensor` is the edge list of a
+    disjoint union batch (see `load_data.disjoint_union_batch`) with this
+    many edge types instead of dense (batch, time, depth, lanes, lanes)
+    adjacency
+    """
     attn_dims, num_heads, dropout_rate, attn_dropout_rate, attn_reduction = map(
         iterfy, [attn_dims, num_heads, dropout_rate, attn_dropout_rate,
                  attn_reduction])
@@ -139,14 +147,24 @@ def gat_encoder(X_tensor, A_tensor, attn_dims, num_heads,
             attn_dropout_rate,
             attn_reduction)):
         out = TimeDistributed(Dropout(drop), name='dropout_{}'.format(i))(X)
-        out = TimeDistributedMultiInput(
-            BatchMultigraphAttention(dim,
-                                     attn_heads=head,
-                                     attn_heads_reduction=reduct,
-                                     attn_dropout=attndrop,
-                                     activation=gat_activation,
-                                     highway_connection=gat_highway_connection
-                                     ), name='GAT_{}'.format(i))([X, A_tensor])
+        if num_edge_types is None:
+            out = TimeDistributedMultiInput(
+                BatchMultigraphAttention(dim,
+                                         attn_heads=head,
+                                         attn_heads_reduction=reduct,
+                                         attn_dropout=attndrop,
+                                         activation=gat_activation,
+                                         highway_connection=gat_highway_connection
+                                         ), name='GAT_{}'.format(i))([X, A_tensor])
+        else:
+            out = SegmentMultigraphAttention(
+                dim, num_edge_types,
+                attn_heads=head,
+                attn_heads_reduction=reduct,
+                attn_dropout=attndrop,
+                activation=gat_activation,
+                highway_connection=gat_highway_connection,
+                name='GAT_{}'.format(i))([X, A_tensor])
         if residual_connection: # in transformer, res connection done here (eg on concatted heads)
             X = X + out
         else:
@@ -0,0 +1,101 @@
+"""Compact storage of preprocessed feature tables.
+
+Each column of an X or Y table is stored in the dtype given by
+`col_storage_codec` (e.g. occupancy as hundredths in uint16), and decoded
+straight into a float32 array on load. A column is only encoded if it
+decodes back to exactly its float32 values; otherwise it is stored as
+float32. The codec of every column is kept in the table's storer
+attributes.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+from trafficgraphnn.utils import col_storage_codec
+
+_logger = logging.getLogger(__name__)
+
+_ATTR_NAME = 'codecs'
+
+_float_codec = ('float32', 1)
+
+
+def encode_table(df):
+    """Encode each column of `df` with its storage codec.
+
+    :return: Encoded DataFrame and dict of column to (dtype, divisor)
+    :rtype: tuple
+    """
+    columns = {}
+    codecs = {}
+    for col in df.columns:
+        values = df[col].values
+        codec = col_storage_codec(col)
+        encoded = _encode_column(values, *codec)
+        if encoded is None:
+            codec = _float_codec
+            encoded = values.astype(np.float32)
+        columns[col] = encoded
+        codecs[col] = codec
+    return pd.DataFrame(columns, columns=df.columns), codecs
+
+
+def _encode_column(values, dtype, divisor):
+    if (dtype, divisor) == _float_codec or len(values) == 0:
+        return None
+    values = values.astype(np.float32)
+    if np.isnan(values).any():
+        return None
+    scaled = np.rint(values.astype(np.float64) * divisor)
+    info = np.iinfo(dtype)
+    if scaled.min() < info.min or scaled.max() > info.max:
+        _logger.debug('Values out of range of %s, storing as float32', dtype)
+        return None
+    encoded = scaled.astype(dtype)
+    if not np.array_equal(_decode_column(encoded, divisor), values):
+        _logger.debug('Values not exact in %s / %g, storing as float32',
+                      dtype, divisor)
+        return None
+    return encoded
+
+
+def _decode_column(encoded, divisor, out=None):
+    if out is None:
+        out = np.empty(len(encoded), dtype=np.float32)
+    if divisor == 1:
+        out[...] = encoded
+    else:
+        # divide in float64 and round once to float32, which matches
+        # parsing the decimal value and casting it
+        np.divide(encoded, divisor, out=out, casting='unsafe',
+                  dtype=np.float64)
+    return out
+
+
+def decode_table(df, columns, codecs, out=None):
+    """Decode columns of an encoded table into one float32 array.
+
+    :param codecs: Dict of column to (dtype, divisor); columns not in it
+    are taken as float32
+    :param out: (rows, len(columns)) float32 array to decode into
+    :rtype: numpy.ndarray
+    """
+    if out is None:
+        out = np.empty((len(df), len(columns)), dtype=np.float32)
+    for i, col in enumerate(columns):
+        _, divisor = codecs.get(col, _float_codec)
+        _decode_column(df[col].values, divisor, out[:, i])
+    return out
+
+
+def set_storer_codecs(store, key, codecs):
+    setattr(store.get_storer(key).attrs, _ATTR_NAME, codecs)
+
+
+def get_storer_codecs(store, key):
+    """Codecs stored with table `key`, or None for float tables"""
+    attrs = store.get_storer(key).attrs
+    if _ATTR_NAME not in attrs:
+        return None
+    return getattr(attrs, _ATTR_NAME)
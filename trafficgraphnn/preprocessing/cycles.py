@@ -0,0 +1,207 @@
+"""Stored cycle-level tables of preprocessed files.
+
+The per-cycle targets change once per signal cycle, so cycle-level models
+take one step per cycle of each lane instead of one per timestep.
+Preprocessing can store each lane's cycles aggregated (see
+`aggregate_cycles`) as tables `X_cycle` and
+`Y_cycle`, with the first and last timestep of each cycle in
+`cycle_bounds`. Rows are ordered by lane, then cycle, and lanes with fewer
+cycles are padded. The tables' `TimeGrid` counts cycles (t0 0, spacing 1).
+"""
+import logging
+
+import numpy as np
+
+from trafficgraphnn.preprocessing.features import (cycle_aggregations_default,
+                                                   get_pad_value_for_feature,
+                                                   per_cycle_features_default)
+
+_logger = logging.getLogger(__name__)
+
+X_CYCLE_KEY = 'X_cycle'
+Y_CYCLE_KEY = 'Y_cycle'
+BOUNDS_KEY = 'cycle_bounds'
+
+_ATTR_NAME = 'cycles'
+
+_cycle_aggregations = ['mean', 'max', 'min', 'sum']
+
+
+def cycle_info(per_cycle_features, histogram_bins=None):
+    """Settings the cycle tables were aggregated with"""
+    histogram_bins = histogram_bins or {}
+    return {'per_cycle_features': list(per_cycle_features),
+            'histogram_bins': {feat: [float(edge) for edge in edges]
+                               for feat, edges in histogram_bins.items()}}
+
+
+def cycle_info_matches(info, y_features, per_cycle_features,
+                       histogram_bins=None):
+    """Whether stored cycle tables aggregate the requested features the way
+    aggregating them at load time would"""
+    stored = set(info['per_cycle_features'])
+    requested = set(per_cycle_features)
+    if any((feat in stored) != (feat in requested) for feat in y_features):
+        return False
+    stored_bins = info['histogram_bins']
+    for feat, edges in (histogram_bins or {}).items():
+        if [float(edge) for edge in edges] != stored_bins.get(feat):
+            return False
+    return True
+
+
+def set_storer_cycle_info(store, key, info):
+    setattr(store.get_storer(key).attrs, _ATTR_NAME, info)
+
+
+def get_storer_cycle_info(store, key):
+    attrs = store.get_storer(key).attrs
+    if _ATTR_NAME not in attrs:
+        return None
+    return getattr(attrs, _ATTR_NAME)
+
+
+def mask_per_cycle_features(green, Y, feature_indices, pad_values,
+                            when_per_cycle):
+    """Keep only one value per light cycle of per-cycle Y features, in place.
+
+    A cycle runs from one red start to the next, inclusive. Its maximum is
+    put at its end (`when_per_cycle='end'`) or beginning ('begin') and every
+    other timestep is set to the pad value.
+
+    :param green: (lanes, time) green indicator array
+    :param Y: (lanes, time, feature) array
+    """
+    if len(feature_indices) == 0:
+        return
+    for lane in range(green.shape[0]):
+        red_starts = _red_starts(green[lane])
+        cycles = list(zip(red_starts[:-1], red_starts[1:]))
+        for i, pad_value in zip(feature_indices, pad_values):
+            series = Y[lane, :, i]
+            values = [series[begin:end + 1].max() for begin, end in cycles]
+            series[:] = pad_value
+            for (begin, end), value in zip(cycles, values):
+                series[end if when_per_cycle == 'end' else begin] = value
+
+
+def _red_starts(lane_green):
+    """Timesteps where a lane's light turns red, which bound its cycles"""
+    lane_green = lane_green > 0
+    if len(lane_green) == 0:
+        return np.zeros(0, dtype=np.int64)
+    phase_starts = np.flatnonzero(np.concatenate(
+        [[True], lane_green[1:] != lane_green[:-1]]))
+    return phase_starts[~lane_green[phase_starts]]
+
+
+def cycle_feature_names(x_feature_subset,
+                        aggregations=cycle_aggregations_default,
+                        histogram_bins=None):
+    """Columns of the cycle-level X of `x_feature_subset`.
+
+    Each feature gets a `{feature}/{aggregation}` column per aggregation,
+    and a `{feature}/hist{i}` column per bin if it has histogram bins.
+    `green` becomes `green/mean`, the green fraction of the cycle, and a
+    `cycle_length` column (in seconds) is added last.
+    """
+    histogram_bins = histogram_bins or {}
+    columns = []
+    for feat in x_feature_subset:
+        if feat == 'green':
+            columns.append('green/mean')
+            continue
+        columns.extend('{}/{}'.format(feat, agg) for agg in aggregations)
+        columns.extend('{}/hist{}'.format(feat, i)
+                       for i in range(len(histogram_bins.get(feat, [])) - 1))
+    columns.append('cycle_length')
+    return columns
+
+
+def aggregate_cycles(X, Y, green, x_feature_subset, y_feature_subset,
+                     per_cycle_features=per_cycle_features_default,
+                     aggregations=cycle_aggregations_default,
+                     histogram_bins=None,
+                     freq=1.):
+    """Aggregate (lanes, time, feature) X and Y over each lane's cycles.
+
+    A cycle runs from one red start of the lane to the next. X features are
+    aggregated over the cycle's timesteps (see `cycle_feature_names`); a
+    histogram bin holds the fraction of timesteps with values in
+    `[edges[i], edges[i + 1])`. Y features in `per_cycle_features` take the
+    maximum including the next red start, like the per-cycle targets of
+    `read_from_file`, and other Y features the mean. Lanes with fewer cycles
+    are padded with pad values.
+
+    :param green: (lanes, time) green indicator array
+    :param histogram_bins: Optional dict of X feature to bin edges
+    :param freq: Seconds per timestep
+    :return: float32 X (lanes, cycle, cycle feature) and Y (lanes, cycle,
+    feature), and the int64 (lanes, cycle, 2) first and last (the next red
+    start) timestep of each cycle, -1 for padding
+    """
+    unknown = [agg for agg in aggregations if agg not in _cycle_aggregations]
+    if len(unknown) > 0:
+        raise ValueError('Unknown cycle aggregations {}, must be in {}'.format(
+            unknown, _cycle_aggregations))
+    histogram_bins = histogram_bins or {}
+    x_columns = cycle_feature_names(x_feature_subset, aggregations,
+                                    histogram_bins)
+
+    num_lanes = X.shape[0]
+    red_starts = [_red_starts(green[lane]) for lane in range(num_lanes)]
+    num_cycles = max([max(len(starts) - 1, 0) for starts in red_starts],
+                     default=0)
+
+    X_cycle = np.empty((num_lanes, num_cycles, len(x_columns)),
+                       dtype=np.float32)
+    X_cycle[:] = [get_pad_value_for_feature(col) for col in x_columns]
+    Y_cycle = np.empty((num_lanes, num_cycles, len(y_feature_subset)),
+                       dtype=np.float32)
+    Y_cycle[:] = [get_pad_value_for_feature(feat)
+                  for feat in y_feature_subset]
+    bounds = np.full((num_lanes, num_cycles, 2), -1, dtype=np.int64)
+
+    y_is_max = np.array([feat in per_cycle_features
+                         for feat in y_feature_subset], dtype=bool)
+    for lane, starts in enumerate(red_starts):
+        lane_cycles = len(starts) - 1
+        if lane_cycles < 1:
+            continue
+        begins, ends = starts[:-1], starts[1:]
+        lengths = (ends - begins).astype(np.float64)
+        offsets = begins - begins[0]
+        x = X[lane, begins[0]:ends[-1]].astype(np.float64)
+
+        sums = np.add.reduceat(x, offsets, 0)
+        stats = {'sum': sums,
+                 'mean': sums / lengths[:, np.newaxis],
+                 'max': np.maximum.reduceat(x, offsets, 0),
+                 'min': np.minimum.reduceat(x, offsets, 0)}
+        columns = []
+        for i, feat in enumerate(x_feature_subset):
+            if feat == 'green':
+                columns.append(
+                    np.add.reduceat((x[:, i] > 0).astype(np.float64), offsets)
+                    / lengths)
+                continue
+            columns.extend(stats[agg][:, i] for agg in aggregations)
+            edges = histogram_bins.get(feat)
+            if edges is not None:
+                bins = np.digitize(x[:, i], edges) - 1
+                columns.extend(np.add.reduceat((bins == b).astype(np.float64),
+                                               offsets) / lengths
+                               for b in range(len(edges) - 1))
+        columns.append(lengths * freq)
+        X_cycle[lane, :lane_cycles] = np.stack(columns, -1)
+
+        y = Y[lane]
+        y_window = y[begins[0]:ends[-1]].astype(np.float64)
+        y_means = np.add.reduceat(y_window, offsets, 0) / lengths[:, np.newaxis]
+        y_maxes = np.maximum(np.maximum.reduceat(y_window, offsets, 0),
+                             y[ends])
+        Y_cycle[lane, :lane_cycles] = np.where(y_is_max, y_maxes, y_means)
+        bounds[lane, :lane_cycles, 0] = begins
+        bounds[lane, :lane_cycles, 1] = ends
+
+    return X_cycle, Y_cycle, bounds
@@ -0,0 +1,46 @@
+"""Pad values and per-cycle settings of preprocessed features.
+
+Both preprocessing and the loaders pad missing values of a feature with its
+pad value and treat the features in `per_cycle_features` as one value per
+light cycle, so these live here rather than with either of them.
+"""
+from collections import defaultdict
+
+pad_value_for_feature = defaultdict(lambda: 0,
+                                    occupancy=0.,
+                                    speed=-1.,
+                                    liu_estimated_m=-1.,
+                                    liu_estimated_veh=-1.,
+                                    green=0.,
+                                    nVehSeen=0.,
+                                    maxJamLengthInMeters=-1.,
+                                    maxJamLengthInVehicles=-1.,
+                                   )
+
+pad_value_for_feature.update(
+    [('e1_0/occupancy', 0.),
+    ('e1_0/speed', -1.),
+    ('e1_1/occupancy', 0.),
+    ('e1_1/speed', -1.),
+    ('e2_0/nVehSeen', 0.),
+    ('e2_0/maxJamLengthInMeters', -1.),
+    ('e2_0/maxJamLengthInVehicles', -1.),
+])
+
+per_cycle_features_default = ['maxJamLengthInMeters',
+                              'maxJamLengthInVehicles',
+                              'e2_0/maxJamLengthInMeters',
+                              'e2_0/maxJamLengthInVehicles',
+                              'liu_estimated_veh',
+                              'liu_estimated_m']
+
+cycle_aggregations_default = ['mean', 'max']
+
+
+def get_pad_value_for_feature(feature):
+    if feature not in pad_value_for_feature:
+        # cycle-level columns (see `cycle_feature_names`)
+        base, _, aggregation = feature.rpartition('/')
+        if base and aggregation in ('mean', 'max', 'min'):
+            return get_pad_value_for_feature(base)
+    return pad_value_for_feature[feature]
@@ -1,14 +1,19 @@
 import collections
+import hashlib
 import logging
 import multiprocessing
 import os
 import re
+import shutil
 import warnings
 
 import numpy as np
 import pandas as pd
 import tables
 
+from trafficgraphnn.preprocessing.pool import preprocessing_pool
+from trafficgraphnn.preprocessing.time_grid import (TimeGrid, get_storer_grid,
+                                                    set_storer_grid)
 from trafficgraphnn.utils import (E1IterParseWrapper, E2IterParseWrapper,
                                   TLSSwitchIterParseWrapper, _col_dtype_key,
                                   col_type, pairwise_iterate)
@@ -16,20 +21,20 @@ from trafficgraphnn.utils import (E1IterParseWrapper, E2IterParseWrapper,
 _logger = logging.getLogger(__name__)
 
 
-def write_hdf_for_sumo_network(sumo_network, multiprocess=True):
-    output_dir = os.path.join(os.path.dirname(sumo_network.netfile),
-                              'output')
+def write_hdf_for_sumo_network(sumo_network, multiprocess=True, pool=None):
+    output_dir = sumo_network.output_dir
     if multiprocess:
-        output_hdf = sumo_output_xmls_to_hdf_multiprocess(output_dir)
+        output_hdf = sumo_output_xmls_to_hdf_multiprocess(output_dir,
+                                                          pool=pool)
     else:
         output_hdf = sumo_output_xmls_to_hdf(output_dir)
 
     light_switch_out_files = light_switch_out_files_for_sumo_network(
         sumo_network)
 
-    assert len(light_switch_out_files) == 1 # more than one xml not supported yet
-
-    tls_output_xml_to_hdf(light_switch_out_files.pop())
+    tls_output_xmls_to_hdf(sorted(light_switch_out_files), output_hdf,
+                           num_workers=None if multiprocess else 1,
+                           pool=pool)
 
     return output_hdf
 
@@ -126,7 +131,8 @@ def sumo_output_xmls_to_hdf_multiprocess(output_dir,
                                          complevel=5,
                                          complib='blosc:lz4',
                                          num_workers=None,
-                                         remove_old_if_exists=True):
+                                         remove_old_if_exists=True,
+                                         pool=None):
     file_list = output_files_in_dir(output_dir)
     output_filename = os.path.join(output_dir, hdf_filename)
 
@@ -135,7 +141,7 @@ def sumo_output_xmls_to_hdf_multiprocess(output_dir,
         os.remove(output_filename)
         _logger.debug('Removed file %s for new one', output_filename)
 
-    with multiprocessing.Pool(num_workers) as pool:
+    with preprocessing_pool(pool, num_workers=num_workers) as pool:
         dfs = pool.map(detector_output_xml_to_df, file_list)
 
     dfs = {k: v for d in dfs if d is not None for k, v in d.items()}
@@ -143,11 +149,59 @@ def sumo_output_xmls_to_hdf_multiprocess(output_dir,
     with pd.HDFStore(output_filename, complevel=complevel,
                      complib=complib) as store:
         for det_id, df in dfs.items():
-            store.append('raw_xml/{}'.format(det_id), df)
+            write_raw_table(store, 'raw_xml/{}'.format(det_id), df)
 
     return output_filename
 
 
+def write_raw_table(store, key, df):
+    """Write a raw table indexed by `begin`.
+
+    Detector and tls tables are sampled at a fixed frequency, so they are
+    stored with a `TimeGrid` in place of the float index. Tables whose times
+    are irregular keep their index.
+    """
+    try:
+        grid = TimeGrid.from_times(df.index.values)
+    except ValueError:
+        _logger.debug('Times of %s are irregular, storing its index', key)
+        store.put(key, df, format='table')
+        return
+    store.put(key, df.reset_index(drop=True))
+    set_storer_grid(store, key, grid)
+
+
+def read_raw_table(store, key):
+    """Read a raw table and its time grid.
+
+    Row `i` of the returned frame is at the grid's `i`th time. Tables
+    stored with a time index are moved onto the grid covering their times,
+    with NaN rows for any gaps.
+
+    :return: TimeGrid and DataFrame with a RangeIndex
+    :rtype: tuple
+    """
+    df = store[key]
+    grid = get_storer_grid(store, key)
+    if grid is not None:
+        return grid, df
+
+    grid = TimeGrid.covering(df.index.values)
+    offsets = grid.offsets(df.index.values)
+    df = df.reset_index(drop=True)
+    if len(offsets) != len(grid) or (offsets != np.arange(len(grid))).any():
+        df.index = offsets
+        df = df[~df.index.duplicated()].reindex(pd.RangeIndex(len(grid)))
+    return grid, df
+
+
+def read_raw_df(store, key):
+    """Read a raw table indexed by `begin`"""
+    grid, df = read_raw_table(store, key)
+    df.index = grid.index()
+    return df
+
+
 def output_files_in_dir(output_dir):
     file_list = [os.path.join(output_dir, f) for f in os.listdir(output_dir)]
     file_list = [f for f in file_list
@@ -191,8 +245,56 @@ def tls_output_xml_to_hdf(xml_file,
     hdf_filename = os.path.join(file_dir, hdf_filename)
     with pd.HDFStore(hdf_filename, complevel=complevel,
                      complib=complib) as store:
-        store.append('raw_xml/tls_switch', df, append=False)
+        write_raw_table(store, 'raw_xml/tls_switch', df)
+
+    return df
+
+
+def tls_output_xmls_to_hdf(xml_files,
+                           hdf_filename,
+                           num_workers=None,
+                           complevel=5,
+                           complib='blosc:lz4',
+                           pool=None):
+    """Parse one or more tls switch outputs into the raw hdf file's
+    per-lane green table"""
+    df = light_timing_xml_files_to_phase_df(xml_files, num_workers, pool)
+    with pd.HDFStore(hdf_filename, complevel=complevel,
+                     complib=complib) as store:
+        write_raw_table(store, 'raw_xml/tls_switch', df)
+
+    return df
 
+
+def light_timing_xml_files_to_phase_df(xml_files, num_workers=None,
+                                       pool=None):
+    """Per-lane green table from several tls switch outputs.
+
+    The files (e.g. one per traffic light) are parsed in parallel and their
+    lanes merged into one table. A lane that appears in more than one file
+    is green whenever any file has it green.
+    """
+    xml_files = list(xml_files)
+    if len(xml_files) == 0:
+        raise ValueError('No tls switch output files given')
+    if len(xml_files) == 1 or (num_workers == 1 and pool is None):
+        dfs = [light_timing_xml_to_phase_df(f) for f in xml_files]
+    elif pool is not None:
+        dfs = pool.map(light_timing_xml_to_phase_df, xml_files)
+    else:
+        with multiprocessing.Pool(
+                min(num_workers or os.cpu_count(), len(xml_files))) as pool:
+            dfs = pool.map(light_timing_xml_to_phase_df, xml_files)
+    return merge_phase_dfs(dfs)
+
+
+def merge_phase_dfs(dfs):
+    if len(dfs) == 1:
+        return dfs[0]
+    df = pd.concat(dfs, axis=1).fillna(False).astype(bool)
+    df.index.name = 'begin'
+    if df.columns.has_duplicates:
+        df = df.T.groupby(level=0, sort=False).any().T
     return df
 
 
@@ -203,18 +305,22 @@ def light_timing_xml_to_phase_df(xml_file):
     df = df.astype({col: col_type(col) for col in df.columns})
 
     max_time = df.end.max()
-    out_df = pd.DataFrame(index=pd.Index(np.arange(0, max_time), name='begin'))
+    index = pd.Index(np.arange(0, max_time), name='begin')
 
-    for lane in df.fromLane.unique():
-        subdf = df[df.fromLane == lane].sort_values(['begin', 'end'])
-        ints = subdf.groupby(
-            (subdf.end.shift()-subdf.begin).lt(0).cumsum()).agg(
-                {'begin': 'first', 'end': 'last'})
-        intervals = [pd.Interval(i.begin, i.end, 'left')
-                     for i in ints.itertuples()]
-        out_df[lane] = [any(t in i for i in intervals) for t in out_df.index]
+    # a lane is green at integer time t if t is in some [begin, end).
+    # Count interval starts minus ends up to each t.
+    lanes, lane_codes = np.unique(df.fromLane.values, return_inverse=True)
+    starts = np.ceil(df.begin.values).astype(np.int64)
+    ends = np.ceil(df.end.values).astype(np.int64)
+    counts = np.zeros((len(lanes), len(index) + 1), dtype=np.int32)
+    np.add.at(counts, (lane_codes, np.minimum(starts, len(index))), 1)
+    np.add.at(counts, (lane_codes, np.minimum(ends, len(index))), -1)
+    green = np.cumsum(counts, axis=1)[:, :len(index)] > 0
 
-    return out_df
+    # keep the column order of first appearance in the file
+    lane_order = pd.unique(df.fromLane.values)
+    out_df = pd.DataFrame(green.T, index=index, columns=lanes)
+    return out_df[lane_order]
 
 
 def green_times_from_lane_light_df(lane_df):
@@ -245,6 +351,137 @@ def green_phase_start_ends_from_lane_light_df(lane_df):
     return zip(green_starts, red_starts)
 
 
+def adjacency_hash(lanes, A_matrices):
+    """Content hash of a lane ordering and its sparse adjacency matrices"""
+    sha1 = hashlib.sha1()
+    sha1.update('\n'.join(lanes).encode())
+    for name in sorted(A_matrices):
+        A = A_matrices[name].tocoo()
+        sha1.update(name.encode())
+        sha1.update(np.asarray(A.row, dtype=np.int32).tobytes())
+        sha1.update(np.asarray(A.col, dtype=np.int32).tobytes())
+    return sha1.hexdigest()
+
+
+def write_adjacency_file(directory, lanes, A_matrices,
+                         complevel=5, complib='blosc:lz4'):
+    """Write sparse adjacency matrices to a file named by their hash.
+
+    Simulations of one network share their adjacency, so each distinct
+    (lanes, matrices) combination is written only once.
+
+    :param A_matrices: Dict of name to scipy sparse matrix ordered by `lanes`
+    :return: Filename and hash
+    :rtype: tuple
+    """
+    lanes = list(lanes)
+    A_hash = adjacency_hash(lanes, A_matrices)
+    filename = os.path.join(directory, 'A_{}.h5'.format(A_hash))
+    if os.path.exists(filename):
+        return filename, A_hash
+
+    os.makedirs(directory, exist_ok=True)
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with pd.HDFStore(tmp_filename, 'w', complevel=complevel,
+                     complib=complib) as store:
+        store.put('lanes', pd.Series(lanes))
+        for name, A in A_matrices.items():
+            A = A.tocoo()
+            store.put('A/{}'.format(name),
+                      pd.DataFrame({'row': A.row.astype(np.int32),
+                                    'col': A.col.astype(np.int32)}))
+    os.replace(tmp_filename, filename)
+    return filename, A_hash
+
+
+# directory next to the preprocessed files that holds their adjacency files
+ADJACENCY_DIRNAME = 'adjacency'
+
+# (filename, hash) -> (lane index, dict of name to dense bool array)
+_adjacency_cache = {}
+
+
+def adjacency_ref(store, filename):
+    """Adjacency file and hash referenced by a preprocessed file.
+
+    The reference is a path relative to the file's directory. If nothing is
+    there (e.g. the file was moved without its adjacency directory), a file
+    with the same hash in `ADJACENCY_DIRNAME` or directly next to the file
+    is used.
+
+    :param store: Open HDFStore of the preprocessed file `filename`
+    :return: Filename and hash, or (None, None) for older files without a
+    reference
+    :rtype: tuple
+    :raises FileNotFoundError: If no adjacency file with the hash is found
+    """
+    if '/A_ref' not in store.keys():
+        return None, None
+    A_ref = store['A_ref']
+    directory = os.path.dirname(filename)
+    expected = os.path.join(directory, A_ref['filename'])
+    basename = 'A_{}.h5'.format(A_ref['hash'])
+    for A_filename in [expected,
+                       os.path.join(directory, ADJACENCY_DIRNAME, basename),
+                       os.path.join(directory, basename)]:
+        if os.path.exists(A_filename):
+            return A_filename, A_ref['hash']
+    raise FileNotFoundError(
+        'Adjacency file {} of {} does not exist. Preprocessed files must be '
+        'moved together with their {} directory (see '
+        'copy_preprocessed_file)'.format(expected, filename,
+                                         ADJACENCY_DIRNAME))
+
+
+def copy_preprocessed_file(filename, directory):
+    """Copy a preprocessed file and the adjacency file it references.
+
+    :return: Filename of the copy
+    """
+    copy = os.path.join(directory, os.path.basename(filename))
+    with pd.HDFStore(filename, 'r') as store:
+        A_filename, _ = adjacency_ref(store, filename)
+        if A_filename is not None:
+            # where the copy's reference points
+            A_copy = os.path.join(directory, store['A_ref']['filename'])
+    if A_filename is not None and not os.path.exists(A_copy):
+        os.makedirs(os.path.dirname(A_copy), exist_ok=True)
+        shutil.copy(A_filename, A_copy)
+    shutil.copy(filename, copy)
+    return copy
+
+
+def read_adjacency_file(filename, A_hash=None):
+    """Read a shared adjacency file as dense boolean arrays.
+
+    Results are cached per process, so each shared file is read once no
+    matter how many simulation files reference it. The returned arrays are
+    shared and must not be modified.
+
+    :return: Lane index and dict of name to (lanes, lanes) bool array
+    :rtype: tuple
+    """
+    key = (os.path.realpath(filename), A_hash)
+    if key in _adjacency_cache:
+        return _adjacency_cache[key]
+
+    with pd.HDFStore(filename, 'r') as store:
+        lanes = pd.Index(store['lanes'].values)
+        num_lanes = len(lanes)
+        A_dict = {}
+        for storer_key in store.keys():
+            if not storer_key.startswith('/A/'):
+                continue
+            coo = store[storer_key]
+            A = np.zeros((num_lanes, num_lanes), dtype=bool)
+            A[coo['row'].values, coo['col'].values] = True
+            A.setflags(write=False)
+            A_dict[storer_key[len('/A/'):]] = A
+
+    _adjacency_cache[key] = lanes, A_dict
+    return lanes, A_dict
+
+
 def get_preprocessed_filenames(directory):
     try:
         return [os.path.join(directory, f)
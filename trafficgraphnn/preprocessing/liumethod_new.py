@@ -1,12 +1,13 @@
-import multiprocessing
-from collections import Iterable
+from collections import namedtuple
 from itertools import repeat
 
 import numpy as np
 import pandas as pd
 
 from trafficgraphnn.preprocessing.io import (green_times_from_lane_light_df,
-                                             queueing_intervals_from_lane_light_df)
+                                             queueing_intervals_from_lane_light_df,
+                                             read_raw_df, read_raw_table)
+from trafficgraphnn.preprocessing.pool import preprocessing_pool
 from trafficgraphnn.utils import DetInfo
 
 JAM_DENSITY = 0.13333 # hardcoded default jam density value (veh/meter)
@@ -18,10 +19,85 @@ __SATURATED = 'saturated'
 __LIU = 'liu'
 
 
+# Per-lane quantities the estimate formulas need that depend only on the
+# detector data, not on the estimator parameters: for each queueing period,
+# its breakpoints, last timesteps and detector flow sums, and the stopbar
+# timesteps with the cumulative stopbar flow before each of them
+LiuLaneInputs = namedtuple(
+    'LiuLaneInputs',
+    ['green_times', 'breakpoint_A_list', 'breakpoint_B_list',
+     'breakpoint_C_list', 'stopbar_end_times', 'advance_end_times',
+     'stopbar_flows', 'advance_flows', 'advance_flows_to_C',
+     'advance_flows_from_C', 'stopbar_times', 'stopbar_cumulative_flows'])
+
+
 def liu_method_for_net(sumo_network, output_data_hdf_filename,
                        jam_density=JAM_DENSITY, num_workers=None,
-                       use_lane_change_accounting_heuristic=True):
-    args = []
+                       use_lane_change_accounting_heuristic=True,
+                       pool=None):
+    lane_ids, idds = _lanes_and_inter_detector_distances(sumo_network)
+
+    args = zip(repeat(output_data_hdf_filename), lane_ids, idds,
+               repeat(jam_density))
+    with preprocessing_pool(pool, num_workers=num_workers) as pool:
+        results = pool.starmap(liu_for_lane, args)
+
+        out = {result.columns[0]: result for result in results}
+        if use_lane_change_accounting_heuristic:
+            out = postprocess_negative_from_lane_changes(sumo_network, out,
+                                                         pool=pool)
+
+    return out
+
+
+def liu_sweep_for_net(sumo_network, output_data_hdf_filename,
+                      jam_densities=(JAM_DENSITY,),
+                      lane_change_heuristic_settings=(True, False),
+                      num_workers=None,
+                      pool=None):
+    """Run the Liu estimator for a grid of parameter values.
+
+    Breakpoints and per-period flow sums are computed once per lane, and the
+    estimates for all jam densities are evaluated in one pass. Each jam
+    density's results are then postprocessed with and/or without the
+    lane-change accounting heuristic.
+
+    :param jam_densities: Jam density values (veh/meter) to evaluate
+    :param lane_change_heuristic_settings: Values of
+    `use_lane_change_accounting_heuristic` to evaluate
+    :return: Dataframe indexed by `begin` with column levels
+    (jam_density, lane_change_heuristic, lane, value), where value is one of
+    `estimate`, `method`
+    :rtype: pandas.DataFrame
+    """
+    jam_densities = list(jam_densities)
+    lane_ids, idds = _lanes_and_inter_detector_distances(sumo_network)
+
+    args = zip(repeat(output_data_hdf_filename), lane_ids, idds,
+               repeat(jam_densities))
+    with preprocessing_pool(pool, num_workers=num_workers) as pool:
+        per_lane_results = pool.starmap(liu_sweep_for_lane, args)
+
+        cube = {}
+        for i, jam_density in enumerate(jam_densities):
+            results = {lane_id: lane_results[i] for lane_id, lane_results
+                       in zip(lane_ids, per_lane_results)}
+            for use_heuristic in lane_change_heuristic_settings:
+                if use_heuristic:
+                    out = postprocess_negative_from_lane_changes(
+                        sumo_network, dict(results), pool=pool)
+                else:
+                    out = results
+                cube[(jam_density, use_heuristic)] = pd.concat(
+                    [_estimate_method_columns(lane_id, df)
+                     for lane_id, df in out.items()], axis=1)
+
+    return pd.concat(cube, axis=1,
+                     names=['jam_density', 'lane_change_heuristic',
+                            'lane', 'value'])
+
+
+def _lanes_and_inter_detector_distances(sumo_network):
     lane_ids = []
     idds = []
     for lane_id, lane_data in sumo_network.graph.nodes.data():
@@ -29,20 +105,21 @@ def liu_method_for_net(sumo_network, output_data_hdf_filename,
             continue
         idds.append(get_length_between_loop_detectors(sumo_network, lane_id))
         lane_ids.append(lane_id)
+    return lane_ids, idds
 
-    args = zip(repeat(output_data_hdf_filename), lane_ids, idds,
-               repeat(jam_density))
-    with multiprocessing.Pool(num_workers) as pool:
-        results = pool.starmap(liu_for_lane, args)
-
-    out = {result.columns[0]: result for result in results}
-    if use_lane_change_accounting_heuristic:
-        out = postprocess_negative_from_lane_changes(sumo_network, out)
 
-    return out
+def _estimate_method_columns(lane_id, lane_df):
+    """Put single-lane liu results in (lane, estimate/method) columns"""
+    if isinstance(lane_df.columns, pd.MultiIndex):
+        return lane_df
+    lane_df = lane_df.copy()
+    lane_df.columns = pd.MultiIndex.from_product([[lane_id],
+                                                  ['estimate', 'method']])
+    return lane_df
 
 
-def postprocess_negative_from_lane_changes(sn, results, num_workers=None):
+def postprocess_negative_from_lane_changes(sn, results, num_workers=None,
+                                           pool=None):
     """Heuristic to try and mitigate negative net loop flows from lane changes.
 
     Lane queue estimates computed by the simple input output method will
@@ -52,7 +129,7 @@ def postprocess_negative_from_lane_changes(sn, results, num_workers=None):
     """
     grouped_lanes = _split_lanes_by_edges(sn, results)
     dfs = {}
-    with multiprocessing.Pool(num_workers) as pool:
+    with preprocessing_pool(pool, num_workers=num_workers) as pool:
         edge_dfs = pool.map(distribute_io_estimate_deficit_for_edge,
                             grouped_lanes.values())
 
@@ -136,15 +213,37 @@ def get_length_between_loop_detectors(sumo_network, lane_id):
 
 def liu_for_lane(output_data_hdf_filename, lane_id, inter_detector_distance,
                  jam_density=JAM_DENSITY):
+    lane_inputs = liu_inputs_for_lane(output_data_hdf_filename, lane_id)
+    return liu_estimates_for_lane(lane_inputs, lane_id,
+                                  inter_detector_distance, jam_density)
+
+
+def liu_sweep_for_lane(output_data_hdf_filename, lane_id,
+                       inter_detector_distance, jam_densities):
+    """Return a list of liu results for the lane, one per jam density"""
+    lane_inputs = liu_inputs_for_lane(output_data_hdf_filename, lane_id)
+    return liu_sweep_estimates_for_lane(lane_inputs, lane_id,
+                                        inter_detector_distance,
+                                        jam_densities)
+
+
+def liu_inputs_for_lane(output_data_hdf_filename, lane_id):
+    """Read a lane's detector data and find its per-period breakpoints and
+    flow sums"""
     stopbar_detector_id = 'e1_' + lane_id + '_0'
     advance_detector_id = 'e1_' + lane_id + '_1'
 
     with pd.HDFStore(output_data_hdf_filename, 'r') as store:
 
-        stopbar_detector_df = store['raw_xml/' + stopbar_detector_id].copy()
-        advance_detector_df = store['raw_xml/' + advance_detector_id].copy()
+        stopbar_grid, stopbar_detector_df = read_raw_table(
+            store, 'raw_xml/' + stopbar_detector_id)
+        advance_grid, advance_detector_df = read_raw_table(
+            store, 'raw_xml/' + advance_detector_id)
 
-        lane_light_series = store['raw_xml/tls_switch'][lane_id].copy()
+        lane_light_series = read_raw_df(store,
+                                        'raw_xml/tls_switch')[lane_id].copy()
+    stopbar_detector_df.index = stopbar_grid.index()
+    advance_detector_df.index = advance_grid.index()
     queueing_periods = queueing_intervals_from_lane_light_df(lane_light_series)
     queueing_periods = list(queueing_periods)
     green_times = green_times_from_lane_light_df(lane_light_series)
@@ -156,13 +255,13 @@ def liu_for_lane(output_data_hdf_filename, lane_id, inter_detector_distance,
         green_times = green_times[1:]
 
     # break up the df's by queueing periods
-    stopbar_queueing_periods = _split_df_by_intervals(stopbar_detector_df,
-                                                      queueing_periods)
-    advance_queueing_periods = _split_df_by_intervals(advance_detector_df,
-                                                      queueing_periods)
+    stopbar_queueing_periods = _split_df_by_intervals(
+        stopbar_detector_df, queueing_periods, stopbar_grid)
+    advance_queueing_periods = _split_df_by_intervals(
+        advance_detector_df, queueing_periods, advance_grid)
 
     breakpoint_A_list, breakpoint_B_list = breakpoints_A_B_wholedf(
-        advance_detector_df, queueing_periods)
+        advance_detector_df, queueing_periods, advance_grid)
 
     # breakpoint C: only look up until the next queue starts forming (i.e.,
     # the start of the next queueing period)
@@ -170,33 +269,94 @@ def liu_for_lane(output_data_hdf_filename, lane_id, inter_detector_distance,
                          for B, next_intvl in zip(breakpoint_B_list,
                                                   queueing_periods[1:])]
 
-    estimates_list = []
-    residual_queue_estimate = 0
-    for stop, adv, green, A, B, C in zip(stopbar_queueing_periods,
-                                         advance_queueing_periods,
-                                         green_times,
-                                         breakpoint_A_list,
-                                         breakpoint_B_list,
-                                         breakpoint_C_list):
-        estimate = queue_estimate(stop, adv, green, A, B, C,
-                                 residual_queue_estimate,
-                                 inter_detector_distance, jam_density)
-        if isinstance(estimate[0], Iterable): # can return one or two tuples
-            estimates_list.extend(estimate)
-        else:
-            estimates_list.append(estimate)
-
-        residual_queue_estimate = estimates_list[-1][1]
+    return lane_inputs_from_periods(stopbar_queueing_periods,
+                                    advance_queueing_periods, green_times,
+                                    breakpoint_A_list, breakpoint_B_list,
+                                    breakpoint_C_list)
+
+
+def lane_inputs_from_periods(stopbar_queueing_periods,
+                             advance_queueing_periods, green_times,
+                             breakpoint_A_list, breakpoint_B_list,
+                             breakpoint_C_list):
+    """LiuLaneInputs of a lane's detector data split by queueing period.
+
+    The flow sums of each period are computed here, so estimates for any
+    jam density are arithmetic on them instead of dataframe slicing.
+    """
+    stopbar_flows = [df['nVehContrib'].sum()
+                     for df in stopbar_queueing_periods]
+    advance_flows = [df['nVehContrib'].sum()
+                     for df in advance_queueing_periods]
+    advance_flows_to_C = [
+        df.loc[:C, 'nVehContrib'].sum() if C is not None else np.nan
+        for df, C in zip(advance_queueing_periods, breakpoint_C_list)]
+    advance_flows_from_C = [
+        df.loc[C:, 'nVehContrib'].sum() if C is not None else np.nan
+        for df, C in zip(advance_queueing_periods, breakpoint_C_list)]
+    stopbar_times = [df.index.values for df in stopbar_queueing_periods]
+    stopbar_cumulative_flows = [
+        np.concatenate([[0], np.cumsum(df['nVehContrib'].values)])
+        for df in stopbar_queueing_periods]
+
+    return LiuLaneInputs(green_times, breakpoint_A_list, breakpoint_B_list,
+                         breakpoint_C_list,
+                         _last_index_values(stopbar_queueing_periods),
+                         _last_index_values(advance_queueing_periods),
+                         stopbar_flows, advance_flows, advance_flows_to_C,
+                         advance_flows_from_C, stopbar_times,
+                         stopbar_cumulative_flows)
+
+
+def _last_index_values(dfs):
+    return [df.index[-1] if len(df) > 0 else None for df in dfs]
+
+
+def liu_estimates_for_lane(lane_inputs, lane_id, inter_detector_distance,
+                           jam_density=JAM_DENSITY):
+    """Evaluate the queue estimates from a lane's precomputed inputs"""
+    return liu_sweep_estimates_for_lane(lane_inputs, lane_id,
+                                        inter_detector_distance,
+                                        [jam_density])[0]
+
+
+def liu_sweep_estimates_for_lane(lane_inputs, lane_id,
+                                 inter_detector_distance, jam_densities):
+    """Evaluate the queue estimates for every jam density in one pass over
+    the lane's queueing periods (see `queue_estimate`).
+
+    :return: List of result dataframes (see `liu_for_lane`), one per jam
+    density
+    """
+    jam_densities = np.asarray(jam_densities, dtype=float)
+    estimates_lists = [[] for _ in jam_densities]
+    residual_queue_estimates = np.zeros(len(jam_densities))
+    num_periods = min(len(values) for values in lane_inputs)
+    for i in range(num_periods):
+        estimates = queue_estimate(lane_inputs, i, residual_queue_estimates,
+                                   inter_detector_distance, jam_densities)
+        for t_estimate, queue_estimates, method in estimates:
+            queue_estimates = np.broadcast_to(queue_estimates,
+                                              jam_densities.shape)
+            for j, estimates_list in enumerate(estimates_lists):
+                if np.isnan(queue_estimates[j]):
+                    continue
+                t = t_estimate[j] if np.ndim(t_estimate) > 0 else t_estimate
+                estimates_list.append((t, queue_estimates[j], method))
+
+        residual_queue_estimates = np.array(
+            [estimates_list[-1][1] for estimates_list in estimates_lists])
 
     # return pandas df of the time that a liu estimate is made
     # and the estimate itself
-    result = pd.DataFrame(
-        estimates_list, columns=['begin',
-                                 '{}'.format(lane_id),
-                                 '{}_method'.format(lane_id)])
-    result = result.set_index('begin')
-    return result
-    # return estimates_list
+    results = []
+    for estimates_list in estimates_lists:
+        result = pd.DataFrame(
+            estimates_list, columns=['begin',
+                                     '{}'.format(lane_id),
+                                     '{}_method'.format(lane_id)])
+        results.append(result.set_index('begin'))
+    return results
 
 
 def breakpoints_A_B(advance_df):
@@ -216,15 +376,24 @@ def breakpoints_A_B(advance_df):
     return bkpt_A, bkpt_B
 
 
-def breakpoints_A_B_wholedf(advance_df, queueing_intervals):
+def breakpoints_A_B_wholedf(advance_df, queueing_intervals, grid=None):
+    """Breakpoints A and B of each queueing interval.
+
+    :param grid: TimeGrid of `advance_df`. If given, intervals are sliced by
+    row offset instead of by index label.
+    """
     binary_occupancy = (advance_df['occupancy'] >= 100).astype(bool)
+    if grid is not None:
+        periods = [binary_occupancy.iloc[grid.slice(q[0], q[1])]
+                   for q in queueing_intervals]
+    else:
+        periods = [binary_occupancy.loc[q[0]:q[1]]
+                   for q in queueing_intervals]
 
-    breakpoints_A = [breakpoint_A_for_period(binary_occupancy.loc[q[0]:q[1]])
-                     for q in queueing_intervals]
+    breakpoints_A = [breakpoint_A_for_period(period) for period in periods]
 
-    breakpoints_B = [breakpoint_B_for_period(binary_occupancy.loc[q[0]:q[1]],
-                                             A)
-                     for q, A in zip(queueing_intervals, breakpoints_A)]
+    breakpoints_B = [breakpoint_B_for_period(period, A)
+                     for period, A in zip(periods, breakpoints_A)]
 
     return breakpoints_A, breakpoints_B
 
@@ -287,48 +456,53 @@ def breakpoint_C(detector_df, breakpoint_B, end_search_time, min_time_gap=3):
     return breakpoint_C
 
 
-def queue_estimate(stopbar_df, advance_df, green_start,
-                   breakpoint_A, breakpoint_B, breakpoint_C,
-                   prev_phase_queue_estimate, inter_detector_distance,
-                   jam_density):
-    if breakpoint_A is None:
-        time, estimate = input_output_method(stopbar_df, advance_df,
-                                             prev_phase_queue_estimate,
-                                             green_start)
-        return time, estimate, __INPUT_OUTPUT
-    elif breakpoint_C is None:
+def queue_estimate(lane_inputs, i, prev_phase_queue_estimate,
+                   inter_detector_distance, jam_density):
+    """Queue estimates of a lane's `i`th queueing period.
+
+    `jam_density` and `prev_phase_queue_estimate` can be arrays, to evaluate
+    several jam densities at once.
+
+    :param lane_inputs: LiuLaneInputs of the lane
+    :return: List of (time, estimate, method) tuples. Estimates are NaN for
+    the jam densities that have no such estimate
+    """
+    if lane_inputs.breakpoint_A_list[i] is None:
+        time, estimate = input_output_method(lane_inputs, i,
+                                             prev_phase_queue_estimate)
+        return [(time, estimate, __INPUT_OUTPUT)]
+    elif lane_inputs.breakpoint_C_list[i] is None:
         # No breakpoint C means that the queue is saturated and therefore
         # unobservable. In this case the Liu method gives no guidance, so we
         # choose to estimate that the queue reaches the advance detector
-        phase_end = stopbar_df.index[-1]
+        phase_end = lane_inputs.stopbar_end_times[i]
         saturated_queue_estimate_veh = inter_detector_distance * jam_density
-        return phase_end, saturated_queue_estimate_veh, __SATURATED
+        return [(phase_end, saturated_queue_estimate_veh, __SATURATED)]
     else:
-        estimate_or_estimates = liu_estimate_from_breakpoints(
-            advance_df, stopbar_df, green_start, breakpoint_B, breakpoint_C,
-            inter_detector_distance, jam_density)
-        if isinstance(estimate_or_estimates[0], Iterable):
-            return tuple(est + (__LIU,) for est in estimate_or_estimates)
-        return estimate_or_estimates + (__LIU,)
-
-def input_output_method(stopbar_df, advance_df, prev_phase_queue_estimate,
-                        green_time):
-    total_outflow = stopbar_df.loc[:,'nVehContrib'].sum()
-    total_inflow = advance_df.loc[:,'nVehContrib'].sum()
-    net_flow = total_inflow - total_outflow
+        return [estimate + (__LIU,) for estimate in
+                liu_estimate_from_breakpoints(lane_inputs, i,
+                                              inter_detector_distance,
+                                              jam_density)]
+
+def input_output_method(lane_inputs, i, prev_phase_queue_estimate):
+    net_flow = lane_inputs.advance_flows[i] - lane_inputs.stopbar_flows[i]
 
     queue_estimate = prev_phase_queue_estimate + net_flow
-    assert stopbar_df.index[-1] == advance_df.index[-1]
-    t_queue_estimate = stopbar_df.index[-1]
-    # print([t_queue_estimate, queue_estimate])
+    assert lane_inputs.stopbar_end_times[i] == lane_inputs.advance_end_times[i]
+    t_queue_estimate = lane_inputs.stopbar_end_times[i]
     return t_queue_estimate, queue_estimate
 
 
-def liu_estimate_from_breakpoints(advance_df, stopbar_df, green_start,
-                                  breakpoint_B,
-                                  breakpoint_C, inter_detector_distance,
+def liu_estimate_from_breakpoints(lane_inputs, i, inter_detector_distance,
                                   jam_density):
-    """Liu's "Expansion I" method (Equation 11)"""
+    """Liu's "Expansion I" method (Equation 11)
+
+    :return: The time and size of the max queue, and the time and size of
+    the queue at the end of the phase, which is NaN where the max queue is
+    not before the end of the phase
+    """
+    green_start = lane_inputs.green_times[i]
+    breakpoint_B = lane_inputs.breakpoint_B_list[i]
 
     # estimate shockwave speed
 
@@ -339,30 +513,29 @@ def liu_estimate_from_breakpoints(advance_df, stopbar_df, green_start,
         v2 = np.inf
 
     # max queue
-    n = advance_df.loc[:breakpoint_C, 'nVehContrib'].sum()
+    n = lane_inputs.advance_flows_to_C[i]
     max_queue_veh = n + inter_detector_distance * jam_density # units: veh
 
     # time of max queue
     max_queue_m = max_queue_veh / jam_density
     t_queue_max = np.round(green_start + max_queue_m / v2)
 
-    outputs = (t_queue_max, max_queue_veh)
-
     # queue at end of green phase (if max queue not at end of green phase)
     # estimated by subtracting outflow after time of max queue
     # and adding inflow after breakpoint C (pre-breakpoint C arrivals included
     # in max queue)
-    t_phase_end = advance_df.index[-1]
-    if t_phase_end > t_queue_max:
-        post_max_queue_outflow = stopbar_df.loc[t_queue_max:,
-                                                'nVehContrib'].sum()
-        post_breakpoint_C_inflow = advance_df.loc[breakpoint_C:,
-                                                  'nVehContrib'].sum()
-
-        phase_end_queue_veh = (max_queue_veh - post_max_queue_outflow
-                            + post_breakpoint_C_inflow)
-
-        outputs = outputs, (t_phase_end, phase_end_queue_veh)
+    t_phase_end = lane_inputs.advance_end_times[i]
+    cumulative_flows = lane_inputs.stopbar_cumulative_flows[i]
+    post_max_queue_outflow = (
+        cumulative_flows[-1]
+        - cumulative_flows[np.searchsorted(lane_inputs.stopbar_times[i],
+                                           t_queue_max)])
+    post_breakpoint_C_inflow = lane_inputs.advance_flows_from_C[i]
+
+    phase_end_queue_veh = (max_queue_veh - post_max_queue_outflow
+                           + post_breakpoint_C_inflow)
+    phase_end_queue_veh = np.where(t_phase_end > t_queue_max,
+                                   phase_end_queue_veh, np.nan)
 
     # speed of the queue discharge wave
     # v3 = max_queue_m - inter_detector_distance / (breakpoint_C - t_queue_max)
@@ -372,9 +545,12 @@ def liu_estimate_from_breakpoints(advance_df, stopbar_df, green_start,
     # end of the green light
     # t_min_queue = phase_end_t + min_queue_m / v4
 
-    return outputs
+    return (t_queue_max, max_queue_veh), (t_phase_end, phase_end_queue_veh)
 
 
-def _split_df_by_intervals(df, intervals):
+def _split_df_by_intervals(df, intervals, grid=None):
+    if grid is not None:
+        return [df.iloc[grid.slice(interval[0], interval[1])]
+                for interval in intervals]
     return [df.loc[(interval[0] <= df.index) & (df.index <= interval[1])]
             for interval in intervals]
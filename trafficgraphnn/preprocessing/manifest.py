@@ -0,0 +1,257 @@
+"""Catalog of the preprocessed simulation files in a directory.
+
+`DatasetManifest` keeps a `manifest.json` next to the preprocessed files with
+each file's lane count, time grid, features, adjacency hash, size and
+train/val/test split. Preprocessing adds an entry as it writes each file,
+so readers can batch, bucket and split the data without opening the files.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+
+import pandas as pd
+
+from trafficgraphnn.preprocessing.codec import get_storer_codecs
+from trafficgraphnn.preprocessing.io import (adjacency_ref,
+                                             get_preprocessed_filenames,
+                                             read_adjacency_file)
+from trafficgraphnn.preprocessing.time_grid import TimeGrid, get_storer_grid
+
+_logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'manifest.json'
+
+_MANIFEST_VERSION = 1
+
+SPLITS = ('train', 'val', 'test')
+
+
+class DatasetManifest(object):
+    """Manifest of the preprocessed files in `directory`.
+
+    Entries are keyed by file basename. Use `locked` to read-modify-write
+    the manifest when other processes may be writing to the directory.
+
+    :ivar entries: Dict of basename to entry dict (see `make_entry`)
+    :ivar reserved: Set of file numbers handed out but not yet written
+    """
+    def __init__(self, directory, entries=None, reserved=None):
+        self.directory = directory
+        self.entries = entries if entries is not None else {}
+        self.reserved = set(reserved) if reserved is not None else set()
+
+    @property
+    def filename(self):
+        return os.path.join(self.directory, MANIFEST_FILENAME)
+
+    @classmethod
+    def load(cls, directory):
+        """Load the manifest of `directory`.
+
+        A directory without a manifest is scanned once to build one.
+        """
+        manifest = cls(directory)
+        try:
+            with open(manifest.filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            manifest.sync()
+            return manifest
+        except ValueError:
+            _logger.warning('Could not parse %s, rebuilding it',
+                            manifest.filename, exc_info=True)
+            manifest.sync()
+            return manifest
+        if data.get('version') != _MANIFEST_VERSION:
+            _logger.info('Rebuilding manifest %s of older version',
+                         manifest.filename)
+            manifest.sync()
+            return manifest
+        manifest.entries = data['entries']
+        manifest.reserved = set(data.get('reserved', []))
+        return manifest
+
+    @classmethod
+    @contextlib.contextmanager
+    def locked(cls, directory):
+        """Load the manifest under an exclusive lock and save it on exit"""
+        os.makedirs(directory, exist_ok=True)
+        lock_filename = os.path.join(directory, MANIFEST_FILENAME + '.lock')
+        with open(lock_filename, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                manifest = cls.load(directory)
+                yield manifest
+                manifest.save()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self):
+        """Write the manifest atomically"""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump({'version': _MANIFEST_VERSION,
+                       'entries': self.entries,
+                       'reserved': sorted(self.reserved)},
+                      f, indent=1, sort_keys=True)
+        os.replace(tmp_filename, self.filename)
+
+    def sync(self):
+        """Bring entries up to date with the files in the directory.
+
+        Only files that are new or whose size or mtime changed are opened.
+
+        :return: True if any entry changed
+        """
+        on_disk = {os.path.basename(f): f
+                   for f in get_preprocessed_filenames(self.directory)}
+        changed = False
+        for name in list(self.entries):
+            if name not in on_disk:
+                del self.entries[name]
+                changed = True
+        for name, path in on_disk.items():
+            stat = os.stat(path)
+            entry = self.entries.get(name)
+            if (entry is not None and entry['bytes'] == stat.st_size
+                    and entry['mtime'] == stat.st_mtime):
+                continue
+            try:
+                new_entry = entry_from_file(path)
+            except (OSError, KeyError, ValueError):
+                _logger.warning('Could not read %s for the manifest', path,
+                                exc_info=True)
+                continue
+            if entry is not None:
+                new_entry['split'] = entry.get('split')
+            self.entries[name] = new_entry
+            self.reserved.discard(_file_number(name))
+            changed = True
+        return changed
+
+    def add(self, filename, entry):
+        name = os.path.basename(filename)
+        self.entries[name] = entry
+        self.reserved.discard(_file_number(name))
+
+    def next_file_number(self):
+        numbers = [_file_number(name) for name in self.entries]
+        numbers.extend(self.reserved)
+        return max(numbers, default=0) + 1
+
+    def reserve_file_numbers(self, count=1):
+        """Hand out `count` consecutive unused file numbers"""
+        first = self.next_file_number()
+        numbers = list(range(first, first + count))
+        self.reserved.update(numbers)
+        return numbers
+
+    def filenames(self, split=None):
+        """Sorted full paths of the files, optionally of one split"""
+        return [os.path.join(self.directory, name)
+                for name in sorted(self.entries)
+                if split is None or self.entries[name].get('split') == split]
+
+    def entry(self, filename):
+        return self.entries[os.path.basename(filename)]
+
+    def release_file_numbers(self, numbers):
+        """Return reserved numbers whose files will not be written"""
+        self.reserved.difference_update(numbers)
+
+    def assign_splits(self, val_proportion, test_proportion):
+        """Assign a split to each file that does not have one.
+
+        See `assign_splits`.
+
+        :return: True if any split was assigned
+        """
+        return assign_splits(self.entries, val_proportion, test_proportion)
+
+
+def assign_splits(entries, val_proportion, test_proportion):
+    """Assign a split to each entry of dict `entries` that does not have one.
+
+    Assigned splits never change, so adding files keeps earlier
+    train/val/test sets intact. New files fill each split up to its
+    proportion of all files; as with the earlier sorted-filename split,
+    the last files (by key) go to test and the ones before them to val.
+
+    :return: True if any split was assigned
+    """
+    unassigned = sorted(name for name, entry in entries.items()
+                        if entry.get('split') is None)
+    if len(unassigned) == 0:
+        return False
+    total = len(entries)
+    counts = {split: sum(entry.get('split') == split
+                         for entry in entries.values())
+              for split in SPLITS}
+    num_test = max(int(total * test_proportion) - counts['test'], 0)
+    num_val = max(int(total * val_proportion) - counts['val'], 0)
+    num_test = min(num_test, len(unassigned))
+    num_val = min(num_val, len(unassigned) - num_test)
+
+    num_train = len(unassigned) - num_val - num_test
+    for i, name in enumerate(unassigned):
+        if i < num_train:
+            split = 'train'
+        elif i < num_train + num_val:
+            split = 'val'
+        else:
+            split = 'test'
+        entries[name]['split'] = split
+    return True
+
+
+def make_entry(filename, num_lanes, grid, x_features, y_features, A_hash,
+               A_filename=None):
+    """Manifest entry of a just-written preprocessed file"""
+    stat = os.stat(filename)
+    if A_filename is not None:
+        A_filename = os.path.relpath(A_filename, os.path.dirname(filename))
+    return {'lanes': int(num_lanes),
+            'timesteps': len(grid),
+            't0': grid.t0,
+            'freq': grid.freq,
+            'x_features': list(x_features),
+            'y_features': list(y_features),
+            'A_hash': A_hash,
+            'A_file': A_filename,
+            'bytes': stat.st_size,
+            'mtime': stat.st_mtime,
+            'split': None}
+
+
+def entry_from_file(filename):
+    """Manifest entry of an existing preprocessed file, read from the file"""
+    with pd.HDFStore(filename, 'r') as store:
+        A_filename, A_hash = adjacency_ref(store, filename)
+        x_features = _table_columns(store, 'X')
+        y_features = _table_columns(store, 'Y')
+        grid = get_storer_grid(store, 'X')
+        if grid is None: # older files index rows by (lane, begin)
+            index = store['X'].index
+            num_lanes = len(index.get_level_values('lane').unique())
+            grid = TimeGrid.from_times(
+                index.get_level_values('begin').unique())
+        else:
+            num_lanes = len(read_adjacency_file(A_filename, A_hash)[0])
+    return make_entry(filename, num_lanes, grid, x_features, y_features,
+                      A_hash, A_filename)
+
+
+def _table_columns(store, key):
+    # the codecs are stored in column order
+    codecs = get_storer_codecs(store, key)
+    if codecs is not None:
+        return list(codecs)
+    return list(store[key].columns)
+
+
+def _file_number(name):
+    return int(re.search(r'\d+', name).group())
@@ -0,0 +1,136 @@
+"""Long-lived worker pool shared by the preprocessing stages.
+
+Creating a `multiprocessing.Pool` per stage costs a process spin-up per
+stage and simulation, and per-lane tasks used to pickle network-level data
+(e.g. lane detector dicts) with every task. `PreprocessingPool` keeps one
+pool alive across stages and simulations, and ships a network's read-only
+state to its workers once through the pool initializer.
+"""
+import contextlib
+import hashlib
+import logging
+import multiprocessing
+import pickle
+
+_logger = logging.getLogger(__name__)
+
+# set in each worker by _init_worker
+_worker_network_state = None
+
+
+class NetworkState(object):
+    """Read-only per-network data the preprocessing workers need.
+
+    :ivar lane_detectors: Dict of lane id to that lane's detector dict (as in
+    the graph's 'detectors' node attribute), without the per-run output
+    file attribute, so all runs of a network share one state
+    """
+    def __init__(self, netfile, lane_detectors):
+        self.netfile = netfile
+        self.lane_detectors = lane_detectors
+        self.key = hashlib.sha1(pickle.dumps(
+            (netfile, sorted((lane, sorted((det_id, sorted(info.items()))
+                                           for det_id, info in dets.items()))
+                             for lane, dets in lane_detectors.items()))
+        )).hexdigest()
+
+    @classmethod
+    def from_sumo_network(cls, sumo_network):
+        lane_detectors = {}
+        for lane in sumo_network.lanes_with_detectors():
+            dets = sumo_network.graph.nodes[lane]['detectors']
+            lane_detectors[lane] = {
+                det_id: {k: v for k, v in info.items() if k != 'file'}
+                for det_id, info in dets.items()}
+        return cls(sumo_network.netfile, lane_detectors)
+
+
+def _init_worker(state):
+    global _worker_network_state
+    _worker_network_state = state
+
+
+def worker_network_state():
+    """The network state of the pool this worker belongs to"""
+    if _worker_network_state is None:
+        raise RuntimeError('Worker has no network state. Use '
+                           'PreprocessingPool.set_network first.')
+    return _worker_network_state
+
+
+class PreprocessingPool(object):
+    """A process pool reused across preprocessing stages and simulations.
+
+    The underlying pool starts on first use. It is restarted only when
+    `set_network` is given a network whose state differs from the
+    current one.
+
+    :param num_workers: Number of worker processes, defaults to the number
+    of CPUs
+    """
+    def __init__(self, num_workers=None):
+        self.num_workers = num_workers
+        self.network_state = None
+        self._pool = None
+
+    def set_network(self, sumo_network):
+        """Make `sumo_network`'s state available to the workers"""
+        state = NetworkState.from_sumo_network(sumo_network)
+        if self.network_state is not None \
+                and self.network_state.key == state.key:
+            return
+        self.network_state = state
+        if self._pool is not None:
+            _logger.debug('Restarting preprocessing pool for new network %s',
+                          sumo_network.netfile)
+            self._close_pool()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(
+                self.num_workers, initializer=_init_worker,
+                initargs=(self.network_state,))
+        return self._pool
+
+    def map(self, func, iterable, chunksize=None):
+        return self.pool.map(func, iterable, chunksize)
+
+    def starmap(self, func, iterable, chunksize=None):
+        return self.pool.starmap(func, iterable, chunksize)
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        return self.pool.imap_unordered(func, iterable, chunksize)
+
+    def _close_pool(self):
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+    def close(self):
+        if self._pool is not None:
+            self._close_pool()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@contextlib.contextmanager
+def preprocessing_pool(pool=None, sumo_network=None, num_workers=None):
+    """Use `pool` if given, otherwise a temporary pool.
+
+    :param sumo_network: If given, its state is set on the pool
+    """
+    if pool is not None:
+        if sumo_network is not None:
+            pool.set_network(sumo_network)
+        yield pool
+        return
+
+    with PreprocessingPool(num_workers) as new_pool:
+        if sumo_network is not None:
+            new_pool.set_network(sumo_network)
+        yield new_pool
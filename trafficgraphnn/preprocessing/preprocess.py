@@ -3,23 +3,40 @@
 Use to put data into hdf stores with A, X, Y arrays.
 """
 import logging
-import multiprocessing
 import os
 import re
 import time
 from collections import OrderedDict
 from itertools import repeat
 
-import networkx as nx
+import numpy as np
 import pandas as pd
 import six
 
-from trafficgraphnn.load_data import pad_value_for_feature
-from trafficgraphnn.preprocessing.io import (get_preprocessed_filenames,
+from trafficgraphnn.preprocessing.codec import encode_table, set_storer_codecs
+from trafficgraphnn.preprocessing.cycles import (BOUNDS_KEY, X_CYCLE_KEY,
+                                                 Y_CYCLE_KEY, aggregate_cycles,
+                                                 cycle_feature_names,
+                                                 cycle_info,
+                                                 mask_per_cycle_features,
+                                                 set_storer_cycle_info)
+from trafficgraphnn.preprocessing.features import (pad_value_for_feature,
+                                                   per_cycle_features_default)
+from trafficgraphnn.preprocessing.io import (ADJACENCY_DIRNAME,
                                              light_switch_out_files_for_sumo_network,
-                                             light_timing_xml_to_phase_df,
+                                             light_timing_xml_files_to_phase_df,
+                                             read_raw_df, read_raw_table,
+                                             write_adjacency_file,
                                              write_hdf_for_sumo_network)
 from trafficgraphnn.preprocessing.liumethod_new import liu_method_for_net
+from trafficgraphnn.preprocessing.manifest import DatasetManifest, make_entry
+from trafficgraphnn.preprocessing.pool import (preprocessing_pool,
+                                               worker_network_state)
+from trafficgraphnn.preprocessing.pyramid import (downsample_time_axis,
+                                                  level_grid, level_info,
+                                                  pyramid_key,
+                                                  set_storer_pyramid)
+from trafficgraphnn.preprocessing.time_grid import TimeGrid, set_storer_grid
 
 raw_xml_x_feature_defaults=[
     'occupancy', 'speed', 'green', 'liu_estimated_veh', 'nVehContrib',
@@ -30,20 +47,38 @@ raw_xml_y_feature_defaults=['nVehSeen', 'maxJamLengthInVehicles']
 _logger = logging.getLogger(__name__)
 
 
-def run_preprocessing(sumo_network, output_filename=None):
+def run_preprocessing(sumo_network, output_filename=None, pool=None,
+                      pyramid_intervals=None):
+    """Extract a simulation's xml outputs and write its preprocessed file.
+
+    :param pool: PreprocessingPool to run all stages in. If None, a pool is
+    created for this call.
+    :param pyramid_intervals: Intervals to precompute averaged levels for
+    (see `write_per_lane_tables`)
+    """
+    reserved = None
     if output_filename is None:
+        reserved = _reserve_file_numbers(sumo_network)
         output_filename = os.path.join(
-            os.path.dirname(sumo_network.netfile),
-            'preprocessed_data',
-            '{:04}.h5').format(_next_file_number(sumo_network))
-    t0 = time.time()
-    hdf_filename = write_hdf_for_sumo_network(sumo_network)
-    t = time.time() - t0
-    _logger.debug('Extracting xml took {} s'.format(t))
-    t0 = time.time()
-    write_per_lane_tables(output_filename, sumo_network, hdf_filename)
-    t - time.time() - t0
-    _logger.debug('Writing preprocessed data took {} s'.format(t))
+            _preprocessed_data_dir(sumo_network),
+            '{:04}.h5').format(reserved[0])
+    try:
+        with preprocessing_pool(pool, sumo_network) as pool:
+            t0 = time.time()
+            hdf_filename = write_hdf_for_sumo_network(sumo_network,
+                                                      pool=pool)
+            t = time.time() - t0
+            _logger.debug('Extracting xml took {} s'.format(t))
+            t0 = time.time()
+            write_per_lane_tables(output_filename, sumo_network,
+                                  hdf_filename, pool=pool,
+                                  pyramid_intervals=pyramid_intervals)
+            t = time.time() - t0
+            _logger.debug('Writing preprocessed data took {} s'.format(t))
+    except BaseException:
+        if reserved is not None:
+            _release_file_numbers(sumo_network, reserved)
+        raise
     return output_filename
 
 
@@ -52,96 +87,243 @@ def write_per_lane_tables(output_filename,
                           raw_xml_filename=None,
                           X_features=raw_xml_x_feature_defaults,
                           Y_features=raw_xml_y_feature_defaults,
-                          complib='blosc:lz4', complevel=5):
-    """Write an hdf file with per-lane X and Y data arrays"""
-
-    X_df, Y_df = build_X_Y_tables_for_lanes(
-        sumo_network, raw_xml_filename=raw_xml_filename, X_features=X_features,
-        Y_features=Y_features)
-
-    lanes_with_data = X_df.index.get_level_values(0).unique()
-    assert len(lanes_with_data.difference(
-               Y_df.index.get_level_values(0)).unique()) == 0
-
-    A_dfs = build_A_tables_for_lanes(sumo_network, lanes_with_data)
-    A_df = pd.concat(A_dfs, axis=1)
+                          complib='blosc:lz4', complevel=5,
+                          pool=None,
+                          update_manifest=True,
+                          pyramid_intervals=None,
+                          per_cycle_features=per_cycle_features_default,
+                          when_per_cycle='end',
+                          cycle_tables=False):
+    """Write an hdf file with per-lane X and Y data arrays.
+
+    X and Y rows are ordered by lane, then time, with no index: the lanes are
+    those of the adjacency file and the times are the `TimeGrid` stored in
+    the tables' attributes. Columns are stored in compact dtypes (see
+    `trafficgraphnn.preprocessing.codec`). The adjacency is shared with the
+    network's other simulations in an `adjacency` directory next to the
+    file, so move or copy the file together with that directory (e.g. with
+    `trafficgraphnn.preprocessing.io.copy_preprocessed_file`).
+
+    :param update_manifest: If True, record the file in its directory's
+    DatasetManifest
+    :param pyramid_intervals: Numbers of timesteps to also store averaged X
+    and Y tables for (see `trafficgraphnn.preprocessing.pyramid`), e.g.
+    [5, 10, 30]
+    :param per_cycle_features: Features the levels take block maxima of, and
+    Y features the levels mask to one value per light cycle first
+    :param when_per_cycle: Where in the cycle the masked value goes
+    :param cycle_tables: If True, also store every lane's light cycles
+    aggregated with the default aggregations (see
+    `trafficgraphnn.preprocessing.cycles`). Needs the `green` feature
+    """
+    lanes_with_data, grid, X_columns, X, Y_columns, Y = \
+        build_X_Y_arrays_for_lanes(
+            sumo_network, raw_xml_filename=raw_xml_filename,
+            X_features=X_features, Y_features=Y_features, pool=pool)
+
+    A_matrices = build_A_matrices_for_lanes(sumo_network, lanes_with_data)
+    A_filename, A_hash = write_adjacency_file(
+        os.path.join(os.path.dirname(output_filename), ADJACENCY_DIRNAME),
+        lanes_with_data, A_matrices)
 
     if not os.path.isdir(os.path.dirname(output_filename)):
         os.makedirs(os.path.dirname(output_filename))
 
     with pd.HDFStore(output_filename, 'w', complevel=complevel,
                      complib=complib) as store:
-        store.put('X', X_df)
-        store.put('Y', Y_df)
-        store.put('A', A_df)
+        for key, data, columns in [('X', X, X_columns),
+                                   ('Y', Y, Y_columns)]:
+            _put_lane_table(store, key, data, columns, grid)
+        for interval, (X_level, Y_level, info) in _pyramid_levels(
+                X, X_columns, Y, Y_columns, pyramid_intervals,
+                per_cycle_features, when_per_cycle):
+            for key, data, columns in [('X', X_level, X_columns),
+                                       ('Y', Y_level, Y_columns)]:
+                level_key = pyramid_key(key, interval)
+                _put_lane_table(store, level_key, data, columns,
+                                level_grid(grid, interval))
+                set_storer_pyramid(store, level_key, info)
+        if cycle_tables:
+            _put_cycle_tables(store, X, X_columns, Y, Y_columns,
+                              per_cycle_features, grid)
+        # A is shared by all simulations of the network, so store a reference
+        store.put('A_ref', pd.Series(
+            {'filename': os.path.relpath(A_filename,
+                                         os.path.dirname(output_filename)),
+             'hash': A_hash}))
+
+    if update_manifest:
+        entry = make_entry(output_filename, len(lanes_with_data), grid,
+                           X_columns, Y_columns, A_hash, A_filename)
+        with DatasetManifest.locked(
+                os.path.dirname(output_filename)) as manifest:
+            manifest.add(output_filename, entry)
+
+
+def _put_lane_table(store, key, data, columns, grid):
+    df, codecs = encode_table(
+        pd.DataFrame(data.reshape(-1, len(columns)), columns=columns))
+    store.put(key, df)
+    set_storer_grid(store, key, grid)
+    set_storer_codecs(store, key, codecs)
+
+
+def _pyramid_levels(X, X_columns, Y, Y_columns, intervals, per_cycle_features,
+                    when_per_cycle):
+    """Yield (interval, (X level, Y level, level info)) for each interval.
+
+    The levels are what `load_data.read_from_file` gives with
+    `average_interval`: per-cycle Y features masked when there is a green
+    feature, then blocks averaged.
+    """
+    if not intervals:
+        return
+    masked = 'green' in X_columns and len(per_cycle_features) > 0
+    if masked:
+        Y = Y.copy()
+        feats_to_mask = [feat for feat in per_cycle_features
+                         if feat in Y_columns]
+        mask_per_cycle_features(
+            X[:, :, X_columns.index('green')], Y,
+            [Y_columns.index(feat) for feat in feats_to_mask],
+            [pad_value_for_feature[feat] for feat in feats_to_mask],
+            when_per_cycle)
+
+    for interval in sorted(set(int(interval) for interval in intervals)):
+        if interval <= 1:
+            continue
+        info = level_info(interval, per_cycle_features, when_per_cycle,
+                          masked)
+        yield interval, (
+            downsample_time_axis(X, interval, X_columns, per_cycle_features),
+            downsample_time_axis(Y, interval, Y_columns, per_cycle_features),
+            info)
+
+
+def _put_cycle_tables(store, X, X_columns, Y, Y_columns, per_cycle_features,
+                      grid):
+    if 'green' not in X_columns:
+        raise ValueError('Cycle tables need the green feature')
+    X_cycle, Y_cycle, bounds = aggregate_cycles(
+        X, Y, X[:, :, X_columns.index('green')], X_columns, Y_columns,
+        per_cycle_features, freq=grid.freq)
+    cycle_grid = TimeGrid(0., 1., X_cycle.shape[1])
+    _put_lane_table(store, X_CYCLE_KEY, X_cycle,
+                    cycle_feature_names(X_columns), cycle_grid)
+    _put_lane_table(store, Y_CYCLE_KEY, Y_cycle, Y_columns, cycle_grid)
+    _put_lane_table(store, BOUNDS_KEY, bounds, ['begin', 'end'], cycle_grid)
+    set_storer_cycle_info(store, X_CYCLE_KEY, cycle_info(per_cycle_features))
+
+
+def build_A_matrices_for_lanes(sumo_network, lanes=None):
+    """Returns dict of scipy sparse matrices for different lane adjacencies"""
+    if lanes is None:
+        lanes = sumo_network.lanes_with_detectors()
+    lanes = list(lanes)
+    index = sumo_network.lane_index
+
+    # connections of an undirected graph go both ways
+    undirected = sumo_network.undirected_graph
+
+    A_matrices = OrderedDict()
+    A_matrices['A_downstream'] = index.adjacency(lanes,
+                                                 undirected=undirected)
+    A_matrices['A_upstream'] = index.adjacency(lanes, reverse=True,
+                                               undirected=undirected)
+    A_matrices['A_neighbors'] = index.neighbor_adjacency(
+        lanes, include_self_adjacency=False)
+    A_matrices['A_turn_movements'] = index.adjacency(
+        lanes, directions=['l', 'r'], undirected=undirected)
+    A_matrices['A_through_movements'] = index.adjacency(
+        lanes, directions=['s'], undirected=undirected)
+    return A_matrices
 
 
 def build_A_tables_for_lanes(sumo_network, lanes=None):
     """Returns dict of dataframes for different lane adjacency matrices"""
     if lanes is None:
         lanes = sumo_network.lanes_with_detectors()
+    lanes = list(lanes)
+    A_matrices = build_A_matrices_for_lanes(sumo_network, lanes)
+    return {name: pd.DataFrame(A.toarray(), index=lanes, columns=lanes)
+            for name, A in A_matrices.items()}
 
-    A_dfs = {}
-    A_dfs['A_downstream'] = nx.to_pandas_adjacency(
-        sumo_network.graph, nodelist=lanes).astype('bool')
-
-    A_dfs['A_upstream'] = nx.to_pandas_adjacency(
-        sumo_network.graph.reverse(), nodelist=lanes).astype('bool')
-
-    A_dfs['A_neighbors'] = nx.to_pandas_adjacency(
-        sumo_network.get_lane_graph_for_neighboring_lanes(
-            include_self_adjacency=False),
-        nodelist=lanes).astype('bool')
 
-    A_dfs['A_turn_movements'] = nx.to_pandas_adjacency(
-        sumo_network.get_lane_graph_for_turn_movements(),
-        nodelist=lanes).astype('bool')
-
-    A_dfs['A_through_movements'] = nx.to_pandas_adjacency(
-        sumo_network.get_lane_graph_for_thru_movements(),
-        nodelist=lanes).astype('bool')
+def build_X_Y_tables_for_lanes(sumo_network,
+                               lane_subset=None,
+                               raw_xml_filename=None,
+                               X_features=raw_xml_x_feature_defaults,
+                               Y_features=raw_xml_y_feature_defaults,
+                               num_workers=None,
+                               clip_ending_pad_timesteps=True,
+                               pool=None):
+    """Return per-lane dataframe for X and Y with specified feature sets
+
+    :param pool: PreprocessingPool to use, otherwise a temporary pool with
+    `num_workers` workers is created
+    """
+    lanes, grid, X_columns, X, Y_columns, Y = build_X_Y_arrays_for_lanes(
+        sumo_network, lane_subset, raw_xml_filename, X_features, Y_features,
+        num_workers, clip_ending_pad_timesteps, pool)
+
+    index = pd.MultiIndex.from_product([lanes, grid.times()],
+                                       names=['lane', 'begin'])
+    X_df = pd.DataFrame(X.reshape(-1, len(X_columns)), index=index,
+                        columns=X_columns)
+    Y_df = pd.DataFrame(Y.reshape(-1, len(Y_columns)), index=index,
+                        columns=Y_columns)
 
-    return A_dfs
+    return X_df, Y_df
 
 
-def build_X_Y_tables_for_lanes(sumo_network,
+def build_X_Y_arrays_for_lanes(sumo_network,
                                lane_subset=None,
                                raw_xml_filename=None,
                                X_features=raw_xml_x_feature_defaults,
                                Y_features=raw_xml_y_feature_defaults,
                                num_workers=None,
-                               clip_ending_pad_timesteps=True):
-    """Return per-lane dataframe for X and Y with specified feature sets"""
+                               clip_ending_pad_timesteps=True,
+                               pool=None):
+    """Per-lane X and Y data as (lanes, time, feature) arrays.
+
+    All lanes share one time grid: row `t` of every lane is at the grid's
+    `t`th time.
+
+    :return: Lane list, TimeGrid, X columns, X array, Y columns, Y array
+    :rtype: tuple
+    """
     # default to all lanes
     if lane_subset is None:
         lane_subset = sumo_network.lanes_with_detectors()
+    lane_subset = list(lane_subset)
     if raw_xml_filename is None:
-        raw_xml_filename = os.path.join(os.path.dirname(sumo_network.netfile),
-                                        'output', 'raw_xml.hdf')
-
-    if 'green' in X_features:
-        green_df = per_lane_green_series_for_sumo_network(sumo_network)
-        green_serieses = {lane_id: green_df.loc[:, lane_id].rename('green')
-                          for lane_id in lane_subset}
-    else:
-        green_serieses = {}
-
-    # run liu method if needed
-    if len(set(['liu_estimated_m', 'liu_estimated_veh']).intersection(
-               X_features)) > 0:
-        liu_result_df = liu_method_for_net(sumo_network, raw_xml_filename)
-        liu_serieses = {lane_id: __get_liu_series(liu_result_df, lane_id)
-                        for lane_id in lane_subset}
-    else:
-        liu_serieses = {}
+        raw_xml_filename = os.path.join(sumo_network.output_dir,
+                                        'raw_xml.hdf')
 
-    with multiprocessing.Pool(num_workers) as pool:
-        dfs = pool.starmap(
-            _X_Y_dfs_for_lane,
+    with preprocessing_pool(pool, sumo_network, num_workers) as pool:
+        if 'green' in X_features:
+            green_df = per_lane_green_series_for_sumo_network(
+                sumo_network, raw_xml_filename, pool=pool)
+            green_serieses = {lane_id: green_df.loc[:, lane_id].rename('green')
+                              for lane_id in lane_subset}
+        else:
+            green_serieses = {}
+
+        # run liu method if needed
+        if len(set(['liu_estimated_m', 'liu_estimated_veh']).intersection(
+                   X_features)) > 0:
+            liu_result_df = liu_method_for_net(sumo_network, raw_xml_filename,
+                                               pool=pool)
+            liu_serieses = {lane_id: __get_liu_series(liu_result_df, lane_id)
+                            for lane_id in lane_subset}
+        else:
+            liu_serieses = {}
+
+        # detector dicts are in the workers' network state
+        lane_arrays = pool.starmap(
+            _X_Y_arrays_for_lane_from_state,
             zip(repeat(raw_xml_filename),
                 lane_subset,
-                [sumo_network.graph.nodes[lane]['detectors']
-                 for lane in lane_subset],
                 repeat(X_features),
                 repeat(Y_features),
                 [green_serieses[lane] if lane in green_serieses else None
@@ -149,62 +331,152 @@ def build_X_Y_tables_for_lanes(sumo_network,
                 [liu_serieses[lane] if lane in liu_serieses else None
                  for lane in lane_subset])
         )
-        X_dfs, Y_dfs = zip(*dfs)
-
-        X_df = pd.concat(X_dfs, join='outer', keys=lane_subset,
-                         names=['lane', 'begin'])
-        Y_df = pd.concat(Y_dfs, join='outer', keys=lane_subset,
-                         names=['lane', 'begin'])
-
-        # fill in blanks
-        if 'green' in X_features:
-            X_df['green'] = X_df['green'].ffill()
-
-        X_df = X_df.fillna(pad_value_for_feature)
-        Y_df = Y_df.fillna(pad_value_for_feature)
-
-        if clip_ending_pad_timesteps:
-            clip_after = max(map(last_nonpad_timestep, [X_df, Y_df]))
-            X_df = X_df.loc[pd.IndexSlice[:, :clip_after], :]
-            Y_df = Y_df.loc[pd.IndexSlice[:, :clip_after], :]
-
-    return X_df, Y_df
+    X_arrays, Y_arrays = zip(*lane_arrays)
+
+    # all lanes share one time grid, which the loaders assume
+    grid = TimeGrid.union([lane_grid for lane_grid, _, _ in X_arrays + Y_arrays])
+    X_columns, X = _assemble_lane_arrays(X_arrays, grid)
+    Y_columns, Y = _assemble_lane_arrays(Y_arrays, grid)
+    del lane_arrays, X_arrays, Y_arrays
+
+    # fill in blanks in place
+    if 'green' in X_columns:
+        _ffill_time_axis(X[:, :, X_columns.index('green')])
+    _fill_pad_values(X, X_columns)
+    _fill_pad_values(Y, Y_columns)
+
+    if clip_ending_pad_timesteps:
+        num_timesteps = 1 + max(_last_nonpad_timestep_index(X, X_columns),
+                                _last_nonpad_timestep_index(Y, Y_columns))
+        grid = grid.subgrid(0, num_timesteps)
+        X = X[:, :num_timesteps]
+        Y = Y[:, :num_timesteps]
+
+    return lane_subset, grid, X_columns, X, Y_columns, Y
+
+
+def _X_Y_arrays_for_lane_from_state(filename, lane_id, X_features,
+                                    Y_features, green_series=None,
+                                    liu_series=None):
+    detector_dict = worker_network_state().lane_detectors[lane_id]
+    return _X_Y_arrays_for_lane(filename, lane_id, detector_dict, X_features,
+                                Y_features, green_series, liu_series)
+
+
+def _assemble_lane_arrays(lane_arrays, grid):
+    """Place per-lane (grid, columns, values) into a (lanes, T, F) array.
+
+    Columns are ordered by first appearance, as in an outer concat. Entries
+    a lane has no data for are NaN.
+    """
+    columns = []
+    for _, lane_columns, _ in lane_arrays:
+        columns.extend(col for col in lane_columns if col not in columns)
+    column_index = {col: i for i, col in enumerate(columns)}
+
+    data = np.full((len(lane_arrays), len(grid), len(columns)), np.nan,
+                   dtype=np.float32)
+    for i, (lane_grid, lane_columns, values) in enumerate(lane_arrays):
+        start = int(grid.offsets(lane_grid.t0)) if len(lane_grid) > 0 else 0
+        cols = [column_index[col] for col in lane_columns]
+        data[i, start:start + len(lane_grid)][:, cols] = values
+    return columns, data
+
+
+def _ffill_time_axis(data):
+    """Forward-fill NaNs along axis 1 of a (lanes, T) array, in place"""
+    valid = ~np.isnan(data)
+    last_valid = np.where(valid, np.arange(data.shape[1]), 0)
+    np.maximum.accumulate(last_valid, axis=1, out=last_valid)
+    data[...] = np.take_along_axis(data, last_valid, axis=1)
+
+
+def _fill_pad_values(data, columns):
+    """Replace NaNs with each feature's pad value, in place"""
+    for i, col in enumerate(columns):
+        if col in pad_value_for_feature:
+            feature = data[:, :, i]
+            feature[np.isnan(feature)] = pad_value_for_feature[col]
+
+
+def _last_nonpad_timestep_index(data, columns):
+    """Index of the last timestep where any lane has a non-pad value.
+
+    Array version of `last_nonpad_timestep`.
+    """
+    features = [i for i, col in enumerate(columns)
+                if col in pad_value_for_feature and col != 'green']
+    if len(features) == 0:
+        return data.shape[1] - 1
+    pads = np.array([pad_value_for_feature[columns[i]] for i in features],
+                    dtype=np.float32)
+    is_pad = (data[:, :, features] == pads).all(axis=2).all(axis=0)
+    nonpad = np.flatnonzero(~is_pad)
+    return nonpad[-1] if len(nonpad) > 0 else 0
+
+
+def _X_Y_arrays_for_lane(filename, lane_id, detector_dict,
+                         X_features, Y_features, green_series=None,
+                         liu_series=None):
+    """A lane's X and Y data on the time grid of its detectors.
+
+    Detector tables are placed by their grid offsets, so no index joins are
+    needed. The green and liu series are placed at the grid rows of their
+    times; values off the grid are dropped.
+
+    :return: (TimeGrid, columns, float32 values) for each of X and Y
+    :rtype: tuple
+    """
+    # e1 (loop) detectors first, then e2 (lane area), each by position
+    det_ids = (lane_detectors_of_type_sorted_by_position(detector_dict, 'e1')
+               + lane_detectors_of_type_sorted_by_position(detector_dict,
+                                                           'e2'))
+    with pd.HDFStore(filename, 'r') as input_store:
+        tables = OrderedDict(
+            (det_id, read_raw_table(input_store, 'raw_xml/{}'.format(det_id)))
+            for det_id in det_ids)
+    grid = TimeGrid.union([det_grid for det_grid, _ in tables.values()])
+
+    X_parts = __get_table_parts(tables, X_features, lane_id, grid)
+    Y_parts = __get_table_parts(tables, Y_features, lane_id, grid)
+
+    # add some more X features if needed
+    for series in [green_series, liu_series]:
+        if series is None:
+            continue
+        rows = grid.offsets(series.index.values)
+        on_grid = ((rows >= 0) & (rows < len(grid))
+                   & np.isclose(grid.t0 + rows * grid.freq,
+                                series.index.values))
+        X_parts.append(([series.name], rows[on_grid],
+                        series.values[on_grid, np.newaxis]))
+
+    return (grid,) + __stack_parts(X_parts, len(grid)), \
+           (grid,) + __stack_parts(Y_parts, len(grid))
+
+
+def __get_table_parts(tables, features, lane_id, grid):
+    parts = []
+    for det_id, (det_grid, df) in tables.items():
+        feats = [feat for feat in features if feat in df]
+        if len(feats) == 0:
+            continue
+        prefix = _det_id_minus_lane_id(det_id, lane_id) + '/'
+        start = int(grid.offsets(det_grid.t0)) if len(det_grid) > 0 else 0
+        parts.append(([prefix + feat for feat in feats],
+                      slice(start, start + len(det_grid)),
+                      df[feats].values))
+    return parts
 
 
-def _X_Y_dfs_for_lane(filename, lane_id, detector_dict,
-                      X_features, Y_features, green_series=None,
-                      liu_series=None):
-    with pd.HDFStore(filename, 'r') as input_store:
-        # e1 (loop) detector data
-        e1_detectors = lane_detectors_of_type_sorted_by_position(
-            detector_dict, 'e1')
-        e1_dfs = OrderedDict((det_id,
-                                input_store['raw_xml/{}'.format(det_id)])
-                                for det_id in e1_detectors)
-        X_lane_dfs_e1 = __get_dfs_feats(e1_dfs, X_features, lane_id)
-        Y_lane_dfs_e1 = __get_dfs_feats(e1_dfs, Y_features, lane_id)
-
-        # e2 (lane area) detector data
-        e2_detectors = lane_detectors_of_type_sorted_by_position(
-            detector_dict, 'e2')
-        e2_dfs = OrderedDict((det_id,
-                                input_store['raw_xml/{}'.format(det_id)])
-                                for det_id in e2_detectors)
-        X_lane_dfs_e2 = __get_dfs_feats(e2_dfs, X_features, lane_id)
-        Y_lane_dfs_e2 = __get_dfs_feats(e2_dfs, Y_features, lane_id)
-
-        X_lane_dfs = [*X_lane_dfs_e1, *X_lane_dfs_e2]
-        Y_lane_dfs = [*Y_lane_dfs_e1, *Y_lane_dfs_e2]
-
-        # add some more X features if needed
-        X_lane_dfs.append(green_series) # no-op if these are None
-        X_lane_dfs.append(liu_series)
-
-        # append columns (features) together
-        X_lane_df = pd.concat(X_lane_dfs, axis=1)
-        Y_lane_df = pd.concat(Y_lane_dfs, axis=1)
-
-        return X_lane_df, Y_lane_df
+def __stack_parts(parts, length):
+    columns = [col for part_columns, _, _ in parts for col in part_columns]
+    values = np.full((length, len(columns)), np.nan, dtype=np.float32)
+    i = 0
+    for part_columns, rows, part_values in parts:
+        values[rows, i:i + len(part_columns)] = part_values
+        i += len(part_columns)
+    return columns, values
 
 
 def last_nonpad_timestep(df):
@@ -223,25 +495,6 @@ def last_nonpad_timestep(df):
     return last_nonpad
 
 
-def __get_dfs_feats(det_dfs, features, lane_id):
-    subdfs = OrderedDict((det_id,
-                          df[[feat for feat in features if feat in df]])
-                         for det_id, df in det_dfs.items())
-    out = __det_df_dict_to_dfs_with_prefixed_columns(subdfs, lane_id)
-    return out
-
-
-def __det_df_dict_to_dfs_with_prefixed_columns(df_dict, lane_id):
-    dfs = []
-    for det_id, df in df_dict.items():
-        prefix = _det_id_minus_lane_id(det_id, lane_id) + '/'
-        new_colnames = prefix + df.columns
-        df = df.rename(columns={col: newcol for col, newcol
-                                in zip(df.columns, new_colnames)})
-        dfs.append(df)
-    return dfs
-
-
 def __get_liu_series(liu_results, lane_id):
     df = liu_results[lane_id]
     try:
@@ -253,12 +506,18 @@ def __get_liu_series(liu_results, lane_id):
     return df
 
 
-def per_lane_green_series_for_sumo_network(sumo_network):
+def per_lane_green_series_for_sumo_network(sumo_network,
+                                           raw_xml_filename=None,
+                                           pool=None):
+    """Per-lane green table, from the raw hdf file if it has one"""
+    if raw_xml_filename is not None and os.path.exists(raw_xml_filename):
+        with pd.HDFStore(raw_xml_filename, 'r') as store:
+            if '/raw_xml/tls_switch' in store.keys():
+                return read_raw_df(store, 'raw_xml/tls_switch')
     light_switch_out_files = light_switch_out_files_for_sumo_network(
         sumo_network)
-    assert len(light_switch_out_files) == 1
-    light_timing_df = light_timing_xml_to_phase_df(
-        light_switch_out_files.pop())
+    light_timing_df = light_timing_xml_files_to_phase_df(
+        sorted(light_switch_out_files), pool=pool)
     return light_timing_df
 
 
@@ -276,15 +535,23 @@ def lane_detectors_of_type_sorted_by_position(lane_dict, det_type):
     return dets_of_type
 
 
-def _next_file_number(sumo_network):
-    data_dir = os.path.join(os.path.dirname(sumo_network.netfile),
-                            'preprocessed_data')
+def _preprocessed_data_dir(sumo_network):
+    return os.path.join(os.path.dirname(sumo_network.netfile),
+                        'preprocessed_data')
+
+
+def _reserve_file_numbers(sumo_network, count=1):
+    """Reserve numbers for new preprocessed files in the network's manifest"""
+    with DatasetManifest.locked(
+            _preprocessed_data_dir(sumo_network)) as manifest:
+        return manifest.reserve_file_numbers(count)
 
-    files = get_preprocessed_filenames(data_dir)
-    fnames = [os.path.basename(f) for f in files]
-    numbers = [int(re.search(r'\d+', f).group()) for f in fnames]
 
-    return max(numbers, default=0) + 1
+def _release_file_numbers(sumo_network, numbers):
+    """Release reserved numbers of preprocessed files that were not written"""
+    with DatasetManifest.locked(
+            _preprocessed_data_dir(sumo_network)) as manifest:
+        manifest.release_file_numbers(numbers)
 
 
 def _prune_det_id_in_colnames(colnames, lane_id):
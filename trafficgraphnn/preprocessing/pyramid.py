@@ -0,0 +1,100 @@
+"""Precomputed time-averaged levels of preprocessed X and Y tables.
+
+Loading with an `average_interval` averages blocks of that many timesteps,
+taking the maximum of per-cycle features. Preprocessing can store those
+averages for a set of intervals as tables `X_avg{interval}` and
+`Y_avg{interval}` next to `X` and `Y`, so loaders read the level instead of
+averaging every time a file is loaded.
+
+Each level table keeps its `TimeGrid` (the full grid's start, with
+`interval` times its spacing) and the per-cycle settings it was computed
+with in its storer attributes.
+"""
+import logging
+
+import numpy as np
+
+from trafficgraphnn.preprocessing.features import get_pad_value_for_feature
+from trafficgraphnn.preprocessing.time_grid import TimeGrid
+
+_logger = logging.getLogger(__name__)
+
+_ATTR_NAME = 'pyramid'
+
+
+def pyramid_key(key, interval):
+    """Table name of the `interval` level of table `key`"""
+    return '{}_avg{}'.format(key, int(interval))
+
+
+def level_grid(grid, interval):
+    """Grid of the `interval` level of a table on `grid`"""
+    return TimeGrid(grid.t0, grid.freq * interval,
+                    int(np.ceil(len(grid) / interval)))
+
+
+def level_info(interval, per_cycle_features, when_per_cycle, masked):
+    """Settings a level was computed with.
+
+    :param masked: Whether per-cycle Y features were masked to one value per
+    light cycle before averaging (which needs the `green` feature)
+    """
+    return {'interval': int(interval),
+            'per_cycle_features': list(per_cycle_features),
+            'when_per_cycle': when_per_cycle,
+            'masked': bool(masked)}
+
+
+def level_matches(info, x_features, y_features, per_cycle_features,
+                  when_per_cycle):
+    """Whether a level holds what loading the features at full resolution
+    and averaging them would give"""
+    stored = set(info['per_cycle_features'])
+    requested = set(per_cycle_features)
+    if any((feat in stored) != (feat in requested)
+           for feat in list(x_features) + list(y_features)):
+        return False
+    if any(feat in requested for feat in y_features):
+        masked = 'green' in x_features and len(per_cycle_features) > 0
+        if masked != info['masked']:
+            return False
+        if masked and when_per_cycle != info['when_per_cycle']:
+            return False
+    return True
+
+
+def downsample_time_axis(data, interval, features, per_cycle_features):
+    """Average (lanes, time, feature) data over blocks of `interval` steps.
+
+    As in `load_data_tf.average_over_interval`, the last block is filled up
+    with each feature's pad value, and features in `per_cycle_features` take
+    the block maximum instead of the mean.
+
+    :return: float32 array of shape (lanes, ceil(time / interval), feature)
+    """
+    num_lanes, num_timesteps, num_features = data.shape
+    num_intervals = int(np.ceil(num_timesteps / interval))
+    padded = np.empty((num_lanes, num_intervals * interval, num_features),
+                      dtype=np.float32)
+    padded[:, :num_timesteps] = data
+    padded[:, num_timesteps:] = [get_pad_value_for_feature(feat)
+                                 for feat in features]
+    blocks = padded.reshape(num_lanes, num_intervals, interval, num_features)
+
+    out = blocks.mean(2, dtype=np.float32)
+    is_max = np.array([feat in per_cycle_features for feat in features],
+                      dtype=bool)
+    if is_max.any():
+        out[..., is_max] = blocks[..., is_max].max(2)
+    return out
+
+
+def set_storer_pyramid(store, key, info):
+    setattr(store.get_storer(key).attrs, _ATTR_NAME, info)
+
+
+def get_storer_pyramid(store, key):
+    attrs = store.get_storer(key).attrs
+    if _ATTR_NAME not in attrs:
+        return None
+    return getattr(attrs, _ATTR_NAME)
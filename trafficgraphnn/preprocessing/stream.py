@@ -0,0 +1,321 @@
+"""Ingest SUMO detector and tls outputs while the simulation runs.
+
+The output paths in a run's additional files are replaced by named pipes
+(FIFOs). An ingest process reads every pipe in its own thread, parses the
+xml as SUMO writes it, and stores the parsed frames in the same raw hdf
+layout as `write_hdf_for_sumo_network`, so the xml outputs never hit the disk.
+"""
+import logging
+import multiprocessing
+import os
+import select
+import stat
+import threading
+import time
+
+import pandas as pd
+from lxml import etree
+
+from trafficgraphnn.preprocessing.io import (detector_output_xml_to_df,
+                                             light_timing_xml_to_phase_df,
+                                             merge_phase_dfs, write_raw_table)
+
+_logger = logging.getLogger(__name__)
+
+_detector_tags = ['e1Detector', 'inductionLoop',
+                  'e2Detector', 'laneAreaDetector']
+
+
+def output_paths_in_additional_files(addlfiles, net_dir=None):
+    """Find the output paths named in additional files.
+
+    :param net_dir: Directory relative paths are resolved against, defaults
+    to each additional file's directory
+    :return: Sets of detector output paths and tls switch output paths
+    :rtype: tuple
+    """
+    detector_paths = set()
+    tls_paths = set()
+    for addlfile in addlfiles:
+        base_dir = net_dir if net_dir is not None else os.path.dirname(addlfile)
+        for _, element in etree.iterparse(addlfile, events=('end',)):
+            if element.tag in _detector_tags:
+                path = element.get('file')
+                if path is not None:
+                    detector_paths.add(os.path.join(base_dir, path))
+            elif (element.tag == 'timedEvent'
+                  and element.get('type') == 'SaveTLSSwitchTimes'):
+                path = element.get('dest')
+                if path is not None:
+                    tls_paths.add(os.path.join(base_dir, path))
+    return detector_paths, tls_paths
+
+
+def make_fifos(paths):
+    """Create a named pipe at each path, replacing existing regular files"""
+    for path in paths:
+        if os.path.exists(path):
+            if stat.S_ISFIFO(os.stat(path).st_mode):
+                continue
+            os.remove(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.mkfifo(path)
+
+
+def remove_fifos(paths):
+    for path in paths:
+        try:
+            if stat.S_ISFIFO(os.stat(path).st_mode):
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _unblock_fifos(paths):
+    """Open and close the write end of each pipe.
+
+    Readers still waiting for a writer (e.g. because SUMO exited before
+    opening its outputs) then see end-of-file instead of blocking forever.
+    """
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError: # no reader waiting on this pipe
+            continue
+        os.close(fd)
+
+
+def open_fifo_reader(path):
+    """Open a read end of a pipe without waiting for a writer.
+
+    While it is open the writer never sees a closed pipe, even if another
+    reader of the same pipe closes its end (as lxml does when a parse
+    fails). Returns None for regular files and missing paths.
+    """
+    try:
+        if not stat.S_ISFIFO(os.stat(path).st_mode):
+            return None
+        return os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+
+
+def drain_fifo(fd, poll_interval=.1):
+    """Read and discard a pipe's read end `fd` until its writer closes it.
+
+    Only call this once a writer has opened the pipe: before that, reads see
+    end-of-file.
+    """
+    while True:
+        try:
+            chunk = os.read(fd, 1 << 16)
+        except BlockingIOError: # writer open, nothing written yet
+            select.select([fd], [], [], poll_interval)
+            continue
+        if not chunk:
+            return
+
+
+def ingest_streams_to_hdf(detector_paths,
+                          tls_paths,
+                          hdf_filename,
+                          complevel=5,
+                          complib='blosc:lz4',
+                          failed_event=None):
+    """Parse each output stream in its own thread and write the raw hdf file.
+
+    Every pipe must be read concurrently: SUMO writes to all outputs during
+    the simulation and would block on any pipe that is not being drained.
+    A stream that fails to parse is therefore still read to its end, from
+    a read end that is held open for the whole stream.
+
+    :param failed_event: Optional event set as soon as a stream fails, so
+    the caller can stop the writer early
+    :return: Paths whose streams could not be parsed
+    :rtype: list
+    """
+    results = {}
+    failed = []
+    lock = threading.Lock()
+
+    def read_stream(path, parse):
+        # opened before the parser, so the writer keeps a reader throughout
+        fd = open_fifo_reader(path)
+        try:
+            try:
+                result = parse(path)
+            except Exception:
+                _logger.error('Could not parse stream %s', path,
+                              exc_info=True)
+                with lock:
+                    failed.append(path)
+                if failed_event is not None:
+                    failed_event.set()
+                if fd is not None:
+                    drain_fifo(fd)
+                return None
+        finally:
+            if fd is not None:
+                os.close(fd)
+        return result
+
+    def read_detector_stream(path):
+        result = read_stream(path, detector_output_xml_to_df)
+        if result is not None:
+            with lock:
+                results.update(result)
+
+    def read_tls_stream(path):
+        df = read_stream(path, light_timing_xml_to_phase_df)
+        if df is not None:
+            with lock:
+                results.setdefault('tls_switch', []).append(df)
+
+    threads = [threading.Thread(target=read_detector_stream, args=(path,))
+               for path in detector_paths]
+    threads.extend(threading.Thread(target=read_tls_stream, args=(path,))
+                   for path in tls_paths)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if os.path.exists(hdf_filename):
+        os.remove(hdf_filename)
+    tls_dfs = results.pop('tls_switch', [])
+    with pd.HDFStore(hdf_filename, complevel=complevel,
+                     complib=complib) as store:
+        for det_id, df in results.items():
+            write_raw_table(store, 'raw_xml/{}'.format(det_id), df)
+        if len(tls_dfs) > 0:
+            write_raw_table(store, 'raw_xml/tls_switch',
+                            merge_phase_dfs(tls_dfs))
+    return failed
+
+
+def _ingest_process_target(detector_paths, tls_paths, hdf_filename,
+                           failed_event):
+    failed = ingest_streams_to_hdf(detector_paths, tls_paths, hdf_filename,
+                                   failed_event=failed_event)
+    if len(failed) > 0:
+        raise RuntimeError('Failed to ingest streams {}'.format(failed))
+
+
+class StreamIngest(object):
+    """Streams a run's outputs through pipes into a raw hdf file.
+
+    Usage::
+
+        ingest = StreamIngest(sumo_network.additional_files,
+                              sumo_network.output_dir)
+        ingest.start()
+        process = sumo_network.popen()
+        ingest.wait_for_writer(process)
+        ingest.join()
+
+    :param addlfiles: Additional files whose output paths are streamed
+    :param output_dir: Directory for the raw hdf file
+    """
+    def __init__(self, addlfiles, output_dir, net_dir=None,
+                 hdf_filename='raw_xml.hdf'):
+        self.detector_paths, self.tls_paths = \
+            output_paths_in_additional_files(addlfiles, net_dir)
+        self.hdf_filename = os.path.join(output_dir, hdf_filename)
+        self.process = None
+        self.failed_event = None
+
+    @property
+    def paths(self):
+        return self.detector_paths | self.tls_paths
+
+    def start(self):
+        make_fifos(self.paths)
+        self.failed_event = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=_ingest_process_target,
+            args=(sorted(self.detector_paths), sorted(self.tls_paths),
+                  self.hdf_filename, self.failed_event))
+        self.process.start()
+        return self
+
+    def early_failure(self):
+        """Why ingest can no longer drain the writer's pipes, or None"""
+        if self.failed_event.is_set():
+            return 'A stream failed to parse'
+        if not self.process.is_alive() and self.process.exitcode != 0:
+            return 'Stream ingest exited with code {}'.format(
+                self.process.exitcode)
+        return None
+
+    def wait_for_writer(self, writer, poll_interval=.5):
+        """Wait for the writer (SUMO) process while watching the ingest.
+
+        If a stream fails or the ingest process dies while the writer runs,
+        the writer is killed, since it could block forever on a pipe that is
+        no longer read. Once the writer has exited this also waits for
+        ingest to finish (see `join`).
+
+        :param writer: The writer's subprocess.Popen
+        :return: The writer's return code
+        :raises RuntimeError: If ingest failed, whether before or after the
+        writer exited
+        """
+        while writer.poll() is None:
+            failure = self.early_failure()
+            if failure is not None:
+                _logger.error('%s, killing the writer', failure)
+                writer.kill()
+                writer.wait()
+                self.terminate()
+                raise RuntimeError(failure)
+            time.sleep(poll_interval)
+        # the writer can exit before a failed stream is seen above, so wait
+        # for ingest to finish reading and check it
+        self.join(poll_interval)
+        if self.failed_event.is_set():
+            raise RuntimeError('A stream failed to parse')
+        return writer.returncode
+
+    def terminate(self):
+        """Stop the ingest process and remove the pipes"""
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        remove_fifos(self.paths)
+
+    def join(self, poll_interval=1.):
+        """Wait for ingest to finish. Call after the writer has exited.
+
+        Pipes the writer never opened (e.g. because SUMO failed at startup)
+        are unblocked until the ingest process exits.
+
+        :return: Filename of the raw hdf file
+        """
+        while True:
+            _unblock_fifos(self.paths)
+            self.process.join(poll_interval)
+            if not self.process.is_alive():
+                break
+        remove_fifos(self.paths)
+        if self.process.exitcode != 0:
+            raise RuntimeError(
+                'Stream ingest exited with code {}'.format(
+                    self.process.exitcode))
+        return self.hdf_filename
+
+
+def replay_xml_to_fifo(xml_file, fifo_path, chunk_size=4096, delay=0.):
+    """Write a recorded xml output into a pipe, standing in for SUMO.
+
+    :param delay: Seconds to sleep between chunks, to mimic a simulation
+    writing over time
+    """
+    with open(xml_file, 'rb') as f_in, open(fifo_path, 'wb') as f_out:
+        while True:
+            chunk = f_in.read(chunk_size)
+            if not chunk:
+                break
+            f_out.write(chunk)
+            f_out.flush()
+            if delay > 0:
+                time.sleep(delay)
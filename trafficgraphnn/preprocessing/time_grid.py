@@ -0,0 +1,165 @@
+"""Regular time grids for detector data.
+
+Detectors report at a fixed frequency, so a table's times are
+`t0 + i * freq` for `i` in `range(length)`. A `TimeGrid` stores those three
+numbers instead of a float index per row, and maps times to integer row
+offsets, so slicing by time is positional and tables on the same grid line
+up without index joins.
+
+Grids are kept in the hdf storer attributes of the tables they describe
+(see `set_storer_grid` and `get_storer_grid`).
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+_logger = logging.getLogger(__name__)
+
+_ATTR_NAME = 'time_grid'
+
+
+class TimeGrid(object):
+    """Times `t0 + i * freq` for `i` in `range(length)`.
+
+    :param t0: First time
+    :param freq: Spacing between times
+    :param length: Number of times
+    """
+    def __init__(self, t0, freq, length):
+        if freq <= 0:
+            raise ValueError('Grid frequency must be positive, got {}'.format(
+                freq))
+        self.t0 = float(t0)
+        self.freq = float(freq)
+        self.length = int(length)
+
+    @classmethod
+    def from_times(cls, times, freq=None):
+        """Grid of sorted, evenly spaced times.
+
+        :raises ValueError: If the times are not evenly spaced
+        """
+        times = np.asarray(times, dtype=np.float64)
+        if len(times) == 0:
+            return cls(0., freq or 1., 0)
+        if freq is None:
+            freq = _infer_freq(times)
+        grid = cls(times[0], freq, len(times))
+        if not np.allclose(times, grid.times(), rtol=0, atol=1e-6 * freq):
+            raise ValueError('Times are not on a regular grid')
+        return grid
+
+    @classmethod
+    def covering(cls, times, freq=None):
+        """Smallest grid containing `times`, which may have gaps.
+
+        :param freq: Spacing, defaults to the smallest gap between times
+        """
+        times = np.unique(np.asarray(times, dtype=np.float64))
+        if len(times) == 0:
+            return cls(0., freq or 1., 0)
+        if freq is None:
+            freq = _infer_freq(times)
+        length = int(np.rint((times[-1] - times[0]) / freq)) + 1
+        return cls(times[0], freq, length)
+
+    @classmethod
+    def union(cls, grids):
+        """Smallest grid containing every grid in `grids`.
+
+        :raises ValueError: If the grids do not have a common frequency
+        """
+        grids = [grid for grid in grids if len(grid) > 0]
+        if len(grids) == 0:
+            return cls(0., 1., 0)
+        freq = grids[0].freq
+        if any(not np.isclose(grid.freq, freq) for grid in grids):
+            raise ValueError('Grids have different frequencies: {}'.format(
+                sorted(set(grid.freq for grid in grids))))
+        t0 = min(grid.t0 for grid in grids)
+        end = max(grid.end for grid in grids)
+        return cls(t0, freq, int(np.rint((end - t0) / freq)) + 1)
+
+    @property
+    def end(self):
+        """Last time on the grid"""
+        return self.t0 + (self.length - 1) * self.freq
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        return (isinstance(other, TimeGrid)
+                and self.length == other.length
+                and np.isclose(self.t0, other.t0)
+                and np.isclose(self.freq, other.freq))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'TimeGrid(t0={}, freq={}, length={})'.format(
+            self.t0, self.freq, self.length)
+
+    def times(self):
+        return self.t0 + np.arange(self.length) * self.freq
+
+    def index(self, name='begin'):
+        return pd.Index(self.times(), name=name)
+
+    def offsets(self, times):
+        """Integer offsets of times on the grid (rounded to the nearest)"""
+        return np.rint((np.asarray(times, dtype=np.float64) - self.t0)
+                       / self.freq).astype(np.int64)
+
+    def offset(self, time, side='left'):
+        """Offset of the first (`side='left'`) time on the grid at or after
+        `time`, or one past the last (`side='right'`) at or before it"""
+        position = (time - self.t0) / self.freq
+        if side == 'left':
+            offset = int(np.ceil(position - 1e-6))
+        elif side == 'right':
+            offset = int(np.floor(position + 1e-6)) + 1
+        else:
+            raise ValueError('side must be `left` or `right`')
+        return min(max(offset, 0), self.length)
+
+    def slice(self, begin=None, end=None):
+        """Row slice of the times in `[begin, end]`, as with `.loc`"""
+        start = 0 if begin is None else self.offset(begin, 'left')
+        stop = self.length if end is None else self.offset(end, 'right')
+        return slice(start, max(start, stop))
+
+    def subgrid(self, start, stop):
+        """Grid of the rows `start:stop`"""
+        start, stop, _ = slice(start, stop).indices(self.length)
+        return TimeGrid(self.t0 + start * self.freq, self.freq,
+                        max(stop - start, 0))
+
+    def to_dict(self):
+        return {'t0': self.t0, 'freq': self.freq, 'length': self.length}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['t0'], d['freq'], d['length'])
+
+
+def _infer_freq(times):
+    diffs = np.diff(times)
+    diffs = diffs[diffs > 0]
+    if len(diffs) == 0:
+        return 1.
+    return float(diffs.min())
+
+
+def set_storer_grid(store, key, grid):
+    setattr(store.get_storer(key).attrs, _ATTR_NAME, grid.to_dict())
+
+
+def get_storer_grid(store, key):
+    """The grid stored with table `key`, or None for tables with an index"""
+    attrs = store.get_storer(key).attrs
+    if _ATTR_NAME not in attrs:
+        return None
+    return TimeGrid.from_dict(getattr(attrs, _ATTR_NAME))
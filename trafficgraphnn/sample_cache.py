@@ -0,0 +1,130 @@
+"""Cache of loaded per-file samples that lives across epochs.
+
+Reading a preprocessed file means opening the hdf store, decoding its
+tables and masking the per-cycle features, and an epoch reads every file
+again. `SampleCache` keeps the arrays of each file once they are loaded, in
+memory up to a byte budget with least recently used eviction, and
+optionally as .npz snapshots in a local directory, so later epochs and
+other processes skip the reading.
+
+Entries are keyed by the file's path, mtime and size and by the loading
+parameters, so changing either loads the file again.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+
+class SampleCache(object):
+    """LRU cache of tuples of arrays, one per preprocessed file.
+
+    :param max_bytes: Memory budget, None for no limit, 0 to keep nothing
+    in memory (use with `snapshot_dir`)
+    :param snapshot_dir: If given, samples are also saved there and loaded
+    from there when they are not in memory
+    """
+    def __init__(self, max_bytes=None, snapshot_dir=None):
+        self.max_bytes = max_bytes
+        self.snapshot_dir = snapshot_dir
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(filename, params):
+        """Cache key of `filename` loaded with the dict `params`"""
+        stat = os.stat(filename)
+        params = json.dumps(params, sort_keys=True, default=str)
+        return os.path.realpath(filename), stat.st_mtime, stat.st_size, params
+
+    def get_or_load(self, filename, params, load_func):
+        """The cached sample of `filename`, or `load_func(filename)` cached.
+
+        :param load_func: Function of the filename that returns a tuple of
+        arrays
+        """
+        key = self.key(filename, params)
+        with self._lock:
+            sample = self._entries.get(key)
+            if sample is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return sample
+
+        sample = None
+        if self.snapshot_dir is not None:
+            sample = self._read_snapshot(key)
+        if sample is None:
+            sample = tuple(load_func(filename))
+            if self.snapshot_dir is not None:
+                self._write_snapshot(key, sample)
+
+        with self._lock:
+            self.misses += 1
+            self._insert(key, sample)
+        return sample
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.nbytes,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def _insert(self, key, sample):
+        if key in self._entries:
+            return
+        size = _sample_nbytes(sample)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._entries[key] = sample
+        self.nbytes += size
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _sample_nbytes(evicted)
+            self.evictions += 1
+
+    def snapshot_filename(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.snapshot_dir, digest + '.npz')
+
+    def _read_snapshot(self, key):
+        filename = self.snapshot_filename(key)
+        try:
+            with np.load(filename, allow_pickle=False) as npz:
+                return tuple(npz['arr_{}'.format(i)]
+                             for i in range(len(npz.files)))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            _logger.warning('Could not read cache snapshot %s', filename,
+                            exc_info=True)
+            return None
+
+    def _write_snapshot(self, key, sample):
+        filename = self.snapshot_filename(key)
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        tmp_filename = '{}.{}.{}.tmp.npz'.format(
+            filename[:-len('.npz')], os.getpid(), threading.get_ident())
+        np.savez(tmp_filename, *[np.asarray(array) for array in sample])
+        os.replace(tmp_filename, filename)
+
+
+def _sample_nbytes(sample):
+    return sum(np.asarray(array).nbytes for array in sample)
@@ -0,0 +1,539 @@
+"""Run many SUMO simulations of one network concurrently.
+
+Every run gets its own seed, trip file, output directory and additional
+files, so that runs never write to the same files. Finished runs are
+preprocessed while the remaining ones keep simulating.
+"""
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+import numpy as np
+from lxml import etree
+
+from trafficgraphnn.gendata import sample_trip_files
+from trafficgraphnn.preprocessing.io import write_hdf_for_sumo_network
+from trafficgraphnn.preprocessing.pool import PreprocessingPool
+from trafficgraphnn.preprocessing.preprocess import (_release_file_numbers,
+                                                     _reserve_file_numbers,
+                                                     write_per_lane_tables)
+from trafficgraphnn.preprocessing.stream import StreamIngest
+from trafficgraphnn.sumo_network import SumoNetwork
+from trafficgraphnn.utils import get_num_cpus
+
+_logger = logging.getLogger(__name__)
+
+_detector_tags = ['e1Detector', 'inductionLoop',
+                  'e2Detector', 'laneAreaDetector']
+
+
+class SimulationRun(object):
+    """Per-run state: seed, paths, and the running SUMO process"""
+    def __init__(self, number, seed, run_dir, output_filename):
+        self.number = number
+        self.seed = seed
+        self.run_dir = run_dir
+        self.output_dir = os.path.join(run_dir, 'output')
+        self.output_filename = output_filename
+        self.tag = 'rand_run{:04}'.format(number)
+
+        self.sumo_network = None
+        self.process = None
+        self.log_file = None
+        self.tripfile = None
+        self.routefile = None
+        self.raw_xml_filename = None
+        self.stream_ingest = None
+
+    def __repr__(self):
+        return 'SimulationRun({}, seed={})'.format(self.number, self.seed)
+
+
+class SimulationFarm(object):
+    """Runs simulations of a network in parallel and preprocesses their output.
+
+    :param sumo_network: Network to simulate. Its additional files are used
+    as templates for the per-run additional files.
+    :type sumo_network: SumoNetwork
+    :param num_concurrent: Number of SUMO processes to run at once, defaults
+    to the number of CPUs
+    :param seed: Seed for drawing the per-run seeds
+    :param keep_raw_output: If False, delete each run's SUMO outputs and trip
+    files once it has been preprocessed
+    :param stream_outputs: If True, SUMO writes its outputs into named pipes
+    that are parsed while the simulation runs, instead of xml files
+    :param sample_trips: If True, sample all runs' trip files in one call to
+    the vectorized sampler, which draws trips like randomTrips but drops
+    unroutable ones and uses its own random stream (see
+    `trafficgraphnn.gendata.sample_trip_files`). If False, call randomTrips
+    for each run.
+    """
+    def __init__(self,
+                 sumo_network,
+                 num_concurrent=None,
+                 period=.4,
+                 binomial=None,
+                 trip_end_time=3600,
+                 sim_end_time=None,
+                 seed=None,
+                 runs_dir=None,
+                 keep_raw_output=False,
+                 stream_outputs=False,
+                 sample_trips=False):
+        self.sumo_network = sumo_network
+        self.config_gen = sumo_network.config_gen
+        if num_concurrent is None:
+            num_concurrent = get_num_cpus()
+        self.num_concurrent = num_concurrent
+        self.period = period
+        self.binomial = binomial
+        self.trip_end_time = trip_end_time
+        self.sim_end_time = sim_end_time
+        self.random_state = np.random.RandomState(seed)
+        if runs_dir is None:
+            runs_dir = os.path.join(sumo_network.net_dir, 'runs')
+        self.runs_dir = runs_dir
+        self.keep_raw_output = keep_raw_output
+        self.stream_outputs = stream_outputs
+        self.sample_trips = sample_trips
+
+        self.preprocessed_dir = os.path.join(sumo_network.net_dir,
+                                             'preprocessed_data')
+        self._prepare_lock = threading.Lock()
+        self._active_runs = set()
+        self._cancelled = False
+        self._active_lock = threading.Lock()
+        self.scheduler = None
+        self.pool = None
+
+    def make_runs(self, num_simulations):
+        """Draw seeds and reserve preprocessed file numbers for new runs"""
+        # assume sumo uses basic C 16-bit integers
+        seeds = self.random_state.randint(np.iinfo(np.int16).max,
+                                          size=num_simulations)
+        numbers = _reserve_file_numbers(self.sumo_network, num_simulations)
+        runs = []
+        for number, seed in zip(numbers, seeds):
+            runs.append(SimulationRun(
+                number, int(seed),
+                os.path.join(self.runs_dir, '{:04}'.format(number)),
+                os.path.join(self.preprocessed_dir,
+                             '{:04}.h5'.format(number))))
+
+        if self.sample_trips:
+            try:
+                for run in runs:
+                    os.makedirs(run.run_dir, exist_ok=True)
+                    run.tripfile = os.path.join(run.run_dir, 'trips.xml')
+                sample_trip_files(
+                    self.sumo_network.netfile,
+                    [run.tripfile for run in runs],
+                    [run.seed for run in runs],
+                    period=self.period, binomial=self.binomial,
+                    end_time=self.trip_end_time)
+            except BaseException:
+                _release_file_numbers(self.sumo_network, numbers)
+                raise
+        return runs
+
+    def run(self, num_simulations, max_queue_size=1, cancel_timeout=60.):
+        """Run `num_simulations` simulations and preprocess them.
+
+        Simulations run in `num_concurrent` producer threads while the
+        calling thread ingests and tensorizes finished runs.
+
+        :param max_queue_size: Number of finished runs allowed to wait for
+        preprocessing before the simulation threads block, which bounds the
+        disk used by raw outputs
+        :param cancel_timeout: Seconds to wait for the simulation threads to
+        exit after running simulations were killed because preprocessing
+        failed
+        :return: Filenames of the preprocessed data files, in run order
+        :rtype: list
+        """
+        scheduler = ProducerConsumerScheduler(
+            self.simulate,
+            [('ingest', self.ingest),
+             ('tensorize', self.tensorize)],
+            num_producers=self.num_concurrent,
+            max_queue_size=max_queue_size,
+            producer_stage_name='simulate',
+            cancel=self.cancel_runs,
+            join_timeout=cancel_timeout)
+
+        self.scheduler = scheduler
+        self._cancelled = False
+
+        runs = self.make_runs(num_simulations)
+        # one worker pool for the preprocessing stages of every run
+        with PreprocessingPool() as pool:
+            pool.set_network(self.sumo_network)
+            self.pool = pool
+            try:
+                finished = scheduler.run(runs)
+            except BaseException:
+                if len(scheduler.outputs) > 0:
+                    _logger.error(
+                        'Preprocessed %d runs before failing: %s',
+                        len(scheduler.outputs),
+                        [run.output_filename for run in scheduler.outputs])
+                if len(scheduler.unconsumed) > 0:
+                    _logger.error(
+                        'Simulated %d runs that were not preprocessed, their '
+                        'outputs are kept in %s',
+                        len(scheduler.unconsumed),
+                        [run.run_dir for run in scheduler.unconsumed])
+                # numbers of files that were not written can be reused
+                written = {run.number for run in scheduler.outputs}
+                _release_file_numbers(
+                    self.sumo_network,
+                    [run.number for run in runs if run.number not in written])
+                raise
+            finally:
+                self.pool = None
+        scheduler.log_stats()
+
+        return [run.output_filename
+                for run in sorted(finished, key=lambda r: r.number)]
+
+    def prepare_run(self, run):
+        """Write the trip file and additional files for a run and create
+        its SumoNetwork"""
+        os.makedirs(run.output_dir, exist_ok=True)
+
+        if run.tripfile is None:
+            self.config_gen.gen_rand_trips(
+                tag=run.tag, period=self.period, binomial=self.binomial,
+                seed=run.seed, end_time=self.trip_end_time)
+            run.tripfile = self.config_gen.tripfile
+            run.routefile = self.config_gen.routefile
+
+        addlfiles = write_run_additional_files(
+            self.sumo_network.additional_files, run.run_dir, run.output_dir)
+
+        run.sumo_network = SumoNetwork(
+            self.sumo_network.netfile,
+            lanewise=self.sumo_network.lanewise,
+            undirected_graph=self.sumo_network.undirected_graph,
+            routefile=run.tripfile,
+            addlfiles=addlfiles,
+            output_dir=run.output_dir)
+        return run
+
+    def start_run(self, run):
+        with self._prepare_lock: # config_gen is not thread safe
+            self.prepare_run(run)
+        if self.stream_outputs:
+            run.stream_ingest = StreamIngest(
+                run.sumo_network.additional_files, run.output_dir).start()
+        if self.sim_end_time is not None:
+            extra_args = ['--end', str(self.sim_end_time)]
+        else:
+            extra_args = None
+
+        run.log_file = open(os.path.join(run.run_dir, 'sumo.log'), 'w')
+        with self._active_lock:
+            if self._cancelled:
+                if run.stream_ingest is not None:
+                    run.stream_ingest.terminate()
+                run.log_file.close()
+                raise RuntimeError('{} was cancelled'.format(run))
+            run.process = run.sumo_network.popen(
+                extra_args=extra_args, seed=run.seed,
+                stdout=run.log_file, stderr=run.log_file)
+        _logger.info('Started %s', run)
+        return run
+
+    def cancel_runs(self):
+        """Kill the running SUMO processes, whose simulations then fail"""
+        with self._active_lock:
+            self._cancelled = True
+            runs = list(self._active_runs)
+        for run in runs:
+            if run.process is not None and run.process.poll() is None:
+                _logger.warning('Killing %s', run)
+                run.process.kill()
+
+    def simulate(self, run):
+        """Run a simulation to completion"""
+        with self._active_lock:
+            self._active_runs.add(run)
+        try:
+            self.start_run(run)
+            try:
+                if run.stream_ingest is not None:
+                    returncode = run.stream_ingest.wait_for_writer(
+                        run.process)
+                else:
+                    returncode = run.process.wait()
+            finally:
+                run.log_file.close()
+        finally:
+            with self._active_lock:
+                self._active_runs.discard(run)
+        if run.stream_ingest is not None:
+            run.raw_xml_filename = run.stream_ingest.join()
+        if returncode != 0:
+            raise RuntimeError(
+                '{} failed with return code {}. See {}'.format(
+                    run, returncode, os.path.join(run.run_dir, 'sumo.log')))
+        return run
+
+    def ingest(self, run):
+        """Convert a finished run's xml outputs to the raw hdf file"""
+        if run.raw_xml_filename is not None: # already streamed
+            return run
+        run.raw_xml_filename = write_hdf_for_sumo_network(run.sumo_network,
+                                                          pool=self.pool)
+        return run
+
+    def tensorize(self, run):
+        """Write the per-lane tables for an ingested run"""
+        write_per_lane_tables(run.output_filename, run.sumo_network,
+                              run.raw_xml_filename, pool=self.pool)
+        _logger.info('Preprocessed %s into %s', run, run.output_filename)
+        if not self.keep_raw_output:
+            self.clean_up_run(run)
+        return run
+
+    def clean_up_run(self, run):
+        shutil.rmtree(run.run_dir, ignore_errors=True)
+        for filename in [run.tripfile, run.routefile]:
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
+
+
+def write_run_additional_files(addlfiles, run_dir, run_output_dir):
+    """Copy additional files into `run_dir`, pointing their outputs at
+    `run_output_dir`.
+
+    Detector `file` and tls-switch `dest` attributes are replaced with
+    absolute paths in `run_output_dir`, so they resolve the same for SUMO and
+    for the readers, which join them onto the network directory.
+
+    :return: Paths of the new additional files
+    :rtype: list
+    """
+    run_output_dir = os.path.realpath(run_output_dir)
+    new_files = []
+    for addlfile in addlfiles:
+        tree = etree.parse(addlfile)
+        for element in tree.iter():
+            if element.tag in _detector_tags:
+                attr = 'file'
+            elif (element.tag == 'timedEvent'
+                  and element.get('type') == 'SaveTLSSwitchTimes'):
+                attr = 'dest'
+            else:
+                continue
+            value = element.get(attr)
+            if value is not None:
+                element.set(attr, os.path.join(run_output_dir,
+                                               os.path.basename(value)))
+
+        new_file = os.path.join(run_dir, os.path.basename(addlfile))
+        tree.write(new_file)
+        new_files.append(new_file)
+    return new_files
+
+
+class StageStats(object):
+    """Item count and busy time of one pipeline stage"""
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy_time = 0.
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.busy_time += seconds
+
+    def mean_time(self):
+        return self.busy_time / self.count if self.count > 0 else np.nan
+
+    def throughput(self, wall_time):
+        """Items per hour over `wall_time` seconds"""
+        return self.count / wall_time * 3600 if wall_time > 0 else np.nan
+
+    def __repr__(self):
+        return 'StageStats({}: {} items, {:.1f} s busy)'.format(
+            self.name, self.count, self.busy_time)
+
+
+class ProducerConsumerScheduler(object):
+    """Overlap a producer stage with a chain of consumer stages.
+
+    `produce` is called on each input item from `num_producers` threads.
+    Products go through a queue holding at most `max_queue_size` items, so
+    producers block (backpressure) while the consumer is behind. The
+    consumer stages run in order in the thread that calls `run`.
+
+    If a producer fails, no new items are started, the products of items
+    already in flight are still consumed, and `run` then raises. If a
+    consumer stage fails, `cancel` is called to abort the items in flight.
+
+    :param produce: Function of one input item
+    :param consume_stages: List of (name, function) pairs. Each function
+    gets the previous stage's output.
+    :param cancel: Function without arguments that makes running `produce`
+    calls return early (e.g. by killing their processes), or None
+    :param join_timeout: Seconds to wait for producers to exit after a
+    failure, None to wait for them indefinitely
+    """
+    _done = object()
+
+    def __init__(self,
+                 produce,
+                 consume_stages,
+                 num_producers=1,
+                 max_queue_size=1,
+                 producer_stage_name='produce',
+                 cancel=None,
+                 join_timeout=None):
+        self.produce = produce
+        self.consume_stages = consume_stages
+        self.num_producers = num_producers
+        self.max_queue_size = max_queue_size
+        self.cancel = cancel
+        self.join_timeout = join_timeout
+
+        self.stats = [StageStats(producer_stage_name)]
+        self.stats.extend(StageStats(name) for name, _ in consume_stages)
+        self.wall_time = 0.
+        # outputs of the last stage, and products left unconsumed by a failed
+        # run, so that callers can recover them
+        self.outputs = []
+        self.unconsumed = []
+
+    def run(self, items):
+        """Run all items through the pipeline.
+
+        :return: Outputs of the last stage, in completion order
+        :rtype: list
+        """
+        inputs = queue.Queue()
+        for item in items:
+            inputs.put(item)
+        products = queue.Queue(maxsize=self.max_queue_size)
+        stop = threading.Event()
+
+        threads = [threading.Thread(target=self._producer_loop,
+                                    args=(inputs, products, stop),
+                                    daemon=True)
+                   for _ in range(self.num_producers)]
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+
+        outputs = []
+        self.outputs = outputs
+        self.unconsumed = []
+        num_done = 0
+        error = None
+        try:
+            while num_done < len(threads):
+                product = products.get()
+                if product is self._done:
+                    num_done += 1
+                elif isinstance(product, _ProducerError):
+                    if error is None:
+                        error = product
+                        # start no new items, but finish the ones in flight
+                        stop.set()
+                else:
+                    outputs.append(self._consume(product))
+            if error is not None:
+                raise RuntimeError(
+                    'Producer failed on {}'.format(error.item)
+                ) from error.exception
+        finally:
+            stop.set()
+            if num_done < len(threads) and self.cancel is not None:
+                _logger.info('Cancelling running producers')
+                self.cancel()
+            self._drain(products, threads)
+            self.wall_time = time.time() - t0
+        return outputs
+
+    def _drain(self, products, threads):
+        """Take products until the producers exit (or `join_timeout`
+        passes), keeping finished products in `unconsumed`"""
+        if self.join_timeout is not None:
+            deadline = time.time() + self.join_timeout
+        # let blocked producers finish their put and see the stop flag
+        while any(thread.is_alive() for thread in threads):
+            if self.join_timeout is not None and time.time() > deadline:
+                _logger.warning(
+                    'Producers still running after %g s, not waiting for '
+                    'them', self.join_timeout)
+                break
+            try:
+                self._keep_unconsumed(products.get(timeout=.1))
+            except queue.Empty:
+                pass
+        while True:
+            try:
+                self._keep_unconsumed(products.get_nowait())
+            except queue.Empty:
+                break
+        if len(self.unconsumed) > 0:
+            _logger.warning('Stopped with %d products not consumed: %s',
+                            len(self.unconsumed), self.unconsumed)
+
+    def _keep_unconsumed(self, product):
+        if product is not self._done and not isinstance(product,
+                                                        _ProducerError):
+            self.unconsumed.append(product)
+
+    def _producer_loop(self, inputs, products, stop):
+        stats = self.stats[0]
+        while not stop.is_set():
+            try:
+                item = inputs.get_nowait()
+            except queue.Empty:
+                break
+            t0 = time.time()
+            try:
+                product = self.produce(item)
+            except Exception as e: # surfaced in the consumer thread
+                _logger.exception('Producer failed on %s', item)
+                products.put(_ProducerError(item, e))
+                break
+            stats.add(time.time() - t0)
+            products.put(product)
+        products.put(self._done)
+
+    def _consume(self, product):
+        for (name, func), stats in zip(self.consume_stages, self.stats[1:]):
+            t0 = time.time()
+            product = func(product)
+            stats.add(time.time() - t0)
+        return product
+
+    def format_stats(self):
+        """One line of throughput statistics per stage"""
+        lines = []
+        for i, stats in enumerate(self.stats):
+            workers = self.num_producers if i == 0 else 1
+            utilization = stats.busy_time / max(self.wall_time, 1e-9) / workers
+            lines.append(
+                'Stage {}: {} items, {:.1f} s mean, {:.1f} items/h, '
+                '{:.0%} utilization'.format(
+                    stats.name, stats.count, stats.mean_time(),
+                    stats.throughput(self.wall_time), utilization))
+        return lines
+
+    def log_stats(self):
+        for line in self.format_stats():
+            _logger.info(line)
+
+
+class _ProducerError(object):
+    def __init__(self, item, exception):
+        self.item = item
+        self.exception = exception
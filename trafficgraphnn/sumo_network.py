@@ -6,10 +6,10 @@ import networkx as nx
 from lxml import etree
 
 from sumolib import checkBinary
-from sumolib.net import readNet
-import traci
 
 from trafficgraphnn.genconfig import ConfigGenerator
+from trafficgraphnn.lane_index import LaneIndex
+from trafficgraphnn.net_cache import get_parsed_net, read_net
 from trafficgraphnn.utils import (
     parse_detector_output_xml, parse_tls_output_xml, iterfy)
 
@@ -27,14 +27,18 @@ else:
 class SumoNetwork(object):
     def __init__(
         self, netfile, lanewise=True, undirected_graph=False,
-        routefile=None, addlfiles=None, binfile='sumo'
+        routefile=None, addlfiles=None, binfile='sumo', output_dir=None
     ):
         self.netfile = netfile
-        self.net = readNet(netfile)
+        self.net = read_net(netfile)
         self.undirected_graph = undirected_graph
         self.lanewise = lanewise
         self.routefile = routefile
         self.data_dfs = []
+        # directory the detector and tls outputs are written to
+        if output_dir is None:
+            output_dir = os.path.join(os.path.dirname(netfile), 'output')
+        self.output_dir = output_dir
 
         self.detector_def_files = []
         self.tls_output_def_files = []
@@ -147,7 +151,7 @@ class SumoNetwork(object):
             _logger.warning('Seed not set, SUMO seed will be random.')
             # assume sumo uses basic C 16-bit integers
             seed = np.random.randint(np.iinfo(np.int16).max)
-            sumo_args.extend(['--seed', str(seed)])
+        sumo_args.extend(['--seed', str(seed)])
 
         if self.binfile == 'sumo-gui':
             sumo_args.extend(['--start', '--quit'])
@@ -158,6 +162,7 @@ class SumoNetwork(object):
             return sumo_args  # used for passing to traci.load()
 
     def start(self):
+        import traci # only needed for interactive runs
         traci.start(self.get_sumo_command())
 
     def run(self, return_output=False, extra_args=None, **kwargs):
@@ -170,6 +175,16 @@ class SumoNetwork(object):
         if return_output:
             return out
 
+    def popen(self, extra_args=None, stdout=None, stderr=None, **kwargs):
+        """Start sumo in a subprocess and return without waiting for it.
+
+        :return: The running process
+        :rtype: subprocess.Popen
+        """
+        return subprocess.Popen(
+            self.get_sumo_command(extra_args=extra_args, **kwargs),
+            stdout=stdout, stderr=stderr)
+
     def sorted_lanes_for_edge(self, edge_id):
         lanes = self.net.getEdge(edge_id).getLanes()
         lanes.sort(key=lambda x: x.getIndex())
@@ -182,6 +197,8 @@ class SumoNetwork(object):
         if lanewise is not None:
             self.lanewise = lanewise
 
+        self._lane_index = None
+
         if self.lanewise:
             self.graph = get_lane_graph(
                 self.netfile, undirected=self.undirected_graph,
@@ -198,8 +215,29 @@ class SumoNetwork(object):
 
     def set_new_graph(self, new_graph):
         self.graph = new_graph
+        self._lane_index = None
+
+    @property
+    def lane_index(self):
+        """Array index of the lanes, connections and detectors, built on
+        first use.
+
+        :rtype: LaneIndex
+        """
+        if not self.lanewise:
+            raise ValueError('Lane index requires a lanewise graph.')
+        if self._lane_index is None:
+            if self.graph.is_directed():
+                lane_graph = self.graph
+            else: # connection directions are lost in an undirected graph
+                lane_graph = get_parsed_net(self.netfile).lane_graph
+            self._lane_index = LaneIndex.from_net_and_graph(
+                self.net, lane_graph, detector_graph=self.graph)
+        return self._lane_index
 
     def lanes_with_detectors(self):
+        if self.lanewise:
+            return self.lane_index.lanes_with_detectors()
         return [lane for lane, lane_data in self.graph.nodes.data('detectors')
                 if lane_data is not None]
 
@@ -216,12 +254,8 @@ class SumoNetwork(object):
         """
         if not isinstance(lane_id, str):
             raise TypeError('Expected str, got %s', type(lane_id))
-        sumolib_lane = self.net.getLane(lane_id)
-        parent_edge = sumolib_lane.getEdge()
-        ids = [lane.getID() for lane in parent_edge.getLanes()]
-        if not include_input_lane:
-            ids.remove(lane_id)
-        return ids
+        return self.lane_index.neighboring_lanes(
+            lane_id, include_input_lane=include_input_lane)
 
     def get_lane_graph_for_neighboring_lanes(self, include_self_adjacency=True):
         """Return networkx graph with edges connecting lanes in the same road (ie same Sumo `edge').
@@ -231,14 +265,16 @@ class SumoNetwork(object):
         """
         if not self.lanewise:
             raise ValueError('Cannot use this method for a non-lanewise graph.')
-        graph_copy = self._graph_shallow_copy(no_edges=True)
-        for lane in self.graph.nodes:
-            neigh_lanes = self.get_neighboring_lanes(
-                lane, include_input_lane=include_self_adjacency)
-            for neigh in neigh_lanes:
-                graph_copy.add_edge(lane, neigh)
+        A = self.lane_index.neighbor_adjacency(
+            include_self_adjacency=include_self_adjacency)
+        return self._graph_from_index_adjacency(A)
 
-        return graph_copy
+    def _graph_from_index_adjacency(self, A):
+        """Utility function: Graph over all lanes with the edges in `A`"""
+        graph = self.graph.__class__()
+        graph.add_nodes_from(self.lane_index.lane_ids)
+        graph.add_edges_from(self.lane_index.edge_list(A))
+        return graph
 
     def _graph_shallow_copy(self, no_edges=False):
         """Utility function: Get copy of graph without data (nodes/edges only).
@@ -268,6 +304,10 @@ class SumoNetwork(object):
         edge_classes = iterfy(edge_classes)
         assert all([isinstance(x, str) for x in edge_classes])
 
+        if edge_class_field == 'direction':
+            A = self.lane_index.adjacency(directions=edge_classes)
+            return self._graph_from_index_adjacency(A)
+
         graph_copy = self._graph_shallow_copy(no_edges=True)
         for in_lane, out_lane, edge_class in self.graph.edges.data(edge_class_field):
             if edge_class in edge_classes:
@@ -407,6 +447,9 @@ class SumoNetwork(object):
         if self.graph is None:
             raise ValueError("Graph not set.")
 
+        if self.lanewise:
+            return self.lane_index.detector_to_lane()
+
         graph = self.get_graph()
 
         det_to_node = {}
@@ -422,40 +465,13 @@ def get_lane_graph(netfile,
                    undirected=False,
                    detector_def_files=None,
                    tls_output_def_files=None):
-    net = readNet(netfile)
+    parsed_net = get_parsed_net(netfile)
+    tls_to_edges = parsed_net.tls_to_edges
 
     if undirected:
-        graph = nx.Graph()
+        graph = parsed_net.lane_graph.to_undirected()
     else:
-        graph = nx.DiGraph()
-
-    for edge in net.getEdges():
-        for lane in edge.getLanes():
-            graph.add_node(lane.getID(), length=lane.getLength())
-
-    tls_to_edges = {}
-
-    for node in net.getNodes():
-        for conn in node.getConnections():
-            tls_id = conn.getTLSID()
-            if tls_id not in tls_to_edges:
-                tls_to_edges[tls_id] = []
-            edge_from_to = (conn.getFromLane().getID(),
-                            conn.getToLane().getID())
-            graph.add_edge(
-                *edge_from_to,
-                direction=conn.getDirection(),
-                tls=tls_id)
-            tls_to_edges[tls_id].append(edge_from_to)
-
-    # sanity check
-    tls_to_edges_2 = {
-        tl.getID():
-        [tuple([lane.getID() for lane in conn[:-1]]) for conn in tl.getConnections()]
-        for tl in net.getTrafficLights()
-    }
-
-    assert tls_to_edges == tls_to_edges_2
+        graph = parsed_net.lane_graph.copy()
 
     if detector_def_files is not None:
         if isinstance(detector_def_files, six.string_types):
@@ -499,7 +515,7 @@ def get_lane_graph(netfile,
 def e2_detector_graph(
     netfile, detector_file, undirected=False, lanewise=True
 ):
-    net = readNet(netfile)
+    net = read_net(netfile)
 
     tree = etree.parse(detector_file)
 
@@ -527,7 +543,7 @@ def e2_detector_graph(
 
 
 def get_edge_graph(netfile, undirected=False, additional_files=None):
-    net = readNet(netfile)
+    net = read_net(netfile)
 
     if undirected:
         graph = nx.Graph()
@@ -1,6 +1,6 @@
 import logging
 from lxml import etree
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
 from itertools import chain
 import os
 
@@ -8,8 +8,10 @@ import numpy as np
 import pandas as pd
 
 import sumolib.net.lane
-from trafficgraphnn.utils import E1IterParseWrapper, E2IterParseWrapper, DetInfo
-from trafficgraphnn.get_tls_data import get_tls_data
+from trafficgraphnn.utils import (E1IterParseWrapper, E2IterParseWrapper,
+                                  DetInfo, iterfy)
+from trafficgraphnn.get_tls_data import TLSDataAccumulator
+from trafficgraphnn.preprocessing.io import read_raw_df
 
 _logger = logging.getLogger(__name__)
 
@@ -23,12 +25,110 @@ _Queueing_Period_Data = namedtuple(
      'list_jam_length_sum_e2'])
 
 
+LaneTLSTiming = namedtuple(
+    'LaneTLSTiming',
+    ['green_intervals', 'phase_start', 'phase_length', 'duration_green_light'])
+
+
+def union_intervals(intervals):
+    """Merge overlapping or back-to-back (begin, end) intervals.
+
+    :param intervals: Iterable of (begin, end) pairs
+    :return: Sorted list of merged [begin, end] lists
+    :rtype: list
+    """
+    merged = []
+    for begin, end in sorted(intervals):
+        if merged and merged[-1][1] >= begin - 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([begin, end])
+    return merged
+
+
+class TLSTimingIndex(object):
+    """Per-lane light timing info from a single streaming pass over the
+    tls-switch output file(s).
+
+    For every lane this holds the green intervals and the fixed-cycle timing
+    estimate that `get_tls_data` would give, so that lane readers don't each
+    have to scan the whole tls-switch document.
+    """
+    def __init__(self):
+        self._green_intervals = defaultdict(list)
+        self._fixed_cycle = defaultdict(TLSDataAccumulator)
+        self._timings = {}
+
+    @classmethod
+    def from_xml_files(cls, xml_files, lane_subset=None):
+        index = cls()
+        for xmlfile in iterfy(xml_files):
+            index.parse(xmlfile, lane_subset)
+        index.finalize()
+        return index
+
+    def parse(self, xmlfile, lane_subset=None):
+        parsed = etree.iterparse(xmlfile, tag='tlsSwitch')
+        for _, element in parsed:
+            try:
+                lane_id = element.attrib['fromLane']
+                to_lane = element.attrib.get('toLane')
+                begin = float(element.attrib['begin'])
+                end = float(element.attrib['end'])
+                duration = float(element.attrib['duration'])
+            except KeyError:
+                _logger.warning(
+                    'Could not parse XML element %s. expected a "tlsSwitch"',
+                    element)
+                continue
+            finally:
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+            if lane_subset is not None and lane_id not in lane_subset:
+                continue
+
+            self._green_intervals[lane_id].append((int(begin), int(end)))
+            self._fixed_cycle[lane_id].update(to_lane, end, duration)
+        self._timings = {}
+
+    def finalize(self):
+        self._timings = {
+            lane_id: LaneTLSTiming(union_intervals(intervals),
+                                   *self._fixed_cycle[lane_id].result())
+            for lane_id, intervals in self._green_intervals.items()}
+
+    def lanes(self):
+        return list(self._green_intervals.keys())
+
+    def __contains__(self, lane_id):
+        return lane_id in self._green_intervals
+
+    def timing_for_lane(self, lane_id):
+        if not self._timings:
+            self.finalize()
+        return self._timings[lane_id]
+
+    def green_intervals(self, lane_id):
+        """Return a copy of the (merged) green intervals for a lane"""
+        return [list(interval)
+                for interval in self.timing_for_lane(lane_id).green_intervals]
+
+    def fixed_cycle_estimate(self, lane_id):
+        """Return (phase_start, phase_length, duration_green_light) as given
+        by the old `get_tls_data` heuristic"""
+        timing = self.timing_for_lane(lane_id)
+        return (timing.phase_start, timing.phase_length,
+                timing.duration_green_light)
+
+
 class SumoNetworkOutputReader(object):
     def __init__(self, sumo_network):
         self.sumo_network = sumo_network
         self.graph = self.sumo_network.get_graph()
         self.net = sumo_network.net
-        self.parsed_xml_tls = None
+        self.tls_timing_index = None
 
         self.lane_readers = OrderedDict()
 
@@ -52,31 +152,24 @@ class SumoNetworkOutputReader(object):
         for reader in self.lane_readers.values():
             reader.green_intervals = []
 
+    def build_tls_timing_index(self):
+        tls_output_files = sorted({lane.tls_output_filename for lane
+                                   in self.lane_readers.values()})
+        self.tls_timing_index = TLSTimingIndex.from_xml_files(
+            tls_output_files, lane_subset=self.lane_readers)
+        return self.tls_timing_index
+
+    def get_tls_timing_index(self):
+        if self.tls_timing_index is None:
+            self.build_tls_timing_index()
+        return self.tls_timing_index
+
     def parse_phase_timings(self):
-        tls_output_files = {lane.tls_output_filename for lane
-                            in self.lane_readers.values()}
-
-        for xmlfile in tls_output_files:
-            parsed = etree.iterparse(xmlfile, tag='tlsSwitch')
-            for _, element in parsed:
-                try:
-                    lane_id = element.attrib['fromLane']
-                    start = int(float(element.attrib['begin']))
-                    end = int(float(element.attrib['end']))
-                except KeyError:
-                    _logger.warning(
-                        'Could not parse XML element %s. expected a "tlsSwitch"',
-                        element)
-                    continue
-                finally:
-                    element.clear()
-
-                try:
-                    lane = self.lane_readers[lane_id]
-                    lane.add_green_interval(start, end)
-                except KeyError: # lane not present
-                    pass
-        for lane in self.lane_readers.values():
+        index = self.build_tls_timing_index()
+
+        for lane_id, lane in self.lane_readers.items():
+            if lane_id in index:
+                lane.green_intervals.extend(index.green_intervals(lane_id))
             lane.union_green_intervals()
 
     def _open_or_get_hdfstore(self, store_filename):
@@ -246,24 +339,28 @@ class SumoLaneOutputReader(object):
         cycle_indexer = slice(start_time, end_time-1)
 
         # advance detector
-        adv_detector_string = f'raw_xml/{self.adv_detector_id}'
-        list_time = list(self.store[adv_detector_string].loc[cycle_indexer].index)
-        list_occupancy = list(self.store[adv_detector_string].loc[cycle_indexer]['occupancy'])
-        list_nVehEntered = list(self.store[adv_detector_string].loc[cycle_indexer]['nVehEntered'])
-        list_nVehContrib = list(self.store[adv_detector_string].loc[cycle_indexer]['nVehContrib'])
+        adv_df = read_raw_df(
+            self.store, f'raw_xml/{self.adv_detector_id}').loc[cycle_indexer]
+        list_time = list(adv_df.index)
+        list_occupancy = list(adv_df['occupancy'])
+        list_nVehEntered = list(adv_df['nVehEntered'])
+        list_nVehContrib = list(adv_df['nVehContrib'])
 
         # stopbar detector
-        stopbar_string = f'raw_xml/{self.stopbar_detector_id}'
-        list_time_stop = list(self.store[stopbar_string].loc[cycle_indexer].index)
-        list_nVehContrib_stop = list(self.store[stopbar_string].loc[cycle_indexer]['nVehContrib'])
+        stopbar_df = read_raw_df(
+            self.store,
+            f'raw_xml/{self.stopbar_detector_id}').loc[cycle_indexer]
+        list_time_stop = list(stopbar_df.index)
+        list_nVehContrib_stop = list(stopbar_df['nVehContrib'])
 
         # e2 detector
-        e2_string = f'raw_xml/{self.e2_detector_id}'
-        list_time_e2 = list(self.store[e2_string].loc[cycle_indexer].index)
-        list_startedHalts_e2 = list(self.store[e2_string].loc[cycle_indexer]['startedHalts'])
-        list_max_jam_length_m_e2 = list(self.store[e2_string].loc[cycle_indexer]['maxJamLengthInMeters'])
-        list_max_jam_length_veh_e2 = list(self.store[e2_string].loc[cycle_indexer]['maxJamLengthInVehicles'])
-        list_jam_length_sum_e2 = list(self.store[e2_string].loc[cycle_indexer]['jamLengthInMetersSum'])
+        e2_df = read_raw_df(
+            self.store, f'raw_xml/{self.e2_detector_id}').loc[cycle_indexer]
+        list_time_e2 = list(e2_df.index)
+        list_startedHalts_e2 = list(e2_df['startedHalts'])
+        list_max_jam_length_m_e2 = list(e2_df['maxJamLengthInMeters'])
+        list_max_jam_length_veh_e2 = list(e2_df['maxJamLengthInVehicles'])
+        list_jam_length_sum_e2 = list(e2_df['jamLengthInMetersSum'])
 
         interval_data = _Queueing_Period_Data(
             num_cycle, start_time=start_time, end_time=end_time,
@@ -341,13 +438,7 @@ class SumoLaneOutputReader(object):
         self.green_intervals.append((start_time, end_time))
 
     def union_green_intervals(self, assign_fixed_timing_heuristic=True):
-        intervals = []
-        for begin, end in sorted(self.green_intervals):
-            if intervals and intervals[-1][1] >= begin - 1:
-                intervals[-1][1] = max(intervals[-1][1], end)
-            else:
-                intervals.append([begin, end])
-        self.green_intervals = intervals
+        self.green_intervals = union_intervals(self.green_intervals)
 
         if assign_fixed_timing_heuristic:
             self._estimate_fixed_cycle_timings()
@@ -487,12 +578,10 @@ class SumoLaneOutputReader(object):
         self.phase_start = first_green[1]
 
         # estimating tls data!
-
-        if self.net_reader.parsed_xml_tls == None:
-            self.net_reader.parsed_xml_tls = etree.parse(self.tls_output_filename) # TODO move to own function that constructor calls
+        index = self.net_reader.get_tls_timing_index()
 
         (phase_start_old, phase_length_old, duration_green_light_old
-                    ) = get_tls_data(self.net_reader.parsed_xml_tls, self.lane_id)
+                    ) = index.fixed_cycle_estimate(self.lane_id)
 
         if phase_start_old != self.phase_start:
             _logger.warning('Lane %s: phase_start_old = %g, phase_start = %g',
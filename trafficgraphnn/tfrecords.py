@@ -0,0 +1,211 @@
+"""TFRecord copies of preprocessed simulations for native tf.data input.
+
+Reading the .h5 files with `tf.py_func` runs pandas under the GIL, so the
+input pipeline cannot use more than one core. `export_tfrecords` writes each
+preprocessed simulation, as `read_from_file` returns it, to its own TFRecord
+shard; `make_dataset_tfrecord` reads the shards with parallel interleave and
+decodes them with native ops.
+
+Shards hold the arrays for one choice of adjacency matrices, features and
+per-cycle masking, so they are named by a hash of those parameters (see
+`tfrecord_filename`) and sit in a `tfrecord` directory next to their .h5
+file by default.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from trafficgraphnn.load_data import (per_cycle_features_default,
+                                      read_from_file,
+                                      x_feature_subset_default,
+                                      y_feature_subset_default)
+from trafficgraphnn.utils import get_num_cpus, string_list_decode
+
+_logger = logging.getLogger(__name__)
+
+TFRECORD_DIRNAME = 'tfrecord'
+
+_FEATURES = {
+    'A': tf.FixedLenFeature([], tf.string),
+    'X': tf.FixedLenFeature([], tf.string),
+    'Y': tf.FixedLenFeature([], tf.string),
+    't': tf.FixedLenFeature([], tf.string),
+    'lanes': tf.VarLenFeature(tf.string),
+    'filename': tf.FixedLenFeature([], tf.string),
+    'num_lanes': tf.FixedLenFeature([], tf.int64),
+    'num_timesteps': tf.FixedLenFeature([], tf.int64),
+}
+
+
+def tfrecord_params_hash(A_name_list, x_feature_subset, y_feature_subset,
+                         per_cycle_features, when_per_cycle='end'):
+    """Short hash of the parameters that determine a shard's contents"""
+    params = [string_list_decode(A_name_list),
+              string_list_decode(x_feature_subset),
+              string_list_decode(y_feature_subset),
+              string_list_decode(per_cycle_features),
+              when_per_cycle]
+    return hashlib.sha1(
+        json.dumps(params).encode()).hexdigest()[:10]
+
+
+def tfrecord_filename(filename, params_hash, tfrecord_dir=None):
+    """Shard filename of preprocessed file `filename`"""
+    if tfrecord_dir is None:
+        tfrecord_dir = os.path.join(os.path.dirname(filename),
+                                    TFRECORD_DIRNAME)
+    base = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(tfrecord_dir,
+                        '{}.{}.tfrecord'.format(base, params_hash))
+
+
+def export_tfrecords(filenames,
+                     tfrecord_dir=None,
+                     A_name_list=['A_downstream',
+                                  'A_upstream',
+                                  'A_neighbors'],
+                     x_feature_subset=x_feature_subset_default,
+                     y_feature_subset=y_feature_subset_default,
+                     per_cycle_features=per_cycle_features_default,
+                     when_per_cycle='end',
+                     compression_type=None,
+                     num_workers=None,
+                     overwrite=False):
+    """Write a TFRecord shard for each preprocessed file.
+
+    Shards newer than their .h5 file are kept unless `overwrite` is True.
+
+    :param compression_type: None, 'ZLIB' or 'GZIP'
+    :return: List of shard filenames, in the order of `filenames`
+    """
+    params_hash = tfrecord_params_hash(A_name_list, x_feature_subset,
+                                       y_feature_subset, per_cycle_features,
+                                       when_per_cycle)
+    shards = [tfrecord_filename(f, params_hash, tfrecord_dir)
+              for f in filenames]
+
+    todo = [(f, shard, A_name_list, x_feature_subset, y_feature_subset,
+             per_cycle_features, when_per_cycle, compression_type)
+            for f, shard in zip(filenames, shards)
+            if overwrite or not _is_up_to_date(shard, f)]
+    if len(todo) == 0:
+        return shards
+
+    _logger.info('Writing %d TFRecord shards', len(todo))
+    if num_workers is None:
+        num_workers = get_num_cpus()
+    num_workers = min(num_workers, len(todo))
+    if num_workers > 1:
+        # forking after tensorflow has started its threads can deadlock the
+        # children, so workers are started fresh
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(num_workers) as pool:
+            pool.starmap(_write_shard, todo)
+    else:
+        for args in todo:
+            _write_shard(*args)
+    return shards
+
+
+def _is_up_to_date(shard, filename):
+    return (os.path.exists(shard)
+            and os.path.getmtime(shard) >= os.path.getmtime(filename))
+
+
+def _write_shard(filename, shard, A_name_list, x_feature_subset,
+                 y_feature_subset, per_cycle_features, when_per_cycle,
+                 compression_type):
+    A, X, Y, t, lanes = read_from_file(filename,
+                                       repeat_A_over_time=False,
+                                       A_name_list=A_name_list,
+                                       x_feature_subset=x_feature_subset,
+                                       y_feature_subset=y_feature_subset,
+                                       per_cycle_features=per_cycle_features,
+                                       when_per_cycle=when_per_cycle,
+                                       return_t_and_lanenames=True)
+    example = serialize_example(A[0], X, Y, t, lanes, filename)
+
+    os.makedirs(os.path.dirname(shard), exist_ok=True)
+    # write to a temporary name so readers never see a partial shard
+    tmp_shard = '{}.{}.tmp'.format(shard, os.getpid())
+    options = tf.python_io.TFRecordOptions(
+        _compression_type_enum(compression_type))
+    with tf.python_io.TFRecordWriter(tmp_shard, options) as writer:
+        writer.write(example)
+    os.replace(tmp_shard, shard)
+
+
+def _compression_type_enum(compression_type):
+    return {None: tf.python_io.TFRecordCompressionType.NONE,
+            '': tf.python_io.TFRecordCompressionType.NONE,
+            'ZLIB': tf.python_io.TFRecordCompressionType.ZLIB,
+            'GZIP': tf.python_io.TFRecordCompressionType.GZIP,
+           }[compression_type]
+
+
+def serialize_example(A, X, Y, t, lanes, filename):
+    """Serialized tf.train.Example of one simulation.
+
+    :param A: (depth, lanes, lanes) adjacency
+    :param X: (time, lanes, feature) array
+    :param Y: (time, lanes, feature) array
+    :param t: (time,) array
+    """
+    def _bytes(values):
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+
+    def _int(value):
+        return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+    lanes = [lane.encode() if isinstance(lane, str) else lane
+             for lane in lanes]
+    if isinstance(filename, str):
+        filename = filename.encode()
+
+    features = {
+        'A': _bytes([np.ascontiguousarray(A, dtype=np.uint8).tobytes()]),
+        'X': _bytes([np.ascontiguousarray(X, dtype=np.float32).tobytes()]),
+        'Y': _bytes([np.ascontiguousarray(Y, dtype=np.float32).tobytes()]),
+        't': _bytes([np.ascontiguousarray(t, dtype=np.float32).tobytes()]),
+        'lanes': _bytes(lanes),
+        'filename': _bytes([filename]),
+        'num_lanes': _int(X.shape[1]),
+        'num_timesteps': _int(X.shape[0]),
+    }
+    example = tf.train.Example(features=tf.train.Features(feature=features))
+    return example.SerializeToString()
+
+
+def parse_example(serialized, A_depth, num_x_features, num_y_features,
+                  max_time=None):
+    """Decode a serialized simulation into the tensors of `read_from_file`.
+
+    :return: A (time, depth, lanes, lanes), X and Y (time, lanes, feature),
+    t, lanes and the source .h5 filename
+    """
+    parsed = tf.parse_single_example(serialized, _FEATURES)
+    num_lanes = tf.cast(parsed['num_lanes'], tf.int32)
+    num_timesteps = tf.cast(parsed['num_timesteps'], tf.int32)
+
+    A = tf.cast(tf.decode_raw(parsed['A'], tf.uint8), tf.bool)
+    A = tf.reshape(A, [1, A_depth, num_lanes, num_lanes])
+    X = tf.reshape(tf.decode_raw(parsed['X'], tf.float32),
+                   [num_timesteps, num_lanes, num_x_features])
+    Y = tf.reshape(tf.decode_raw(parsed['Y'], tf.float32),
+                   [num_timesteps, num_lanes, num_y_features])
+    t = tf.reshape(tf.decode_raw(parsed['t'], tf.float32), [num_timesteps])
+    lanes = tf.sparse_tensor_to_dense(parsed['lanes'], default_value='')
+
+    if max_time is not None:
+        num_timesteps = tf.reduce_sum(tf.cast(t <= max_time, tf.int32))
+        X = X[:num_timesteps]
+        Y = Y[:num_timesteps]
+        t = t[:num_timesteps]
+
+    A = tf.tile(A, [num_timesteps, 1, 1, 1])
+    return A, X, Y, t, lanes, parsed['filename']
@@ -1,8 +1,12 @@
 import collections
+import collections.abc
 import logging
 import os
+import queue
 import re
 import sys
+import threading
+import time
 from itertools import chain, repeat, tee, zip_longest
 
 import pandas as pd
@@ -181,6 +185,23 @@ _col_dtype_key = {
     'liu_estimated_m': float,
 }
 
+# On-disk (dtype, divisor) of preprocessed features: a column is stored as
+# round(value * divisor) in dtype. SUMO writes these attributes with at most
+# two decimals, so the encoding is exact. Columns not listed are float32.
+_col_storage_codec = {
+    'nVehContrib': ('int16', 1),
+    'occupancy': ('uint16', 100),
+    'speed': ('int16', 100),
+    'nVehEntered': ('int16', 1),
+    'nVehLeft': ('int16', 1),
+    'nVehSeen': ('int16', 1),
+    'maxJamLengthInVehicles': ('int16', 1),
+    'maxJamLengthInMeters': ('int32', 100),
+    'jamLengthInVehiclesSum': ('int32', 1),
+    'startedHalts': ('int16', 1),
+    'green': ('uint8', 1),
+}
+
 
 def xml_to_list_of_dicts(
     xml_file, tags_to_filter=None, attributes_to_get=None
@@ -263,7 +284,7 @@ def in_interval(value, interval):
 
 
 def iterfy(x):
-    if isinstance(x, collections.Iterable) and type(x) not in six.string_types:
+    if isinstance(x, collections.abc.Iterable) and type(x) not in six.string_types:
         return x
     else:
         return (x,)
@@ -338,6 +359,133 @@ def col_type(colname):
         raise ValueError('Could not parse variable name {}'.format(colname))
 
 
+def col_storage_codec(colname):
+    """On-disk (dtype, divisor) of a preprocessed column, which may be
+    prefixed with its detector (e.g. 'e1_0/occupancy')"""
+    match = re.search(r'(?<=e\d_\d/)\S*', colname)
+    if match is not None:
+        colname = match.group()
+    return _col_storage_codec.get(colname, ('float32', 1))
+
+
+class AsyncHDFAppender(object):
+    """Appends dataframes to a table in an hdf file from a background thread.
+
+    Frames passed to `append` go through a bounded queue and are written in
+    batches, with one append once `max_rows` rows are buffered or `max_wait`
+    seconds have passed since the last write. The buffer is flushed on
+    `close`, which is also called on leaving a `with` block, including on
+    error. An error in the writer thread is raised in the caller on the next
+    `append` or on `close`.
+
+    :param filename: hdf file to write to
+    :param key: key of the table in the file
+    :param overwrite: If True, the first write replaces any existing table
+    under `key`. Otherwise all writes are appends.
+    """
+    _STOP = object()
+
+    def __init__(self, filename, key, max_rows=5000, max_wait=10.,
+                 max_queue_size=128, overwrite=True, complevel=None,
+                 complib=None):
+        self.filename = filename
+        self.key = key
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self.complevel = complevel
+        self.complib = complib
+
+        self._overwrite_next = overwrite
+        self._error = None
+        self._queue = queue.Queue(max_queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def append(self, df):
+        self._raise_if_failed()
+        self._queue.put(df)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+        self._raise_if_failed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except Exception: # don't mask the original exception
+                _logger.exception('Error in hdf writer for %s', self.filename)
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError(
+                'Writing to {} failed'.format(self.filename)) from self._error
+
+    def _run(self):
+        buffer = []
+        num_rows = 0
+        last_write = time.time()
+        while True:
+            if buffer:
+                timeout = max(0., self.max_wait - (time.time() - last_write))
+            else:
+                timeout = None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is self._STOP:
+                break
+            if item is not None:
+                buffer.append(item)
+                num_rows += len(item)
+
+            if buffer and (num_rows >= self.max_rows
+                           or time.time() - last_write >= self.max_wait):
+                self._write(buffer)
+                buffer = []
+                num_rows = 0
+                last_write = time.time()
+
+        self._write(buffer)
+        self._index_table()
+
+    def _write(self, dfs):
+        if len(dfs) == 0 or self._error is not None:
+            return
+        try:
+            df = pd.concat(dfs)
+            with pd.HDFStore(self.filename, 'a', complevel=self.complevel,
+                             complib=self.complib) as store:
+                if self._overwrite_next:
+                    if self.key in store:
+                        store.remove(self.key)
+                    self._overwrite_next = False
+                store.append(self.key, df, index=False)
+            _logger.debug('Wrote %g rows to %s', len(df), self.filename)
+        except Exception as e: # keep draining the queue so callers don't block
+            _logger.exception('Error writing to %s', self.filename)
+            self._error = e
+
+    def _index_table(self):
+        if self._error is not None or not os.path.exists(self.filename):
+            return
+        try:
+            with pd.HDFStore(self.filename, 'a') as store:
+                if self.key in store:
+                    store.create_table_index(self.key, optlevel=9, kind='full')
+        except Exception as e:
+            _logger.exception('Error indexing %s', self.filename)
+            self._error = e
+
+
 def prefixes_in_store(store):
     keys = store.keys()
     prefixes = [re.search('(?<=/).+(?=/X|/Y)', key).group() for key in keys]